@@ -0,0 +1,207 @@
+##########################
+# aggregate-only extraction: the report's tables of counts without a patient-level file
+##########################
+
+# This script:
+# runs a local_engine.py definition over the population in batches of patient_id ranges
+# and computes the aggregations the definition declares (eg vax_counts_stratified of
+# report.R) as it goes, so the action's outputs are the tables of counts rather than the
+# patient-level extract that process.R and report.R collapse to the same counts.
+#
+#  - each batch is evaluated on the source tables restricted to its range
+#    (`Engine.restrict_range()`, as resumable_extract.py), turned into the long dose table
+#    (dose_table.py) and counted by the aggregation's columns; only the counts so far are
+#    kept between batches, so memory is bounded by the batch rather than the population
+#  - the columns are those of the long table (vax_index, vax_type, ...), vax_week (the
+#    monday of the week of the dose), ageband (as process.R) and the aggregation's own
+#    patient-level variables (eg sex); region and sex are collapsed as in process.R, and
+#    missing values are written as NA
+#  - in sampled runs (see sampling.py) the counts are weighted by sample_weight
+#  - counts are rounded up to a multiple of the aggregation's rounding, as ceiling_any()
+#    in utility.R, once every batch is counted
+#  - `--patient-level PATH` also writes the patient-level extract, batch by batch
+#
+# Unlike report.R, products beyond the first 8 in the lookup keep their names rather than
+# becoming NA.
+#
+# usage:
+#   python analysis/aggregate_extract.py --definition varying --database db.sqlite [--batches 20]
+#       [--output-dir output/aggregates] [--patient-level output/local/extract_varying.arrow]
+
+import argparse
+import csv
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+import arrow_io
+import dose_coverage
+import dose_qa
+import dose_table
+import hashing
+import local_engine
+import resumable_extract
+import schema_registry
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+N_BATCHES = 20
+MISSING = "NA"
+
+# as in process.R
+SEX_GROUPS = {"female": "Female", "male": "Male"}
+GROUPS = {"sex": SEX_GROUPS, "region": dose_coverage.REGION_GROUPS}
+
+
+def dimension(name, long, patients):
+    # (codes, levels) of one column of an aggregation over the doses of a batch, with -1
+    # for missing values
+    if name == "vax_week":
+        days = dose_table.to_days(long.column("vax_date")).astype(np.int64)
+        # 1970-01-01 was a thursday
+        weeks, codes = np.unique(days - (days + 3) % 7, return_inverse=True)
+        return codes.ravel(), [str(dose_table.EPOCH + int(week)) for week in weeks]
+    if name == "ageband":
+        return dose_coverage.ageband_codes(long.column("age")), dose_coverage.AGEBAND_LABELS
+    column = patients[name] if name in patients else long.column(name)
+    return dose_coverage.level_codes(column, GROUPS.get(name))
+
+
+def patient_columns(aggregation, table, long):
+    # the aggregation's patient-level variables, one value per dose
+    position = np.searchsorted(table.column("patient_id").to_numpy(), long.column("patient_id").to_numpy())
+    index = pa.array(position)
+    return {variable.name: table.column(variable.name).take(index) for variable in aggregation.variables}
+
+
+def count_batch(counts, aggregation, long, patients):
+    # add the (weighted) doses of a batch to counts: {(level, ...): n}
+    if long.num_rows == 0:
+        return
+    codes, levels = zip(*(dimension(name, long, patients) for name in aggregation.by))
+    cells, inverse = np.unique(np.column_stack(codes), axis=0, return_inverse=True)
+    n = np.bincount(inverse.ravel(), weights=dose_qa.sample_weights(long), minlength=len(cells))
+    for cell, value in zip(cells.tolist(), n.tolist()):
+        key = tuple(levels[k][code] if code >= 0 else None for k, code in enumerate(cell))
+        counts[key] = counts.get(key, 0) + value
+
+
+def batch_definition(definition):
+    # the definition with the aggregations' variables added, and not conformed, so that
+    # they aren't dropped
+    variables = list(definition.variables)
+    names = {variable.name for variable in variables}
+    for aggregation in definition.aggregations:
+        for variable in aggregation.variables:
+            if variable.name not in names:
+                variables.append(variable)
+                names.add(variable.name)
+    return local_engine.Definition(
+        definition.name,
+        population=definition.population,
+        variables=variables,
+        frames=definition.frames.values(),
+        codelists=definition.codelists.values(),
+    )
+
+
+def run_aggregations(engine, definition, n_batches=N_BATCHES, patient_level=None):
+    # counts of each of the definition's aggregations; returns {name: counts} and stats
+    if not definition.aggregations:
+        raise ValueError(f"definition {definition.name} declares no aggregations")
+    ids = [row[0] for row in engine.query("SELECT patient_id FROM patients")]
+    bounds = resumable_extract.chunk_bounds(ids, n_batches)
+    extended = batch_definition(definition)
+
+    counts = {aggregation.name: {} for aggregation in definition.aggregations}
+    stats = {"batches": len(bounds), "patients": 0, "doses": 0, "max_batch_doses": 0}
+    writer = None
+    dictionaries = {}
+    try:
+        for low, high in bounds:
+            engine.restrict_range(low, high)
+            table, _ = engine.run(extended)
+            wide = table if definition.schema is None else schema_registry.conform(table, definition.schema)
+            if patient_level is not None:
+                if writer is None:
+                    Path(patient_level).parent.mkdir(parents=True, exist_ok=True)
+                    writer = arrow_io.new_file(patient_level, wide.schema, dictionary_deltas=True)
+                writer.write_table(arrow_io.extend_dictionaries(wide, dictionaries), max_chunksize=arrow_io.BATCH_SIZE)
+
+            long = dose_table.wide_to_long(wide)
+            for aggregation in definition.aggregations:
+                patients = patient_columns(aggregation, table, long) if long.num_rows else {}
+                count_batch(counts[aggregation.name], aggregation, long, patients)
+            stats["patients"] += table.num_rows
+            stats["doses"] += long.num_rows
+            stats["max_batch_doses"] = max(stats["max_batch_doses"], long.num_rows)
+    finally:
+        engine.restrict_range()
+        if writer is not None:
+            writer.close()
+    return counts, stats
+
+
+def write_aggregation(counts, aggregation, path):
+    # one row per combination of levels with any doses, in order of the levels with NA last
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(aggregation.by + ["n"])
+        for key in sorted(counts, key=lambda key: tuple((value is None, "" if value is None else value) for value in key)):
+            n = int(dose_qa.ceiling_any(round(counts[key]), aggregation.rounding))
+            writer.writerow([MISSING if value is None else value for value in key] + [n])
+    return path
+
+
+def main(argv=None):
+    import local_definitions
+
+    parser = argparse.ArgumentParser(description="Run a definition's aggregations over patient batches")
+    parser.add_argument("--definition", choices=sorted(local_definitions.DEFINITIONS), default="varying")
+    parser.add_argument("--database", required=True, help="SQLite file; created with dummy data if missing")
+    parser.add_argument("--patients", type=int, default=10000, help="number of dummy patients")
+    parser.add_argument("--sample", type=float, help="run on this fraction of patients (see sampling.py)")
+    parser.add_argument("--seed", type=int, default=hashing.DEFAULT_SEED, help="seed of the sampling hash")
+    parser.add_argument("--workers", type=int, default=1, help="statements to run at once")
+    parser.add_argument("--batches", type=int, default=N_BATCHES, help="number of patient_id ranges")
+    parser.add_argument("--output-dir", default=str(ROOT / "output" / "aggregates"))
+    parser.add_argument("--patient-level", help="also write the patient-level extract here")
+    args = parser.parse_args(argv)
+
+    fresh = not Path(args.database).exists()
+    engine = local_engine.Engine(args.database, workers=args.workers)
+    if fresh:
+        local_engine.create_dummy_database(engine.connection, args.patients, event_codes=local_definitions.event_codes())
+    if args.sample is not None:
+        engine.sample(args.sample, args.seed)
+    definition = local_definitions.DEFINITIONS[args.definition]()
+
+    start = time.perf_counter()
+    try:
+        counts, stats = run_aggregations(engine, definition, args.batches, args.patient_level)
+    finally:
+        engine.close()
+
+    stats["bytes_written"] = 0
+    for aggregation in definition.aggregations:
+        path = write_aggregation(counts[aggregation.name], aggregation, Path(args.output_dir) / f"{aggregation.name}.csv")
+        stats[f"{aggregation.name}_rows"] = len(counts[aggregation.name])
+        stats["bytes_written"] += path.stat().st_size
+        print(f"wrote {path}", file=sys.stderr)
+    if args.patient_level is not None:
+        stats["patient_level_bytes"] = Path(args.patient_level).stat().st_size
+        print(f"wrote {args.patient_level}", file=sys.stderr)
+    stats["total_seconds"] = round(time.perf_counter() - start, 4)
+    print(json.dumps(stats, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
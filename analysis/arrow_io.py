@@ -0,0 +1,272 @@
+##########################
+# compression of the arrow / parquet files written by the python actions
+##########################
+
+# This script:
+# holds one compression setting for every arrow (IPC) and parquet file the python
+# actions write: "none", "lz4" or "zstd", optionally with a level ("zstd:3"). The setting
+# comes from the ARROW_COMPRESSION environment variable, or DEFAULT_COMPRESSION; a writer
+# can also be given one explicitly.
+#  - arrow files are written in record batches of BATCH_SIZE rows, each compressed
+#    separately, with the setting recorded in the schema metadata (`compression`, see
+#    `file_compression()`)
+#  - `read_table()` decompresses the record batches of a file on several threads (each
+#    with its own reader over a shared memory map); uncompressed files are memory-mapped
+#    without copying, as before
+#  - parquet files use the same codec and level (see parquet_store.py)
+# Any arrow reader (pyarrow, R's arrow::read_feather) reads lz4 and zstd files unchanged.
+#
+# `benchmark` writes an extract_varying-like table with each codec, and the current csv.gz,
+# and reports the size and the read throughput with one and with all threads. Each column
+# is drawn independently from that column of the dd4d dummy data, so its values have
+# realistic distributions but whole rows are never repeated (which would flatter csv.gz);
+# a column has no more distinct values than the dummy data, and values that go together
+# in real rows (a dose's date, product and region) don't, so the ratios are indicative.
+#
+# usage:
+#   ARROW_COMPRESSION=zstd:3 python analysis/<action>.py ...
+#   python analysis/arrow_io.py benchmark [--rows 2000000] [--input lib/dummydata/dummyinput_varying.arrow]
+#   # -> output/benchmarks/compression.csv
+
+import argparse
+import concurrent.futures
+import csv
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+COMPRESSION_ENV = "ARROW_COMPRESSION"
+CODECS = ("none", "lz4", "zstd")
+DEFAULT_COMPRESSION = "zstd:1"
+COMPRESSION_KEY = b"compression"
+BATCH_SIZE = 65_536
+
+
+## setting ----
+
+def parse(setting):
+    # "zstd:3" -> ("zstd", 3); "lz4" -> ("lz4", None)
+    codec, _, level = str(setting).partition(":")
+    codec = codec.lower() or "none"
+    if codec == "uncompressed":
+        codec = "none"
+    if codec not in CODECS:
+        raise ValueError(f"compression must be one of {', '.join(CODECS)}, optionally with a level (eg zstd:3)")
+    if codec == "none" and level:
+        raise ValueError("no level can be given without compression")
+    return codec, int(level) if level else None
+
+
+def compression(setting=None):
+    # the setting to use: the given one, else the environment's, else the default
+    if setting is None:
+        setting = os.environ.get(COMPRESSION_ENV) or DEFAULT_COMPRESSION
+    codec, level = parse(setting)
+    return codec if level is None else f"{codec}:{level}"
+
+
+def ipc_options(setting=None, dictionary_deltas=False):
+    codec, level = parse(compression(setting))
+    if codec == "none":
+        return pa.ipc.IpcWriteOptions(emit_dictionary_deltas=dictionary_deltas)
+    return pa.ipc.IpcWriteOptions(
+        compression=pa.Codec(codec, level), use_threads=True, emit_dictionary_deltas=dictionary_deltas,
+    )
+
+
+def parquet_options(setting=None):
+    # keyword arguments for pq.write_table
+    codec, level = parse(compression(setting))
+    return {"compression": codec, "compression_level": level}
+
+
+def with_compression(schema, setting=None):
+    metadata = dict(schema.metadata or {})
+    metadata[COMPRESSION_KEY] = compression(setting).encode()
+    return schema.with_metadata(metadata)
+
+
+## writing ----
+
+def new_file(path, schema, setting=None, dictionary_deltas=False):
+    # an arrow file writer with the compression setting; write tables or batches to it.
+    # With dictionary_deltas, a later batch's dictionary may extend an earlier one's
+    options = ipc_options(setting, dictionary_deltas)
+    return pa.ipc.new_file(str(path), with_compression(schema, setting), options=options)
+
+
+def extend_dictionaries(table, dictionaries):
+    # re-encode the dictionary columns of a batch onto the levels of the batches before it,
+    # extended by any new ones, so that each batch only adds to the file's dictionaries
+    columns = []
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_dictionary(column.type):
+            column = column.combine_chunks()
+            levels = column.dictionary.to_pylist()
+            known = dictionaries.setdefault(name, {})
+            for level in levels:
+                known.setdefault(level, len(known))
+            lookup = pa.array([known[level] for level in levels], type=column.type.index_type)
+            column = pa.DictionaryArray.from_arrays(
+                pc.take(lookup, column.indices), pa.array(list(known), type=column.type.value_type),
+            )
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=table.schema)
+
+
+def write_table(table, path, setting=None, batch_size=BATCH_SIZE):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    table = table.replace_schema_metadata(with_compression(table.schema, setting).metadata)
+    with new_file(path, table.schema, setting) as writer:
+        writer.write_table(table, max_chunksize=batch_size)
+    return path
+
+
+## reading ----
+
+def file_compression(path):
+    # the compression setting recorded in an arrow file, or None for files written elsewhere
+    with pa.memory_map(str(path)) as source:
+        metadata = pa.ipc.open_file(source).schema.metadata or {}
+    value = metadata.get(COMPRESSION_KEY)
+    return value.decode() if value is not None else None
+
+
+def read_table(path, columns=None, threads=None):
+    # an arrow file as a table, decompressing record batches on `threads` threads (all
+    # cores by default)
+    path = str(path)
+    reader = pa.ipc.open_file(pa.memory_map(path))
+    if columns is not None:
+        indices = [reader.schema.get_field_index(name) for name in columns]
+        options = pa.ipc.IpcReadOptions(included_fields=indices)
+    else:
+        options = pa.ipc.IpcReadOptions()
+    n = reader.num_record_batches
+    threads = min(threads or os.cpu_count() or 1, max(n, 1))
+    codec = (reader.schema.metadata or {}).get(COMPRESSION_KEY, b"none")
+    if threads == 1 or codec == b"none":
+        return pa.ipc.open_file(pa.memory_map(path), options=options).read_all()
+
+    def read(part):
+        part_reader = pa.ipc.open_file(pa.memory_map(path), options=options)
+        return [part_reader.get_batch(i) for i in range(part, n, threads)]
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        parts = list(executor.map(read, range(threads)))
+    # batches back in file order: batch i was read by thread i % threads
+    batches = [parts[i % threads][i // threads] for i in range(n)]
+    schema = batches[0].schema if batches else reader.schema
+    return pa.Table.from_batches(batches, schema=schema)
+
+
+## benchmark ----
+
+def realistic_varying(path, n_rows, seed=10):
+    # n_rows with each column drawn with replacement from that column of a dummy varying
+    # extract, independently of the others, and new patient ids
+    import pyarrow.feather as feather
+
+    source = feather.read_table(path)
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for name in source.column_names:
+        if name == "patient_id":
+            columns[name] = pa.array(np.arange(1, n_rows + 1), type=source.schema.field(name).type)
+        else:
+            columns[name] = source.column(name).take(pa.array(rng.integers(0, source.num_rows, n_rows)))
+    return pa.table(columns, schema=source.schema)
+
+
+def _timed(function, repeat):
+    # (result, best time)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return result, best
+
+
+def benchmark(table, settings, directory, repeat=3):
+    # [{setting, bytes, ratio, write / read seconds, read MB/s}] for each setting, and csv.gz
+    import pyarrow.csv as pacsv
+
+    rows = []
+    memory = table.nbytes
+    for setting in settings:
+        path = Path(directory) / f"extract_{setting.replace(':', '_')}.arrow"
+        _, write_seconds = _timed(lambda: write_table(table, path, setting), repeat)
+        size = path.stat().st_size
+        read_1, read_1_seconds = _timed(lambda: read_table(path, threads=1), repeat)
+        read_n, read_n_seconds = _timed(lambda: read_table(path), repeat)
+        if not (read_1.equals(table) and read_n.equals(table)):
+            raise AssertionError(f"{setting}: the table read back differs")
+        rows.append((setting, size, write_seconds, read_1_seconds, read_n_seconds))
+
+    # the snapshot extract's current format, for comparison
+    path = Path(directory) / "extract.csv.gz"
+
+    def write_csv():
+        with pa.CompressedOutputStream(str(path), "gzip") as stream:
+            pacsv.write_csv(table, stream)
+
+    _, write_seconds = _timed(write_csv, 1)
+    _, read_seconds = _timed(lambda: pacsv.read_csv(path), 1)
+    rows.append(("csv.gz", path.stat().st_size, write_seconds, read_seconds, read_seconds))
+
+    return [
+        {
+            "compression": setting,
+            "bytes": size,
+            "ratio": round(memory / size, 2),
+            "write_seconds": round(write_seconds, 4),
+            "read_seconds_1_thread": round(read_1, 4),
+            "read_seconds_all_threads": round(read_n, 4),
+            "read_mb_per_second": round(memory / 1e6 / read_n, 1),
+        }
+        for setting, size, write_seconds, read_1, read_n in rows
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Arrow output helpers")
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench = commands.add_parser("benchmark", help="benchmark the compression settings of arrow outputs")
+    bench.add_argument("--input", default=str(ROOT / "lib" / "dummydata" / "dummyinput_varying.arrow"))
+    bench.add_argument("--rows", type=int, default=2_000_000)
+    bench.add_argument("--settings", nargs="+", default=["none", "lz4", "zstd:1", "zstd:3", "zstd:9"])
+    bench.add_argument("--repeat", type=int, default=3, help="best of this many reads / writes")
+    bench.add_argument("--output", default=str(ROOT / "output" / "benchmarks" / "compression.csv"))
+    args = parser.parse_args(argv)
+
+    table = realistic_varying(args.input, args.rows)
+    with tempfile.TemporaryDirectory() as directory:
+        results = benchmark(table, args.settings, directory, args.repeat)
+
+    output = Path(args.output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+    print(f"{args.rows} rows, {table.nbytes / 1e6:.0f} MB in memory, {os.cpu_count()} cores", file=sys.stderr)
+    for row in results:
+        print("\t".join(str(v) for v in row.values()))
+    print(f"wrote {output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
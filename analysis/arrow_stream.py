@@ -0,0 +1,159 @@
+##########################
+# arrow IPC streams between python stages, without intermediate files
+##########################
+
+# This script:
+# lets a producer stage send an extract to a consumer stage as a stream of arrow record
+# batches over a pipe, rather than writing a file that the consumer then reads in full.
+#  - an output or input path of "-" is stdout / stdin; any other path that is a named
+#    pipe (mkfifo) is read or written as a stream too
+#  - the producer writes batch by batch as they are computed; a write blocks while the
+#    pipe's buffer is full, so a slow consumer holds the producer back rather than
+#    batches piling up in memory
+#  - the consumer starts as soon as the first batch arrives; dose_table.read_long()
+#    reshapes each batch to the long dose table as it is read, and
+#    schema_registry.read_extract() reads streams as well as files, so the actions that
+#    read an extract accept `-`
+#  - `tee` also writes the batches to an arrow file (arrow_io.py format), for audit
+# Streams are uncompressed by default, as compressing a local pipe costs more than it saves;
+# the tee file uses the arrow_io.py setting.
+#
+# `local_engine.py --output - [--batches 10]` is a producer; with --batches it runs the
+# definition in patient_id ranges (as resumable_extract.py) and sends each as it finishes.
+#
+# usage:
+#   python analysis/local_engine.py --definition varying --database db.sqlite --output - --batches 10 \
+#       [--tee output/local/extract_varying.arrow] | python analysis/dose_qa.py --input -
+
+import os
+import stat
+import sys
+import time
+from pathlib import Path
+
+import pyarrow as pa
+
+import arrow_io
+
+
+STDIO = "-"
+STREAM_COMPRESSION = "none"
+
+
+def is_stream(path):
+    # "-", or a named pipe
+    if str(path) == STDIO:
+        return True
+    try:
+        return stat.S_ISFIFO(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+## writing ----
+
+class StreamWriter:
+
+    def __init__(self, target, schema, tee=None, setting=STREAM_COMPRESSION):
+        # an arrow IPC stream to stdout ("-") or a named pipe, and optionally the same batches
+        # to an arrow file
+        if str(target) == STDIO:
+            self.sink, self.owns_sink = sys.stdout.buffer, False
+        else:
+            self.sink, self.owns_sink = open(target, "wb"), True
+        self.stream = pa.ipc.new_stream(self.sink, schema, options=arrow_io.ipc_options(setting))
+        self.tee = None
+        if tee is not None:
+            Path(tee).parent.mkdir(parents=True, exist_ok=True)
+            self.tee = arrow_io.new_file(tee, schema, dictionary_deltas=True)
+        self.dictionaries = {}
+        self.stats = {"batches": 0, "rows": 0, "blocked_seconds": 0.0}
+
+    def write_table(self, table, batch_size=arrow_io.BATCH_SIZE):
+        for batch in table.to_batches(max_chunksize=batch_size):
+            # time spent waiting for the consumer to make room in the pipe
+            start = time.perf_counter()
+            self.stream.write_batch(batch)
+            self.sink.flush()
+            self.stats["blocked_seconds"] += time.perf_counter() - start
+            self.stats["batches"] += 1
+            self.stats["rows"] += batch.num_rows
+        if self.tee is not None:
+            self.tee.write_table(arrow_io.extend_dictionaries(table, self.dictionaries), max_chunksize=batch_size)
+
+    def close(self):
+        self.stream.close()
+        self.sink.flush()
+        if self.owns_sink:
+            self.sink.close()
+        if self.tee is not None:
+            self.tee.close()
+        self.stats["blocked_seconds"] = round(self.stats["blocked_seconds"], 4)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def stream_definition(engine, definition, target, n_batches=1, tee=None):
+    # run a definition in patient_id ranges and stream each range's rows as it finishes;
+    # returns stats
+    import resumable_extract
+
+    if n_batches > 1 and definition.schema is None:
+        # without a schema a column's type depends on its values, so could differ between
+        # batches
+        raise ValueError(f"definition {definition.name} has no schema, so can't be streamed in batches")
+    if n_batches > 1:
+        ids = [row[0] for row in engine.query("SELECT patient_id FROM patients")]
+        bounds = resumable_extract.chunk_bounds(ids, n_batches)
+    else:
+        bounds = [(None, None)]
+
+    writer = None
+    start = time.perf_counter()
+    stats = {"definition": definition.name, "ranges": len(bounds), "seconds_to_first_batch": None}
+    try:
+        for low, high in bounds:
+            engine.restrict_range(low, high)
+            table, _ = engine.run(definition)
+            if writer is None:
+                writer = StreamWriter(target, table.schema, tee=tee)
+                stats["seconds_to_first_batch"] = round(time.perf_counter() - start, 4)
+            writer.write_table(table)
+    finally:
+        engine.restrict_range()
+        if writer is not None:
+            writer.close()
+    stats.update(writer.stats)
+    stats["total_seconds"] = round(time.perf_counter() - start, 4)
+    return stats
+
+
+## reading ----
+
+def _source(path):
+    return sys.stdin.buffer if str(path) == STDIO else open(path, "rb")
+
+
+def read_batches(path):
+    # the record batches of a stream, as they arrive
+    source = _source(path)
+    try:
+        yield from pa.ipc.open_stream(source)
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+
+
+def read_table(path):
+    # a whole stream as a table, with one dictionary per column
+    source = _source(path)
+    try:
+        table = pa.ipc.open_stream(source).read_all()
+    finally:
+        if source is not sys.stdin.buffer:
+            source.close()
+    return table.unify_dictionaries()
@@ -0,0 +1,337 @@
+##########################
+# compressed bitmap index of subgroups, for cross-tabulated counts
+##########################
+
+# This script:
+# builds, for every level of every categorical column of a table (sex, ethnicity, imd,
+# bmi, asthma, ckd/rrt, agegroup_*, ...), a compressed bitmap of the rows at that level.
+# Counts for any combination of levels are then intersections and popcounts of bitmaps,
+# without subsetting or copying the data (as `subset()` / `group_by()` do in
+# snapshot_report.R).
+#
+# Bitmaps use the layout of roaring bitmaps: row ids are split into chunks of 65536
+# rows, and each chunk is stored as whichever is smaller of
+#  - a sorted array of the row ids' low 16 bits (up to 4096 rows), or
+#  - a 65536-bit bitset (1024 x uint64 words).
+# Intersections of two bitsets are word-wise ANDs, of two arrays sorted merges, and of
+# an array with a bitset bit lookups; popcounts of bitsets use `np.bitwise_count` (numpy
+# 2), or a 256-entry table of byte popcounts with older numpy.
+#
+# The input is the processed snapshot that snapshot_report.R summarises (written by
+# snapshot_process.R as arrow alongside the rds), so the counts are of the same
+# patients (those with follow-up) and the same factor levels (from define_vars.R).
+# Missing values are counted as a level of their own, "Missing".
+#
+# usage:
+#   python analysis/bitmap_index.py [--input output/snapshot/processed_snapshot.arrow] [--within agegroup_medium]
+#   # -> counts of each covariate level by number of doses, within each age group
+
+import argparse
+import csv
+import sys
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import arrow_io
+import dose_qa
+import schema_registry
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+# chunks with more rows than this are stored as bitsets
+ARRAY_MAX = 4096
+WORDS = CHUNK_SIZE // 64
+
+# columns with more distinct values than this aren't treated as categorical
+MAX_LEVELS = 64
+
+# level of the rows where a column is missing
+MISSING = "Missing"
+
+# number of set bits in each byte value, for numpy without np.bitwise_count
+BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+## containers ----
+
+def _popcount_table(words):
+    # number of set bits in an array of uint64 words, one byte at a time
+    return int(BYTE_POPCOUNT[words.view(np.uint8)].sum(dtype=np.int64))
+
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(words):
+        return int(np.bitwise_count(words).sum())
+else:
+    _popcount = _popcount_table
+
+
+def _bitset(low):
+    # sorted uint16 row ids -> 1024 x uint64 bitset
+    bits = np.zeros(CHUNK_SIZE, dtype=bool)
+    bits[low] = True
+    return np.packbits(bits, bitorder="little").view(np.uint64)
+
+
+def _bitset_rows(words):
+    # 1024 x uint64 bitset -> sorted uint16 row ids
+    bits = np.unpackbits(words.view(np.uint8), bitorder="little")
+    return np.flatnonzero(bits).astype(np.uint16)
+
+
+def _container(low):
+    # smallest representation of a chunk's sorted low row ids
+    if len(low) > ARRAY_MAX:
+        return _bitset(low)
+    return low.astype(np.uint16)
+
+
+def _is_bitset(container):
+    return container.dtype == np.uint64
+
+
+def _cardinality(container):
+    if _is_bitset(container):
+        return _popcount(container)
+    return len(container)
+
+
+def _and(a, b, compact=True):
+    # intersection of two containers, or None if empty; with compact=False, the
+    # intersection of two bitsets is left as a bitset (cheaper when only counting)
+    if _is_bitset(a) and _is_bitset(b):
+        words = a & b
+        if not compact:
+            return words
+        n = _popcount(words)
+        if n == 0:
+            return None
+        return words if n > ARRAY_MAX else _bitset_rows(words)
+    if _is_bitset(a):
+        a, b = b, a
+    if _is_bitset(b):
+        low = a[((b[a >> 6] >> (a & 63).astype(np.uint64)) & np.uint64(1)).astype(bool)]
+    else:
+        low = np.intersect1d(a, b, assume_unique=True)
+    return low if len(low) else None
+
+
+def _or(a, b):
+    if _is_bitset(a) or _is_bitset(b):
+        words = (a if _is_bitset(a) else _bitset(a)) | (b if _is_bitset(b) else _bitset(b))
+        return words if _popcount(words) > ARRAY_MAX else _bitset_rows(words)
+    return _container(np.union1d(a, b))
+
+
+## bitmaps ----
+
+class Bitmap:
+
+    def __init__(self, containers=None):
+        # chunk number -> container
+        self.containers = containers or {}
+
+    @classmethod
+    def from_rows(cls, rows):
+        # from sorted, unique row ids
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return cls()
+        high = rows >> CHUNK_BITS
+        bounds = np.flatnonzero(np.diff(high)) + 1
+        containers = {}
+        for chunk in np.split(rows, bounds):
+            containers[int(chunk[0] >> CHUNK_BITS)] = _container((chunk & (CHUNK_SIZE - 1)).astype(np.uint16))
+        return cls(containers)
+
+    def rows(self):
+        pieces = []
+        for key in sorted(self.containers):
+            container = self.containers[key]
+            low = _bitset_rows(container) if _is_bitset(container) else container
+            pieces.append((key << CHUNK_BITS) + low.astype(np.int64))
+        return np.concatenate(pieces) if pieces else np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return sum(_cardinality(c) for c in self.containers.values())
+
+    def __and__(self, other):
+        containers = {}
+        for key in self.containers.keys() & other.containers.keys():
+            container = _and(self.containers[key], other.containers[key])
+            if container is not None:
+                containers[key] = container
+        return Bitmap(containers)
+
+    def __or__(self, other):
+        containers = dict(self.containers)
+        for key, container in other.containers.items():
+            containers[key] = _or(containers[key], container) if key in containers else container
+        return Bitmap(containers)
+
+    @property
+    def nbytes(self):
+        return sum(c.nbytes for c in self.containers.values())
+
+
+def intersection_count(bitmaps):
+    # popcount of the intersection of several bitmaps, chunk by chunk
+    bitmaps = sorted(bitmaps, key=lambda b: len(b.containers))
+    if not bitmaps:
+        return 0
+    total = 0
+    for key, container in bitmaps[0].containers.items():
+        for other in bitmaps[1:]:
+            if key not in other.containers:
+                container = None
+                break
+            container = _and(container, other.containers[key], compact=False)
+            if container is None:
+                break
+        if container is not None:
+            total += _cardinality(container)
+    return total
+
+
+## subgroup index ----
+
+def factorize(column):
+    # column -> (codes, levels), with missing values as a last level, MISSING (if there
+    # are any); None if it isn't categorical
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if pa.types.is_temporal(column.type):
+        return None
+    if not pa.types.is_dictionary(column.type) and pc.count_distinct(column).as_py() > MAX_LEVELS:
+        return None
+    if pa.types.is_integer(column.type) or pa.types.is_floating(column.type):
+        # numeric codes, eg imd quintile or asthma category
+        column = column.cast(pa.string())
+    if not pa.types.is_dictionary(column.type):
+        column = column.dictionary_encode()
+    dictionary = column.dictionary.to_pylist()
+    if len(dictionary) > MAX_LEVELS:
+        return None
+    levels = [level for level in dictionary if level is not None]
+    # dictionary entry -> code, with nulls (in the values or the dictionary) as the last code
+    lookup = np.array([levels.index(level) if level is not None else len(levels) for level in dictionary] + [len(levels)])
+    codes = lookup[column.indices.fill_null(len(dictionary)).to_numpy(zero_copy_only=False).astype(np.int64)]
+    if (codes == len(levels)).any():
+        levels.append(MISSING)
+    return codes, levels
+
+
+class SubgroupIndex:
+
+    def __init__(self, n_rows):
+        self.n_rows = n_rows
+        # column -> {level: Bitmap}
+        self.bitmaps = {}
+
+    @classmethod
+    def from_table(cls, table, columns=None):
+        index = cls(table.num_rows)
+        columns = columns or [c for c in table.column_names if c != schema_registry.SAMPLE_WEIGHT]
+        for name in columns:
+            index.add(name, table.column(name))
+        return index
+
+    def add(self, name, values):
+        # index a column (arrow array or numpy codes); non-categorical columns are skipped
+        if isinstance(values, np.ndarray):
+            values = pa.array(values)
+        factorized = factorize(values)
+        if factorized is None:
+            return False
+        codes, levels = factorized
+        # rows grouped by level with one stable sort, so each level's rows stay sorted
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(len(levels) + 1))
+        self.bitmaps[name] = {
+            level: Bitmap.from_rows(order[bounds[k]:bounds[k + 1]])
+            for k, level in enumerate(levels)
+        }
+        return True
+
+    @property
+    def columns(self):
+        return list(self.bitmaps)
+
+    def levels(self, name):
+        return list(self.bitmaps[name])
+
+    def bitmap(self, name, level):
+        # rows at a level, or at any of a list of levels
+        if isinstance(level, (list, tuple, set)):
+            result = Bitmap()
+            for one in level:
+                result = result | self.bitmaps[name].get(one, Bitmap())
+            return result
+        return self.bitmaps[name].get(level, Bitmap())
+
+    def count(self, **conditions):
+        # number of rows matching every column=level condition
+        if not conditions:
+            return self.n_rows
+        return intersection_count([self.bitmap(name, level) for name, level in conditions.items()])
+
+    def crosstab(self, rows, columns, within=None):
+        # {(row level, column level): count}, optionally within column=level conditions
+        within = [self.bitmap(name, level) for name, level in (within or {}).items()]
+        return {
+            (r, c): intersection_count([self.bitmaps[rows][r], self.bitmaps[columns][c]] + within)
+            for r in self.bitmaps[rows]
+            for c in self.bitmaps[columns]
+        }
+
+    @property
+    def nbytes(self):
+        return sum(b.nbytes for levels in self.bitmaps.values() for b in levels.values())
+
+
+## snapshot summary ----
+
+def n_vax_groups(n_vax, top=5):
+    # processed n_vax (number of doses on or before the snapshot date, see define_vars.R)
+    # grouped as in snapshot_report.R, with `top` or more as "5plus"
+    if isinstance(n_vax, pa.ChunkedArray):
+        n_vax = n_vax.combine_chunks()
+    n = n_vax.cast(pa.string()).cast(pa.int64()).fill_null(0).to_numpy(zero_copy_only=False)
+    labels = [str(k) for k in range(top)] + [f"{top}plus"]
+    return pa.DictionaryArray.from_arrays(pa.array(np.minimum(n, top), type=pa.int32()), pa.array(labels))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Counts of covariate levels by number of doses, from a bitmap index")
+    parser.add_argument("--input", default=str(ROOT / "output" / "snapshot" / "processed_snapshot.arrow"))
+    parser.add_argument("--within", default="agegroup_medium", help="stratify every table by this column")
+    parser.add_argument("--rounding", type=int, default=6, help="round counts with roundmid_any(x, rounding)")
+    parser.add_argument("--output", default=str(ROOT / "output" / "snapshot_report" / "bitmap_counts.csv"))
+    args = parser.parse_args(argv)
+
+    table = arrow_io.read_table(args.input)
+    index = SubgroupIndex.from_table(table, [c for c in table.column_names if c not in ("patient_id", "n_vax")])
+    index.add("n_vax", n_vax_groups(table.column("n_vax")))
+
+    covariates = [c for c in index.columns if c not in ("n_vax", args.within)]
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([args.within, "covariate", "level", "n_vax", "n"])
+        for stratum in index.levels(args.within):
+            for covariate in covariates:
+                counts = index.crosstab(covariate, "n_vax", within={args.within: stratum})
+                for (level, n_vax), n in counts.items():
+                    writer.writerow([stratum, covariate, level, n_vax, int(dose_qa.roundmid_any(n, args.rounding))])
+    print(f"wrote {args.output} ({index.nbytes} bytes of bitmaps for {table.num_rows} rows)", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+##########################
+# vaccination campaign of every dose
+##########################
+
+# This script:
+# labels every dose in the long vaccination table (see dose_table.py) with the campaign
+# it was given in, from a table of campaign windows and eligibility rules (CAMPAIGNS):
+#  - campaign:          the campaign whose window contains the vaccination date, or
+#                       "none" for doses between windows
+#  - campaign_eligible: whether the patient met the campaign's rules at that dose (age
+#                       at vaccination, and the dose number range)
+#  - campaign_dose:     1 for the patient's first dose in the campaign, 2 for the second, ...
+#  - course:            "primary" for the first PRIMARY_DOSES doses, else "booster"
+#
+# Window starts and ends form one sorted list of boundaries, so each dose's window is a
+# single `searchsorted`; the rules of each window are looked up by window number and
+# compared with the dose's age and number as whole-array masks. The table is processed
+# in batches of patients, so the cost is one pass over the doses.
+#
+# Eligibility here is by age and dose number only: the clinical risk groups that were also
+# eligible for most campaigns are not in the extract.
+#
+# usage:
+#   python analysis/campaigns.py [--clean] [--campaigns campaigns.csv]
+#   # campaigns.csv has the columns of CAMPAIGNS: campaign,start,end,min_age,min_dose,max_dose
+
+import argparse
+import csv
+import sys
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+import arrow_io
+import dose_qa
+import dose_table
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# national programme windows; min_dose / max_dose are the dose numbers (1 = first dose)
+# a campaign offered, and min_age the age at vaccination
+CAMPAIGNS = [
+    {"campaign": "primary", "start": "2020-12-08", "end": "2021-09-15", "min_age": 12, "min_dose": 1, "max_dose": 2},
+    {"campaign": "autumn2021", "start": "2021-09-16", "end": "2022-03-20", "min_age": 16, "min_dose": 3, "max_dose": 3},
+    {"campaign": "spring2022", "start": "2022-03-21", "end": "2022-08-31", "min_age": 75, "min_dose": 3, "max_dose": 4},
+    {"campaign": "autumn2022", "start": "2022-09-01", "end": "2023-02-12", "min_age": 50, "min_dose": 3, "max_dose": 5},
+    {"campaign": "spring2023", "start": "2023-04-03", "end": "2023-06-30", "min_age": 75, "min_dose": 3, "max_dose": 6},
+    {"campaign": "autumn2023", "start": "2023-09-11", "end": "2024-01-31", "min_age": 65, "min_dose": 3, "max_dose": 7},
+]
+
+NONE = "none"
+PRIMARY_DOSES = 2
+COURSES = ["primary", "booster"]
+
+
+def read_campaigns(path):
+    with open(path, newline="") as f:
+        return [
+            {**row, **{key: int(row[key]) for key in ("min_age", "min_dose", "max_dose")}}
+            for row in csv.DictReader(f)
+        ]
+
+
+class Windows:
+    # campaign windows as sorted boundaries: interval 2c is campaign c, and odd intervals
+    # (and anything before the first window or after the last) are between campaigns
+
+    def __init__(self, campaigns=CAMPAIGNS):
+        campaigns = sorted(campaigns, key=lambda c: c["start"])
+        starts = np.array([dose_table.day(c["start"]) for c in campaigns], dtype=np.int64)
+        ends = np.array([dose_table.day(c["end"]) for c in campaigns], dtype=np.int64) + 1
+        if np.any(ends <= starts) or np.any(starts[1:] < ends[:-1]):
+            raise ValueError("campaign windows must be non-empty and must not overlap")
+        self.names = [c["campaign"] for c in campaigns]
+        self.boundaries = np.column_stack([starts, ends]).ravel()
+        # rules by campaign code, with a final entry for "none" that nobody is eligible for
+        self.min_age = np.array([c["min_age"] for c in campaigns] + [np.iinfo(np.int32).max])
+        self.min_dose = np.array([c["min_dose"] for c in campaigns] + [np.iinfo(np.int32).max])
+        self.max_dose = np.array([c["max_dose"] for c in campaigns] + [-1])
+
+    @property
+    def levels(self):
+        return self.names + [NONE]
+
+    def code(self, days):
+        # campaign code of each date; len(names) for "none"
+        interval = np.searchsorted(self.boundaries, days, side="right") - 1
+        inside = (interval >= 0) & (interval % 2 == 0)
+        return np.where(inside, interval // 2, len(self.names))
+
+
+def dose_numbers(starts):
+    # 1, 2, ... within each segment of a sorted table, given the segment start mask
+    position = np.arange(len(starts))
+    return position - np.maximum.accumulate(np.where(starts, position, 0)) + 1
+
+
+def assign(patient_id, days, age, windows):
+    # campaign columns for doses sorted by patient_id and date
+    starts = dose_table.patient_starts(patient_id)
+    dose = dose_numbers(starts)
+    code = windows.code(days)
+
+    eligible = (
+        (age >= windows.min_age[code])
+        & (dose >= windows.min_dose[code])
+        & (dose <= windows.max_dose[code])
+    )
+
+    # within a patient, dates (and so window intervals) are ordered, so doses of the same
+    # campaign are consecutive rows
+    new_campaign = starts.copy()
+    new_campaign[1:] |= code[1:] != code[:-1]
+    campaign_dose = dose_numbers(new_campaign)
+
+    return {
+        "campaign": pa.DictionaryArray.from_arrays(pa.array(code.astype(np.int8)), pa.array(windows.levels)),
+        "campaign_eligible": pa.array(eligible),
+        "campaign_dose": pa.array(campaign_dose.astype(np.int16)),
+        "course": pa.DictionaryArray.from_arrays(pa.array((dose > PRIMARY_DOSES).astype(np.int8)), pa.array(COURSES)),
+    }
+
+
+def patient_batches(patient_id, batch_size):
+    # (start, stop) row ranges of about batch_size rows that don't split a patient
+    n = len(patient_id)
+    start = 0
+    while start < n:
+        stop = min(start + batch_size, n)
+        if stop < n:
+            # extend to the end of the patient at the boundary
+            stop = int(np.searchsorted(patient_id, patient_id[stop - 1], side="right"))
+        yield start, stop
+        start = stop
+
+
+def assign_batches(long, windows, batch_size=10_000_000):
+    # the long table with the campaign columns, batch by batch
+    patient_id = long.column("patient_id").to_numpy()
+    days = dose_table.to_days(long.column("vax_date")).astype(np.int64)
+    # missing age is never eligible
+    age = long.column("age").combine_chunks().cast(pa.float64()).fill_null(-1).to_numpy(zero_copy_only=False)
+    # without doses (eg all dropped by --clean), one empty batch, so that the output still
+    # has its columns
+    for start, stop in list(patient_batches(patient_id, batch_size)) or [(0, 0)]:
+        columns = assign(patient_id[start:stop], days[start:stop], age[start:stop], windows)
+        batch = long.slice(start, stop - start)
+        for name, values in columns.items():
+            batch = batch.append_column(name, values)
+        yield batch
+
+
+def count_campaigns(counts, batch, windows):
+    # add the batch's doses by (campaign, course, eligible) to counts, weighted by
+    # sample_weight in sampled extracts
+    code = batch.column("campaign").combine_chunks().indices.to_numpy(zero_copy_only=False).astype(np.int64)
+    course = batch.column("course").combine_chunks().indices.to_numpy(zero_copy_only=False).astype(np.int64)
+    eligible = batch.column("campaign_eligible").to_numpy().astype(np.int64)
+    weights = dose_qa.sample_weights(batch)
+    counts += np.bincount(
+        (code * 2 + course) * 2 + eligible, weights=weights, minlength=counts.size,
+    ).reshape(counts.shape)
+
+
+def write_counts(counts, windows, path, rounding=6):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["campaign", "course", "eligible", "n_doses"])
+        for c, campaign in enumerate(windows.levels):
+            for k, course in enumerate(COURSES):
+                for eligible in (True, False):
+                    writer.writerow([campaign, course, eligible, int(dose_qa.roundmid_any(round(counts[c, k, int(eligible)]), rounding))])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Label doses with their vaccination campaign")
+    parser.add_argument("--input", default=str(ROOT / "output" / "extracts" / "extract_varying.arrow"))
+    parser.add_argument("--campaigns", help="csv of campaign windows and rules, instead of CAMPAIGNS")
+    parser.add_argument("--clean", action="store_true", help="keep only the doses process.R keeps in data_vax_clean")
+    parser.add_argument("--batch-size", type=int, default=10_000_000, help="doses per batch")
+    parser.add_argument("--rounding", type=int, default=6, help="round counts with roundmid_any(x, rounding)")
+    parser.add_argument("--output-dir", default=str(ROOT / "output" / "campaigns"))
+    args = parser.parse_args(argv)
+
+    windows = Windows(read_campaigns(args.campaigns) if args.campaigns else CAMPAIGNS)
+    long = dose_table.read_long(args.input)
+    if args.clean:
+        long = long.filter(pa.array(dose_qa.clean_mask(long)))
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    counts = np.zeros((len(windows.levels), len(COURSES), 2))
+    writer = None
+    for batch in assign_batches(long, windows, args.batch_size):
+        if writer is None:
+            writer = arrow_io.new_file(output_dir / "dose_campaigns.arrow", batch.schema)
+        writer.write_table(batch)
+        count_campaigns(counts, batch, windows)
+    writer.close()
+
+    write_counts(counts, windows, output_dir / "campaign_counts.csv", rounding=args.rounding)
+    print(f"wrote {output_dir}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
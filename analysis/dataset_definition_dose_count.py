@@ -0,0 +1,34 @@
+##########################
+# count vaccination dates per patient, to decide how many dose slots to extract
+##########################
+
+from ehrql import Dataset
+from ehrql.tables.beta.tpp import vaccinations
+
+# column names are declared in schema_registry.py
+from schema_registry import dose_count as dose_count_schema
+
+
+
+covid_vaccinations = (
+  vaccinations
+  .where(vaccinations.target_disease.is_in(["SARS-2 CORONAVIRUS"]))
+)
+
+
+
+# initialise dataset
+dataset = Dataset()
+
+# same population as the varying extract
+dataset.define_population(covid_vaccinations.exists_for_patient())
+
+variables = dict(
+    # each slot of the varying extract takes the first vaccination strictly after the
+    # previous slot's date, so the number of non-empty slots is the number of distinct dates
+    n_doses = covid_vaccinations.date.count_distinct_for_patient(),
+)
+dose_count_schema.check_variables(["patient_id", *variables])
+
+for name, variable in variables.items():
+    setattr(dataset, name, variable)
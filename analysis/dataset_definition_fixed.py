@@ -8,6 +8,9 @@
 from ehrql import Dataset
 from ehrql.tables.beta.tpp import patients, clinical_events, practice_registrations, vaccinations, ons_deaths
 
+# column names are declared in schema_registry.py
+from schema_registry import fixed as fixed_schema
+
 
 index_date = "2023-09-01"
 
@@ -19,12 +22,15 @@ dataset = Dataset()
 # define dataset poppulation
 dataset.define_population(registered_patients.exists_for_patient())
 
-dataset.sex = patients.sex
-dataset.age = patients.age_on(index_date)
-
-dataset.registered = registered_patients.exists_for_patient()
-dataset.region = registered_patients.practice_nuts1_region_name
-dataset.stp = registered_patients.practice_stp
-dataset.death_date = ons_deaths.sort_by(ons_deaths.date).first_for_patient().date
-
-
+variables = dict(
+    sex = patients.sex,
+    age = patients.age_on(index_date),
+    registered = registered_patients.exists_for_patient(),
+    region = registered_patients.practice_nuts1_region_name,
+    stp = registered_patients.practice_stp,
+    death_date = ons_deaths.sort_by(ons_deaths.date).first_for_patient().date,
+)
+fixed_schema.check_variables(["patient_id", *variables])
+
+for name, variable in variables.items():
+    setattr(dataset, name, variable)
@@ -6,6 +6,11 @@
 from ehrql import Dataset
 from ehrql.tables.beta.tpp import patients, medications, clinical_events, practice_registrations, vaccinations
 
+# column names are declared in schema_registry.py; the number of vaccination slots is
+# chosen from the recorded dose counts by dose_slots.py
+from schema_registry import varying as varying_schema, slot_count
+
+n_slots = slot_count(varying_schema)
 
 
 
@@ -27,18 +32,23 @@ dataset.define_population(covid_vaccinations.exists_for_patient())
 # Arbitrary date guaranteed to be before any events of interest
 previous_vax_date = "1899-01-01"
 
-for i in range(1, 10+1):
+for i in range(1, n_slots+1):
 
     current_vax = covid_vaccinations.where(covid_vaccinations.date>previous_vax_date).first_for_patient()
     registration = practice_registrations.for_patient_on(current_vax.date)
 
-    setattr(dataset, f"covid_vax_{i}_date", current_vax.date)
-    setattr(dataset, f"covid_vax_type_{i}", current_vax.product_name)
-    setattr(dataset, f"age_{i}", patients.age_on(current_vax.date))
-    setattr(dataset, f"registered_{i}", registration.exists_for_patient())
-    setattr(dataset, f"deregistered_{i}_date", registration.end_date)
-    setattr(dataset, f"region_{i}", registration.practice_nuts1_region_name)
-    setattr(dataset, f"stp_{i}", registration.practice_stp)
+    slot_variables = {
+        "covid_vax_{i}_date": current_vax.date,
+        "covid_vax_type_{i}": current_vax.product_name,
+        "age_{i}": patients.age_on(current_vax.date),
+        "registered_{i}": registration.exists_for_patient(),
+        "deregistered_{i}_date": registration.end_date,
+        "region_{i}": registration.practice_nuts1_region_name,
+        "stp_{i}": registration.practice_stp,
+    }
+    varying_schema.check_variables(slot_variables, repeated=True)
 
-    previous_vax_date = current_vax.date
+    for pattern, variable in slot_variables.items():
+        setattr(dataset, varying_schema.slot_name(pattern, i), variable)
 
+    previous_vax_date = current_vax.date
@@ -0,0 +1,230 @@
+##########################
+# cumulative vaccine coverage curves by subgroup
+##########################
+
+# This script:
+# computes, for every week and every k = 1, 2, ..., the proportion of the population
+# (from the fixed extract) that has received at least k doses, overall and within
+# region, ageband and product (the product of the k-th dose), in a single pass over the
+# long vaccination table (see dose_table.py).
+#
+# Every dose and death becomes a +1 / -1 event in a (subgroup, k, week) grid,
+# accumulated with one bincount and a cumulative sum over weeks:
+#  - the k-th dose of a patient adds one to the numerator of (their subgroups, k) from
+#    the week of the dose
+#  - death (death_date) removes the patient from the denominator, and from the
+#    numerators they were counted in, from the week after
+# There is no censoring on deregistration: the population is everyone registered on
+# 2023-09-01 (dataset_definition_fixed.py), so nobody in it has left their practice by
+# the end of the curves. Patients who moved practice earlier are counted throughout.
+# If the population has a `sample_weight` column, patients are weighted by it.
+#
+# usage:
+#   python analysis/dose_coverage.py [--max-dose 5] [--clean]
+
+import argparse
+import csv
+import sys
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+import dose_qa
+import dose_table
+import schema_registry
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+START_DATE = "2020-12-07"
+END_DATE = "2023-09-01"
+
+# as in process.R
+AGEBAND_BREAKS = [18, 40, 55, 65, 75]
+AGEBAND_LABELS = ["under 18", "18-39", "40-54", "55-64", "65-74", "75+"]
+REGION_GROUPS = {
+    "East": "East of England",
+    "London": "London",
+    "West Midlands": "Midlands",
+    "East Midlands": "Midlands",
+    "Yorkshire and The Humber": "North East and Yorkshire",
+    "North East": "North East and Yorkshire",
+    "North West": "North West",
+    "South East": "South East",
+    "South West": "South West",
+}
+
+
+def week_starts(start, end):
+    # mondays from the week containing `start` to the week containing `end`, as days since epoch
+    start, end = dose_table.day(start), dose_table.day(end)
+    # 1970-01-01 was a thursday
+    first = start - (start + 3) % 7
+    return np.arange(first, end + 1, 7, dtype=np.int64)
+
+
+def ageband_codes(age):
+    # index into AGEBAND_LABELS, -1 for missing age
+    age = age.combine_chunks() if isinstance(age, pa.ChunkedArray) else age
+    valid = age.is_valid().to_numpy(zero_copy_only=False)
+    codes = np.searchsorted(AGEBAND_BREAKS, age.fill_null(0).to_numpy(zero_copy_only=False), side="right")
+    return np.where(valid, codes, -1)
+
+
+def level_codes(column, mapping=None):
+    # dictionary / string column -> (codes, levels), with -1 for missing or unmapped values
+    column = column.combine_chunks() if isinstance(column, pa.ChunkedArray) else column
+    if not pa.types.is_dictionary(column.type):
+        column = column.dictionary_encode()
+    names = column.dictionary.to_pylist()
+    if mapping is not None:
+        names = [mapping.get(name) for name in names]
+    levels = sorted({name for name in names if name is not None})
+    lookup = np.array([levels.index(name) if name is not None else -1 for name in names] + [-1], dtype=np.int64)
+    indices = column.indices.fill_null(len(names)).to_numpy(zero_copy_only=False)
+    return lookup[indices], levels
+
+
+def coverage_curves(population, long, weeks, max_dose=5):
+    # one row per (group, level, k, week) with the weighted numerator and denominator
+    patient_id = population.column("patient_id").to_numpy()
+    order = np.argsort(patient_id, kind="stable")
+    patient_id = patient_id[order]
+    population = population.take(pa.array(order))
+    n_weeks = len(weeks)
+
+    if "sample_weight" in population.column_names:
+        weight = population.column("sample_weight").to_numpy().astype(np.float64)
+    else:
+        weight = np.ones(len(patient_id))
+
+    # patient-level subgroups: (group name, level names, code per patient)
+    region, region_levels = level_codes(population.column("region"), REGION_GROUPS)
+    patient_groups = [
+        ("all", [""], np.zeros(len(patient_id), dtype=np.int64)),
+        ("region", region_levels, region),
+        ("ageband", AGEBAND_LABELS, ageband_codes(population.column("age"))),
+    ]
+    product_levels = dose_table.VAX_TYPES
+
+    # grid rows: one per (group, level); patient groups first, then products
+    offsets, labels = {}, []
+    for name, levels, _ in patient_groups + [("product", product_levels, None)]:
+        offsets[name] = len(labels)
+        labels.extend((name, level) for level in levels)
+    n_rows = len(labels)
+
+    # doses of patients in the population, with their rank k within the patient
+    dose_patient = long.column("patient_id").to_numpy()
+    p = np.searchsorted(patient_id, dose_patient)
+    inside = p < len(patient_id)
+    inside[inside] = patient_id[p[inside]] == dose_patient[inside]
+    starts = dose_table.patient_starts(dose_patient)
+    rank = np.arange(len(dose_patient)) - np.maximum.accumulate(np.where(starts, np.arange(len(dose_patient)), 0)) + 1
+    days = dose_table.to_days(long.column("vax_date")).astype(np.int64)
+    product = long.column("vax_type").combine_chunks().indices.to_numpy(zero_copy_only=False).astype(np.int64)
+    keep = inside & (rank <= max_dose)
+    p, rank, days, product = p[keep], rank[keep], days[keep], product[keep]
+
+    # censoring: death only (see above)
+    death = population.column("death_date").combine_chunks().cast(pa.int32()).fill_null(np.iinfo(np.int32).max)
+    censor = death.to_numpy(zero_copy_only=False).astype(np.int64)
+    # doses after censoring never count
+    dose_counts = days <= censor[p]
+    p, rank, days, product = p[dose_counts], rank[dose_counts], days[dose_counts], product[dose_counts]
+
+    def week_of(day):
+        # bin of each date: anything before the first week is in the first week, and
+        # anything after the last week is past the end (n_weeks)
+        week = np.clip(np.searchsorted(weeks, day, side="right") - 1, 0, None)
+        return np.where(day >= weeks[-1] + 7, n_weeks, week)
+
+    censored = censor < weeks[-1] + 7
+    censor_week = week_of(censor + 1)
+
+    # numerator events, keyed by (row, k, week); the denominator is stored as k = 0
+    n_k = max_dose + 1
+    keys, weights = [], []
+
+    def add(rows, k, week, w):
+        valid = (rows >= 0) & (week < n_weeks)
+        keys.append(((rows * n_k + k) * n_weeks + week)[valid])
+        weights.append(np.broadcast_to(w, rows.shape)[valid])
+
+    dose_week = week_of(days)
+    for name, _, codes in patient_groups:
+        rows = np.where(codes >= 0, offsets[name] + codes, -1)
+        # everyone is in the denominator from the start, and leaves when censored
+        add(rows, 0, np.zeros(len(rows), dtype=np.int64), weight)
+        add(np.where(censored, rows, -1), 0, censor_week, -weight)
+        add(rows[p], rank, dose_week, weight[p])
+        add(np.where(censored[p], rows[p], -1), rank, censor_week[p], -weight[p])
+    product_rows = offsets["product"] + product
+    add(product_rows, rank, dose_week, weight[p])
+    add(np.where(censored[p], product_rows, -1), rank, censor_week[p], -weight[p])
+
+    grid = np.bincount(
+        np.concatenate(keys), weights=np.concatenate(weights), minlength=n_rows * n_k * n_weeks,
+    ).reshape(n_rows, n_k, n_weeks)
+    grid = np.cumsum(grid, axis=2)
+
+    # products share the overall denominator
+    denominator = grid[:, 0, :].copy()
+    denominator[offsets["product"]:] = grid[offsets["all"], 0, :]
+
+    rows = []
+    for r, (group, level) in enumerate(labels):
+        for k in range(1, max_dose + 1):
+            for w in range(n_weeks):
+                rows.append({
+                    "group": group,
+                    "level": level,
+                    "k": k,
+                    "week": str(dose_table.EPOCH + int(weeks[w])),
+                    "n_vaccinated": grid[r, k, w],
+                    "n_population": denominator[r, w],
+                })
+    return rows
+
+
+def write_curves(rows, path, rounding=6):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["group", "level", "k", "week", "n_vaccinated", "n_population", "coverage"])
+        writer.writeheader()
+        for row in rows:
+            row = dict(row)
+            for key in ("n_vaccinated", "n_population"):
+                row[key] = int(dose_qa.roundmid_any(round(row[key]), rounding))
+            # from the rounded counts, so the proportions don't undo the rounding
+            row["coverage"] = round(row["n_vaccinated"] / row["n_population"], 4) if row["n_population"] else ""
+            writer.writerow(row)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cumulative coverage of at least k doses by week and subgroup")
+    parser.add_argument("--fixed", default=str(ROOT / "output" / "extracts" / "extract_fixed.arrow"))
+    parser.add_argument("--varying", default=str(ROOT / "output" / "extracts" / "extract_varying.arrow"))
+    parser.add_argument("--start", default=START_DATE)
+    parser.add_argument("--end", default=END_DATE)
+    parser.add_argument("--max-dose", type=int, default=5)
+    parser.add_argument("--clean", action="store_true", help="keep only the doses process.R keeps in data_vax_clean")
+    parser.add_argument("--rounding", type=int, default=6, help="round counts with roundmid_any(x, rounding)")
+    parser.add_argument("--output", default=str(ROOT / "output" / "coverage" / "coverage_curves.csv"))
+    args = parser.parse_args(argv)
+
+    population = schema_registry.read_extract(args.fixed, schema_registry.fixed)
+    long = dose_table.read_long(args.varying)
+    if args.clean:
+        long = long.filter(pa.array(dose_qa.clean_mask(long)))
+
+    rows = coverage_curves(population, long, week_starts(args.start, args.end), args.max_dose)
+    write_curves(rows, args.output, rounding=args.rounding)
+    print(f"wrote {args.output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+##########################
+# ragged per-patient vaccination histories
+##########################
+
+# This script:
+# stores each patient's doses as a contiguous run of rows in flat arrays (dates, product,
+# age, region, ...), with one offset per patient marking where their run starts
+# (compressed sparse row layout). Unlike the wide `covid_vax_{i}_*` columns, memory
+# grows with the number of doses actually given rather than patients x slots.
+#
+# The history converts to and from an arrow ListArray of structs, and answers the
+# usual per-patient questions without pivoting:
+#   history.kth(2)                      # date of each patient's second dose
+#   history.last("vax_type")            # product of each patient's latest dose
+#   history.count_before("2023-09-01")  # number of doses before a date
+#   history.interval_to_previous()      # days since the previous dose, per dose
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import arrow_io
+import dose_table
+
+
+# per-dose fields kept by default, besides the date
+DEFAULT_FIELDS = ["vax_type", "age", "region"]
+
+
+class DoseHistory:
+
+    def __init__(self, patient_id, offsets, doses):
+        # patient_id: sorted unique ids, length P
+        # offsets: int64, length P+1, doses of patient p are rows offsets[p]:offsets[p+1]
+        # doses: arrow table of per-dose fields, including vax_date
+        self.patient_id = np.asarray(patient_id)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.doses = doses
+        # dates are never null (doses without a date aren't doses), so keep them as plain days
+        self.days = dose_table.to_days(doses.column("vax_date"))
+
+    ## construction ----
+
+    @classmethod
+    def from_long(cls, long, fields=DEFAULT_FIELDS, patient_id=None):
+        # from a long table sorted by patient_id, vax_date (see dose_table.py);
+        # pass `patient_id` to also keep patients without any doses
+        dose_patient_id = long.column("patient_id").to_numpy()
+        if patient_id is None:
+            patient_id = dose_patient_id[dose_table.patient_starts(dose_patient_id)]
+        patient_id = np.unique(patient_id)
+        offsets = np.searchsorted(dose_patient_id, patient_id, side="left")
+        offsets = np.append(offsets, len(dose_patient_id)).astype(np.int64)
+        doses = long.select(["vax_date"] + [f for f in fields if f != "vax_date"]).combine_chunks()
+        return cls(patient_id, offsets, doses)
+
+    @classmethod
+    def from_wide(cls, table, fields=DEFAULT_FIELDS):
+        patient_id = table.column("patient_id").to_numpy()
+        return cls.from_long(dose_table.wide_to_long(table), fields, patient_id=patient_id)
+
+    @classmethod
+    def from_arrow(cls, table):
+        # from a table of patient_id and a `doses` list<struct> column, as written by to_arrow()
+        doses = table.column("doses").combine_chunks()
+        flat = doses.flatten()
+        offsets = doses.offsets.to_numpy() - doses.offsets[0].as_py()
+        fields = pa.Table.from_arrays(flat.flatten(), names=[f.name for f in flat.type])
+        return cls(table.column("patient_id").to_numpy(), offsets, fields)
+
+    @classmethod
+    def read(cls, path):
+        return cls.from_arrow(arrow_io.read_table(path))
+
+    ## conversion ----
+
+    def to_arrow(self):
+        structs = pa.StructArray.from_arrays(
+            [column.combine_chunks() for column in self.doses.columns], names=self.doses.column_names,
+        )
+        doses = pa.ListArray.from_arrays(pa.array(self.offsets, type=pa.int32()), structs)
+        return pa.table({"patient_id": self.patient_id, "doses": doses})
+
+    def write(self, path, compression=None):
+        arrow_io.write_table(self.to_arrow(), path, compression)
+
+    def to_long(self):
+        vax_index = np.arange(len(self.days)) - np.repeat(self.offsets[:-1], self.counts) + 1
+        columns = {
+            "patient_id": np.repeat(self.patient_id, self.counts),
+            "vax_index": vax_index.astype(np.int16),
+        }
+        columns.update({name: self.doses.column(name) for name in self.doses.column_names})
+        return pa.table(columns)
+
+    ## size ----
+
+    def __len__(self):
+        return len(self.patient_id)
+
+    @property
+    def n_doses(self):
+        return len(self.days)
+
+    @property
+    def counts(self):
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self):
+        return self.patient_id.nbytes + self.offsets.nbytes + self.doses.nbytes
+
+    ## per-patient accessors ----
+
+    def _take(self, rows, valid, field):
+        # value of `field` at flat row `rows` for each patient, null where not valid
+        rows = np.where(valid, rows, 0)
+        if self.n_doses == 0:
+            return pa.nulls(len(rows), self.doses.schema.field(field).type)
+        values = self.doses.column(field).take(pa.array(rows))
+        mask = pa.array(~valid)
+        return pc.if_else(mask, pa.scalar(None, values.type), values)
+
+    def kth(self, k, field="vax_date"):
+        # field of each patient's k-th dose (1-based), null for patients with fewer doses
+        rows = self.offsets[:-1] + (k - 1)
+        return self._take(rows, self.counts >= k, field)
+
+    def last(self, field="vax_date"):
+        return self._take(self.offsets[1:] - 1, self.counts >= 1, field)
+
+    def count_before(self, dates, inclusive=False):
+        # number of doses strictly before (or on, if inclusive) a date, per patient;
+        # `dates` is a single "YYYY-MM-DD" date or an array with one date per patient,
+        # where missing dates count no doses
+        if isinstance(dates, str):
+            query = np.full(len(self), dose_table.day(dates), dtype=np.int64)
+        else:
+            if not isinstance(dates, (pa.Array, pa.ChunkedArray)):
+                dates = pa.array(dates, type=pa.date32())
+            dates = pc.fill_null(dates.cast(pa.date32()), pa.scalar(-(2**30), pa.date32()))
+            query = dose_table.to_days(dates).astype(np.int64)
+
+        # dates are sorted within each patient, so search all patients at once by
+        # offsetting each patient's dates into their own disjoint range
+        lowest = min(self.days.min(initial=0), query.min(initial=0))
+        span = int(max(self.days.max(initial=0), query.max(initial=0)) - lowest + 2)
+        segment = np.repeat(np.arange(len(self), dtype=np.int64), self.counts)
+        keys = segment * span + (self.days - lowest)
+        query_keys = np.arange(len(self), dtype=np.int64) * span + (query - lowest)
+        side = "right" if inclusive else "left"
+        return np.searchsorted(keys, query_keys, side=side) - self.offsets[:-1]
+
+    def interval_to_previous(self):
+        # days since the same patient's previous dose, per dose; null for first doses
+        interval = np.zeros(self.n_doses, dtype=np.int32)
+        interval[1:] = self.days[1:] - self.days[:-1]
+        first = np.zeros(self.n_doses, dtype=bool)
+        first[self.offsets[:-1][self.counts > 0]] = True
+        return pa.array(interval, mask=first)
+
+    def patient(self, patient_id):
+        # doses of a single patient, as a list of dicts
+        p = np.searchsorted(self.patient_id, patient_id)
+        if p == len(self) or self.patient_id[p] != patient_id:
+            return []
+        return self.doses.slice(self.offsets[p], self.offsets[p + 1] - self.offsets[p]).to_pylist()
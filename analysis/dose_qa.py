@@ -0,0 +1,227 @@
+##########################
+# quality checks of recorded vaccination dates
+##########################
+
+# This script:
+# flags doses in the long vaccination table (see dose_table.py) that break the rules
+# applied elsewhere in the pipeline, and counts how many doses and patients each rule
+# affects:
+#  - duplicate:            same date as the patient's previous recorded dose
+#  - within_14_days:       1-13 days after the patient's previous recorded dose
+#                          (the `vax_interval >= 14` filter in process.R)
+#  - before_rollout:       before the start of the national rollout
+#  - after_end_date:       after the end of the study period
+#  - product_out_of_order: an earlier-generation product (eg original monovalent)
+#                          recorded after a later one (eg bivalent BA.4-5)
+#  - any_rule:             at least one of the above
+#
+# These are checks, not process.R's cleaning: data_vax_clean keeps doses from an earlier
+# start_date and doesn't drop products out of order. `clean_mask()` selects the doses
+# process.R keeps, for the actions that count cleaned doses (`--clean`).
+#
+# All checks are computed in one pass over the table sorted by patient and date, using
+# differences between consecutive rows that are masked at patient boundaries.
+#
+# usage:
+#   python analysis/dose_qa.py [--input output/extracts/extract_varying.arrow]
+
+import argparse
+import csv
+import sys
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+import dose_table
+import schema_registry
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+ROLLOUT_DATE = "2020-12-08"
+# `start_date` in process.R
+PROCESS_START_DATE = "2020-06-01"
+# `end_date` in process.R
+END_DATE = "2023-12-31"
+MIN_INTERVAL = 14
+
+# vaccine generation, by short product name; a dose of a lower generation following
+# a dose of a higher generation is flagged as out of order
+PRODUCT_GENERATION = {
+    "pfizer": 0,
+    "az": 0,
+    "moderna": 0,
+    "pfizerchildren": 0,
+    "azhalf": 0,
+    "pfizerBA1": 1,
+    "modernaomicron": 1,
+    "vidprevtyn": 1,
+    "pfizerBA45": 2,
+    "pfizerXBB15": 3,
+    "modernaXBB15": 3,
+}
+
+RULES = ["duplicate", "within_14_days", "before_rollout", "after_end_date", "product_out_of_order", "any_rule"]
+
+
+def roundmid_any(x, to=1):
+    # as in utility.R: round up to a multiple of `to`, centred on the midpoint
+    x = np.asarray(x)
+    return np.ceil(x / to) * to - np.floor(to / 2) * (x != 0)
+
+
+def ceiling_any(x, to=1):
+    # as in utility.R: round up to a multiple of `to`
+    return np.ceil(np.round(np.asarray(x) / to, 8)) * to
+
+
+def flag_doses(long, rollout_date=ROLLOUT_DATE, end_date=END_DATE, min_interval=MIN_INTERVAL):
+    # dict of rule -> boolean mask over the rows of the long table
+    patient_id = long.column("patient_id").to_numpy()
+    days = dose_table.to_days(long.column("vax_date"))
+    starts = dose_table.patient_starts(patient_id)
+    follows = ~starts
+
+    # interval to the previous recorded dose of the same patient
+    interval = np.zeros(len(days), dtype=np.int32)
+    interval[1:] = days[1:] - days[:-1]
+
+    type_codes = long.column("vax_type").combine_chunks().indices.to_numpy(zero_copy_only=False)
+    generation_lookup = np.array(
+        [PRODUCT_GENERATION.get(name, -1) for name in dose_table.VAX_TYPES], dtype=np.int8,
+    )
+    generation = generation_lookup[type_codes]
+    # unknown products don't take part in the ordering check
+    known = generation >= 0
+    # highest generation seen so far within each patient, excluding the current dose
+    running = np.where(known, generation, -1).astype(np.int64)
+    segment_offset = np.cumsum(starts) * 16
+    running_max = np.maximum.accumulate(running + segment_offset) - segment_offset
+    previous_max = np.full(len(days), -1, dtype=np.int64)
+    previous_max[1:] = running_max[:-1]
+    previous_max[starts] = -1
+
+    flags = {
+        "duplicate": follows & (interval == 0),
+        "within_14_days": follows & (interval > 0) & (interval < min_interval),
+        "before_rollout": days < dose_table.day(rollout_date),
+        "after_end_date": days > dose_table.day(end_date),
+        "product_out_of_order": known & (generation < previous_max),
+    }
+    flags["any_rule"] = np.logical_or.reduce(list(flags.values()))
+    return flags
+
+
+def clean_mask(long, start_date=PROCESS_START_DATE, end_date=END_DATE, min_interval=MIN_INTERVAL):
+    # boolean mask of the doses process.R keeps in data_vax_clean: the patient's first
+    # recorded dose or at least min_interval days after their previous one, and between
+    # start_date and end_date
+    patient_id = long.column("patient_id").to_numpy()
+    days = dose_table.to_days(long.column("vax_date"))
+    interval = np.zeros(len(days), dtype=np.int32)
+    interval[1:] = days[1:] - days[:-1]
+    first = dose_table.patient_starts(patient_id)
+    return (first | (interval >= min_interval)) & (days >= dose_table.day(start_date)) & (days <= dose_table.day(end_date))
+
+
+def n_distinct_sorted(values, weights=None):
+    # number of distinct values in a sorted array, or the sum of the weights of the first
+    # occurrence of each
+    if len(values) == 0:
+        return 0
+    if weights is not None:
+        return float(weights[dose_table.patient_starts(values)].sum())
+    return int(1 + np.count_nonzero(values[1:] != values[:-1]))
+
+
+def sample_weights(long):
+    # sample_weight of each dose of a sampled extract (see sampling.py), else None
+    if schema_registry.SAMPLE_WEIGHT not in long.column_names:
+        return None
+    return long.column(schema_registry.SAMPLE_WEIGHT).to_numpy()
+
+
+def count_flags(long, flags, by=None):
+    # per-rule counts of doses and patients, optionally within levels of a long-table column;
+    # weighted by sample_weight in sampled extracts
+    patient_id = long.column("patient_id").to_numpy()
+    n_total = len(patient_id)
+    weights = sample_weights(long)
+    ones = np.ones(n_total) if weights is None else weights
+
+    if by is None:
+        groups = {"all": np.ones(n_total, dtype=bool)}
+    else:
+        column = long.column(by).combine_chunks()
+        if pa.types.is_dictionary(column.type):
+            levels = column.dictionary.to_pylist()
+            codes = column.indices.to_numpy(zero_copy_only=False)
+            groups = {str(level): codes == k for k, level in enumerate(levels)}
+        else:
+            values = column.to_numpy(zero_copy_only=False)
+            groups = {str(level): values == level for level in np.unique(values)}
+
+    rows = []
+    for level, in_group in groups.items():
+        if not in_group.any():
+            continue
+        n_doses = ones[in_group].sum()
+        for rule in RULES:
+            flagged = flags[rule] & in_group
+            rows.append({
+                "group": by or "all",
+                "level": level,
+                "rule": rule,
+                "n_doses": n_doses,
+                "n_flagged": ones[flagged].sum(),
+                "n_patients_flagged": n_distinct_sorted(
+                    patient_id[flagged], None if weights is None else weights[flagged],
+                ),
+            })
+    return rows
+
+
+def write_counts(rows, path, rounding=6):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=[
+            "group", "level", "rule", "n_doses", "n_flagged", "pct_flagged", "n_patients_flagged",
+        ])
+        writer.writeheader()
+        for row in rows:
+            row = dict(row)
+            for key in ("n_doses", "n_flagged", "n_patients_flagged"):
+                row[key] = int(roundmid_any(round(row[key]), rounding))
+            # from the rounded counts, so the percentages don't undo the rounding
+            row["pct_flagged"] = round(100 * row["n_flagged"] / row["n_doses"], 2) if row["n_doses"] else ""
+            writer.writerow(row)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count doses breaking the vaccination date rules")
+    parser.add_argument("--input", default=str(ROOT / "output" / "extracts" / "extract_varying.arrow"))
+    parser.add_argument("--output-dir", default=str(ROOT / "output" / "dose_qa"))
+    parser.add_argument("--rollout-date", default=ROLLOUT_DATE)
+    parser.add_argument("--end-date", default=END_DATE)
+    parser.add_argument("--min-interval", type=int, default=MIN_INTERVAL)
+    parser.add_argument("--by", action="append", default=["vax_index", "vax_type"],
+                        help="also count within levels of this long-table column")
+    parser.add_argument("--rounding", type=int, default=6, help="round counts with roundmid_any(x, rounding)")
+    args = parser.parse_args(argv)
+
+    long = dose_table.read_long(args.input)
+    flags = flag_doses(long, args.rollout_date, args.end_date, args.min_interval)
+
+    rows = count_flags(long, flags)
+    for by in dict.fromkeys(args.by):
+        rows.extend(count_flags(long, flags, by=by))
+    path = Path(args.output_dir) / "dose_qa_counts.csv"
+    write_counts(rows, path, rounding=args.rounding)
+    print(f"wrote {path}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+##########################
+# choose the number of vaccination slots to extract from the recorded dose counts
+##########################
+
+# This script:
+# reads the number of distinct vaccination dates per patient (extract_dose_count) and
+# picks the number of `_{i}` slots the varying and snapshot extracts need: the maximum
+# dose count, or a high quantile of it (eg 0.9999) to avoid extracting near-empty slots
+# for a handful of implausible records, capped at --max-slots (20 by default) so that a
+# single patient with hundreds of records can't blow up the extracts. Every slot costs a
+# chain of queries and a set of columns, so extracting only as many as are ever filled
+# saves both.
+#
+# The counts are distinct vaccination dates, which is exactly what the varying extract's
+# slots take. The snapshot extract only takes a dose at least 14 days after the previous
+# one, so it needs at most as many slots: the number chosen is an upper bound for it.
+#
+# Outputs:
+#  - output/dose_slots/dose_slots.json: the chosen number of slots, read by the dataset
+#    and study definitions through `schema_registry.slot_count()`
+#  - output/dose_slots/dose_slots_truncation.csv: how many patients and doses fall beyond
+#    the last slot (rounded)
+# dose_slots.json also records the number before the cap (`uncapped_n_slots`) and how
+# many patients lose doses only because of it (`n_patients_truncated_by_cap`).
+#
+# With dummy data, extract_varying takes its number of slots from the custom dummy data
+# file instead, so that the extract's columns still match it, and the snapshot keeps its
+# declared default, as its dummy data is generated from the study definition. These are
+# recorded per dataset in dose_slots.json (`dataset_n_slots`), which `slot_count()` reads
+# before the chosen number.
+#
+# usage:
+#   python analysis/dose_slots.py [--quantile 0.9999] [--max-slots 20]
+#   python analysis/dose_slots.py --max-slots 0   # no cap
+
+import argparse
+import csv
+import json
+import math
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+import schema_registry
+from dose_qa import roundmid_any
+from validate_schema import read_schema
+
+
+ROOT = Path(__file__).resolve().parent.parent
+DUMMY_VARYING = ROOT / "lib" / "dummydata" / "dummyinput_varying.arrow"
+
+# at most this many slots unless --max-slots says otherwise
+MAX_SLOTS = 20
+
+
+def choose_slots(n_doses, quantile=1.0, min_slots=1, max_slots=None):
+    # number of slots covering `quantile` of patients' dose counts
+    n_doses = np.asarray(n_doses)
+    if len(n_doses) == 0:
+        n_slots = min_slots
+    else:
+        n_slots = int(math.ceil(np.quantile(n_doses, quantile, method="higher")))
+    n_slots = max(n_slots, min_slots)
+    if max_slots is not None:
+        n_slots = min(n_slots, max_slots)
+    return n_slots
+
+
+def truncation(n_doses, n_slots):
+    # patients and doses that don't fit in `n_slots` slots
+    n_doses = np.asarray(n_doses)
+    beyond = np.clip(n_doses - n_slots, 0, None)
+    return {
+        "n_patients": int(len(n_doses)),
+        "n_doses": int(n_doses.sum()),
+        "n_patients_truncated": int(np.count_nonzero(beyond)),
+        "n_doses_truncated": int(beyond.sum()),
+    }
+
+
+def dummy_data_slots(path=DUMMY_VARYING):
+    # number of slots in the custom dummy data, read from the file's schema only
+    return schema_registry.varying.n_slots_in(list(read_schema(path)))
+
+
+def write_truncation(summary, path, rounding=6):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=[
+            "n_slots", "n_patients", "n_doses", "n_patients_truncated", "n_doses_truncated",
+        ])
+        writer.writeheader()
+        row = {key: summary[key] for key in writer.fieldnames}
+        for key in writer.fieldnames[1:]:
+            row[key] = int(roundmid_any(row[key], rounding))
+        writer.writerow(row)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Choose the number of vaccination slots to extract")
+    parser.add_argument("--input", default=str(ROOT / "output" / "extracts" / "extract_dose_count.arrow"))
+    parser.add_argument("--output-dir", default=str(schema_registry.DOSE_SLOTS_PATH.parent))
+    parser.add_argument("--quantile", type=float, default=1.0,
+                        help="cover this quantile of dose counts; 1 (the default) covers every patient")
+    parser.add_argument("--min-slots", type=int, default=1)
+    parser.add_argument("--max-slots", type=int, default=MAX_SLOTS, help="cap on the number of slots; 0 for none")
+    parser.add_argument("--rounding", type=int, default=6, help="round counts with roundmid_any(x, rounding)")
+    args = parser.parse_args(argv)
+
+    if not 0 < args.quantile <= 1:
+        parser.error("--quantile must be in (0, 1]")
+
+    table = schema_registry.read_extract(args.input, schema_registry.dose_count)
+    n_doses = table.column("n_doses").fill_null(0).to_numpy()
+
+    uncapped = choose_slots(n_doses, args.quantile, args.min_slots)
+    n_slots = choose_slots(n_doses, args.quantile, args.min_slots, args.max_slots or None)
+    capped = n_slots < uncapped
+    source = "max_slots" if capped else "quantile" if args.quantile < 1 else "maximum"
+    # datasets whose number of slots doesn't come from the dose counts
+    dataset_n_slots = {}
+    dummy_data_backend = os.environ.get("OPENSAFELY_BACKEND", "") in ("", "expectations")
+    if dummy_data_backend:
+        if DUMMY_VARYING.exists():
+            dataset_n_slots[schema_registry.varying.name] = dummy_data_slots()
+        dataset_n_slots[schema_registry.snapshot.name] = schema_registry.snapshot.n_slots
+
+    summary = {
+        "n_slots": n_slots,
+        "source": source,
+        "quantile": args.quantile,
+        "max_slots": args.max_slots or None,
+        "uncapped_n_slots": uncapped,
+        "capped": capped,
+        "default_n_slots": schema_registry.varying.n_slots,
+        "dataset_n_slots": dataset_n_slots,
+        **truncation(n_doses, n_slots),
+    }
+    # patients who would have fitted in the uncapped number of slots
+    without_cap = truncation(n_doses, uncapped)["n_patients_truncated"]
+    summary["n_patients_truncated_by_cap"] = summary["n_patients_truncated"] - without_cap
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(output_dir / "dose_slots.json", "w") as f:
+        json.dump(summary, f, indent=2)
+        f.write("\n")
+    write_truncation(summary, output_dir / "dose_slots_truncation.csv", rounding=args.rounding)
+
+    print(f"extracting {n_slots} vaccination slots ({source})", file=sys.stderr)
+    if capped:
+        print(
+            f"warning: capped at --max-slots {args.max_slots} (would be {uncapped}), "
+            f"truncating {summary['n_patients_truncated_by_cap']} more patients",
+            file=sys.stderr,
+        )
+    for name, n in dataset_n_slots.items():
+        print(f"  except {name}: {n} slots (dummy data)", file=sys.stderr)
+    if summary["n_patients_truncated"]:
+        print(
+            "warning: some patients have more vaccination dates than slots; "
+            f"see {output_dir / 'dose_slots_truncation.csv'}",
+            file=sys.stderr,
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+##########################
+# long vaccination table: one row per recorded dose
+##########################
+
+# This script:
+# reshapes the wide varying extract (one set of `_{i}` columns per dose) into a long
+# table with one row per dose, sorted by patient_id and vaccination date, as done by
+# the `pivot_longer` in process.R.
+# Columns of the long table:
+#   patient_id, vax_index, vax_date, vax_type, vax_product, age, registered,
+#   deregistered_date, region, stp
+# where vax_type is the short product name used in the R scripts ("pfizer", "az", ...,
+# "other" for anything not in the lookup) and vax_product is the recorded product name.
+# Sampled extracts (see sampling.py) also carry the patient's sample_weight.
+# An extract without any doses gives a long table with these columns and no rows.
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import schema_registry
+
+
+# varying extract column -> long table column
+LONG_NAMES = {
+    "covid_vax_{i}_date": "vax_date",
+    "covid_vax_type_{i}": "vax_product",
+    "age_{i}": "age",
+    "registered_{i}": "registered",
+    "deregistered_{i}_date": "deregistered_date",
+    "region_{i}": "region",
+    "stp_{i}": "stp",
+}
+
+OTHER_TYPE = "other"
+VAX_TYPES = list(schema_registry.VAX_PRODUCTS) + [OTHER_TYPE]
+
+# days since 1970-01-01, the representation of arrow's date32
+EPOCH = np.datetime64("1970-01-01", "D")
+
+
+def to_days(dates):
+    # date32 array / column -> int32 numpy array of days since epoch (nulls are not allowed)
+    if isinstance(dates, pa.ChunkedArray):
+        dates = dates.combine_chunks()
+    return dates.cast(pa.int32()).to_numpy(zero_copy_only=False)
+
+
+def day(date):
+    # "YYYY-MM-DD" -> days since epoch
+    return int((np.datetime64(date, "D") - EPOCH).astype(int))
+
+
+def product_codes(products):
+    # product names -> indices into VAX_TYPES, with unknown or missing products as "other"
+    lookup = {name: k for k, name in enumerate(schema_registry.VAX_PRODUCTS.values())}
+    if isinstance(products, pa.ChunkedArray):
+        products = products.combine_chunks()
+    if pa.types.is_dictionary(products.type):
+        # map the (small) dictionary once rather than every value
+        dictionary_codes = np.array(
+            [lookup.get(name, len(VAX_TYPES) - 1) for name in products.dictionary.to_pylist()] + [len(VAX_TYPES) - 1],
+            dtype=np.int8,
+        )
+        indices = products.indices.fill_null(len(products.dictionary)).to_numpy(zero_copy_only=False)
+        return dictionary_codes[indices]
+    return np.array([lookup.get(name, len(VAX_TYPES) - 1) for name in products.to_pylist()], dtype=np.int8)
+
+
+def long_schema(sample_weight=False):
+    # columns of the long table, as wide_to_long() returns them
+    dataset = schema_registry.varying
+    fields = [
+        pa.field("patient_id", dataset.column("patient_id").arrow_type),
+        pa.field("vax_index", pa.int16()),
+    ]
+    for pattern, name in LONG_NAMES.items():
+        if name == "vax_product":
+            fields.append(pa.field("vax_type", pa.dictionary(pa.int8(), pa.string())))
+        fields.append(pa.field(name, dataset.column(pattern).arrow_type))
+    if sample_weight:
+        fields.append(pa.field(schema_registry.SAMPLE_WEIGHT, pa.float64()))
+    return pa.schema(fields)
+
+
+def wide_to_long(table, n_slots=None):
+    # one row per non-missing vaccination date, sorted by patient_id, vax_date
+    dataset = schema_registry.varying
+    table = schema_registry.conform(table, dataset, n_slots)
+    n_slots = dataset.n_slots_in(table.column_names)
+
+    pieces = []
+    for i in range(1, n_slots + 1):
+        date = table.column(dataset.slot_name("covid_vax_{i}_date", i))
+        keep = pc.is_valid(date)
+        columns = {
+            "patient_id": table.column("patient_id"),
+            "vax_index": pa.array(np.full(table.num_rows, i, dtype=np.int16)),
+        }
+        for pattern, name in LONG_NAMES.items():
+            columns[name] = table.column(dataset.slot_name(pattern, i))
+        if schema_registry.SAMPLE_WEIGHT in table.column_names:
+            columns[schema_registry.SAMPLE_WEIGHT] = table.column(schema_registry.SAMPLE_WEIGHT)
+        pieces.append(pa.table(columns).filter(keep))
+
+    if not pieces:
+        # no slots; an empty table, but with the long table's columns
+        return long_schema(schema_registry.SAMPLE_WEIGHT in table.column_names).empty_table()
+
+    long = pa.concat_tables(pieces).unify_dictionaries().combine_chunks()
+    vax_type = pa.DictionaryArray.from_arrays(
+        pa.array(product_codes(long.column("vax_product")), type=pa.int8()),
+        pa.array(VAX_TYPES),
+    )
+    long = long.add_column(long.schema.get_field_index("vax_product"), "vax_type", vax_type)
+    return sort_long(long)
+
+
+def sort_long(long):
+    order = pc.sort_indices(long, sort_keys=[("patient_id", "ascending"), ("vax_date", "ascending")])
+    return long.take(order)
+
+
+def patient_starts(patient_id):
+    # boolean mask of rows that start a new patient in a table sorted by patient_id
+    patient_id = np.asarray(patient_id)
+    starts = np.ones(len(patient_id), dtype=bool)
+    starts[1:] = patient_id[1:] != patient_id[:-1]
+    return starts
+
+
+def read_long(path):
+    # long table from a wide varying extract (arrow, parquet or csv), from a parquet
+    # long table written by parquet_store.py, or from an arrow stream of a wide extract
+    # ("-" for stdin, see arrow_stream.py), reshaped batch by batch as it arrives
+    import arrow_stream
+
+    if arrow_stream.is_stream(path):
+        pieces = [wide_to_long(pa.Table.from_batches([batch])) for batch in arrow_stream.read_batches(path)]
+        if not pieces:
+            # a stream without batches: no doses, but the long table's columns
+            return long_schema().empty_table()
+        return sort_long(pa.concat_tables(pieces).unify_dictionaries().combine_chunks())
+    if str(path).endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        if "vax_date" in pq.read_schema(path).names:
+            return sort_long(pq.read_table(path, memory_map=True))
+    return wide_to_long(schema_registry.read_extract(path, schema_registry.varying))
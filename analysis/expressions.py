@@ -0,0 +1,475 @@
+##########################
+# local evaluation of categorised_as / satisfying expressions
+##########################
+
+# This script:
+# compiles the expression strings used by `patients.categorised_as()` and
+# `patients.satisfying()` in the study definitions, eg
+#   "age >= 18 AND age < 50"
+#   "(dialysis AND kidney_transplant) AND dialysis_date > kidney_transplant_date"
+#   "ethnicity_primary='1' OR (NOT ethnicity_primary AND ethnicity_sus='1')"
+# into vectorised numpy evaluation over the columns of a local table, so that derived
+# categories can be recomputed on raw extracts or dummy data without a backend run.
+#
+# The grammar is that of cohortextractor's expressions: AND, OR, NOT, comparisons
+# (=, !=, <>, <, <=, >, >=), + - * /, parentheses, numbers, quoted strings and variable
+# names. By default (`nulls="default"`) missing numbers and strings are replaced with
+# 0 / "" first, as cohortextractor does, so that eg a missing ethnicity_primary with
+# ethnicity_sus='1' satisfies the third expression above. Missing dates have no such
+# default: as in cohortextractor's SQL, a comparison with a missing date is unknown, so
+# neither it nor its NOT is satisfied. A bare variable is true if it is non-zero /
+# non-empty, or for a date, if it is present. `nulls="kleene"` instead follows three-valued logic: comparisons with a
+# missing value are unknown, AND / OR are Kleene's, and a condition that is unknown at the
+# end counts as not satisfied.
+#
+#   agegroup = categorised_as({"18-49": "age >= 18 AND age < 50", "missing": "DEFAULT"}, table)
+#   bp_ht = satisfying("bp_sys >= 140 OR bp_dia >= 90 OR hypertension", table)
+#
+# usage:
+#   python analysis/expressions.py --input output/input_snapshot.csv.gz [--output recategorised.arrow]
+#   # -> recomputes every categorised_as / satisfying variable of the snapshot study
+#   #    definition and reports how many rows differ from the extracted values
+
+import argparse
+import ast
+import re
+import sys
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+import arrow_io
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+DEFAULT = "DEFAULT"
+
+# files the snapshot study definition takes its categorised variables from
+SNAPSHOT_SOURCES = [
+    ROOT / "analysis" / "snapshot_demographic_vars.py",
+    ROOT / "analysis" / "snapshot_comorbidity_vars.py",
+]
+
+TOKEN = re.compile(r"""
+    \s*(?:
+        (?P<number>\d+\.\d*|\.\d+|\d+)
+      | (?P<string>'[^']*'|"[^"]*")
+      | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<op><=|>=|!=|<>|=|<|>|\+|-|\*|/|\(|\))
+    )""", re.VERBOSE)
+
+KEYWORDS = {"AND", "OR", "NOT"}
+COMPARISONS = {"=", "!=", "<>", "<", "<=", ">", ">="}
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+## parsing ----
+
+def tokenize(text):
+    tokens, position = [], 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if not match or match.end() == position:
+            raise ExpressionError(f"unexpected character at {position} in {text!r}")
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value.upper() in KEYWORDS:
+            kind, value = "keyword", value.upper()
+        tokens.append((kind, value))
+        # trailing whitespace
+        while position < len(text) and text[position].isspace():
+            position += 1
+    return tokens
+
+
+class Parser:
+    # recursive descent, lowest precedence first:
+    #   or -> and -> not -> comparison -> sum -> product -> unary -> atom
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def expect(self, value):
+        kind, got = self.take()
+        if got != value:
+            raise ExpressionError(f"expected {value!r} but found {got!r} in {self.text!r}")
+
+    def parse(self):
+        node = self.parse_or()
+        if self.position != len(self.tokens):
+            raise ExpressionError(f"unexpected {self.peek()[1]!r} in {self.text!r}")
+        return node
+
+    def parse_or(self):
+        node = self.parse_and()
+        while self.peek() == ("keyword", "OR"):
+            self.take()
+            node = ("or", node, self.parse_and())
+        return node
+
+    def parse_and(self):
+        node = self.parse_not()
+        while self.peek() == ("keyword", "AND"):
+            self.take()
+            node = ("and", node, self.parse_not())
+        return node
+
+    def parse_not(self):
+        if self.peek() == ("keyword", "NOT"):
+            self.take()
+            return ("not", self.parse_not())
+        return self.parse_comparison()
+
+    def parse_comparison(self):
+        node = self.parse_sum()
+        kind, value = self.peek()
+        if kind == "op" and value in COMPARISONS:
+            self.take()
+            node = ("compare", "!=" if value == "<>" else value, node, self.parse_sum())
+        return node
+
+    def parse_sum(self):
+        node = self.parse_product()
+        while self.peek() in (("op", "+"), ("op", "-")):
+            node = ("arith", self.take()[1], node, self.parse_product())
+        return node
+
+    def parse_product(self):
+        node = self.parse_unary()
+        while self.peek() in (("op", "*"), ("op", "/")):
+            node = ("arith", self.take()[1], node, self.parse_unary())
+        return node
+
+    def parse_unary(self):
+        if self.peek() == ("op", "-"):
+            self.take()
+            return ("arith", "-", ("number", 0.0), self.parse_unary())
+        return self.parse_atom()
+
+    def parse_atom(self):
+        kind, value = self.take()
+        if kind == "number":
+            return ("number", float(value))
+        if kind == "string":
+            return ("string", value[1:-1])
+        if kind == "name":
+            return ("name", value)
+        if (kind, value) == ("op", "("):
+            node = self.parse_or()
+            self.expect(")")
+            return node
+        raise ExpressionError(f"unexpected {value!r} in {self.text!r}")
+
+
+def parse(text):
+    return Parser(text).parse()
+
+
+def names(node):
+    # variable names an expression refers to
+    if node[0] == "name":
+        return [node[1]]
+    found = []
+    for child in node[1:]:
+        if isinstance(child, tuple):
+            found.extend(n for n in names(child) if n not in found)
+    return found
+
+
+## evaluation ----
+
+class Value:
+    # a column or constant: kind is "bool", "num", "str" or "date" (days since epoch);
+    # valid is False where the value is missing
+
+    def __init__(self, kind, data, valid):
+        self.kind = kind
+        self.data = data
+        self.valid = valid
+
+
+def column_value(column, nulls="default"):
+    # arrow / numpy column -> Value
+    if isinstance(column, np.ndarray):
+        column = pa.array(column)
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if pa.types.is_dictionary(column.type):
+        column = column.cast(column.type.value_type)
+    valid = column.is_valid().to_numpy(zero_copy_only=False)
+
+    if pa.types.is_boolean(column.type):
+        kind, data = "bool", column.fill_null(False).to_numpy(zero_copy_only=False)
+    elif pa.types.is_integer(column.type) or pa.types.is_floating(column.type):
+        kind, data = "num", column.cast(pa.float64()).fill_null(0).to_numpy(zero_copy_only=False)
+        # NaN as missing, as read from csv / R
+        valid = valid & ~np.isnan(data)
+        data = np.where(valid, data, 0)
+    elif pa.types.is_date(column.type):
+        kind, data = "date", column.cast(pa.int32()).fill_null(0).to_numpy(zero_copy_only=False).astype(np.int64)
+    else:
+        kind, data = "str", np.asarray(column.cast(pa.string()).fill_null("").to_pylist(), dtype=object)
+
+    if nulls == "default" and kind != "date":
+        valid = np.ones(len(data), dtype=bool)
+    return Value(kind, data, valid)
+
+
+def truth(value):
+    # three-valued truth of a value: (true, known)
+    if value.kind == "bool":
+        data = value.data.astype(bool)
+    elif value.kind == "str":
+        data = value.data != ""
+    elif value.kind == "date":
+        # whether a date is present is always known
+        return value.valid.copy(), np.ones(len(value.valid), dtype=bool)
+    else:
+        data = value.data != 0
+    return data & value.valid, value.valid
+
+
+def _coerce(left, right):
+    # line up the kinds of two operands, converting string constants to numbers or dates
+    def convert(value, kind):
+        if value.kind == "str" and kind == "num":
+            return Value("num", np.array([float(v) if v != "" else np.nan for v in value.data]), value.valid)
+        if value.kind == "str" and kind == "date":
+            days = np.array([(np.datetime64(v, "D") - np.datetime64("1970-01-01", "D")).astype(int) for v in value.data])
+            return Value("date", days, value.valid)
+        if value.kind == "bool" and kind == "num":
+            return Value("num", value.data.astype(float), value.valid)
+        if value.kind == "num" and kind == "str":
+            # category codes compared with numbers, eg ethnicity = 1
+            return Value("str", np.array([_number_string(v) for v in value.data], dtype=object), value.valid)
+        return value
+
+    if left.kind == right.kind:
+        return left, right
+    if "date" in (left.kind, right.kind):
+        return convert(left, "date"), convert(right, "date")
+    if "num" in (left.kind, right.kind) and "str" in (left.kind, right.kind):
+        # a numeric column against a string constant compares as numbers
+        constant_is_str = (left.kind == "str" and len(left.data) == 1) or (right.kind == "str" and len(right.data) == 1)
+        target = "num" if constant_is_str else "str"
+        return convert(left, target), convert(right, target)
+    return convert(left, "num"), convert(right, "num")
+
+
+def _number_string(x):
+    return str(int(x)) if float(x).is_integer() else str(x)
+
+
+COMPARE = {
+    "=": np.equal, "!=": np.not_equal, "<": np.less, "<=": np.less_equal, ">": np.greater, ">=": np.greater_equal,
+}
+ARITHMETIC = {"+": np.add, "-": np.subtract, "*": np.multiply, "/": np.divide}
+
+
+class Expression:
+
+    def __init__(self, text):
+        self.text = text
+        self.tree = parse(text)
+        self.names = names(self.tree)
+
+    def __repr__(self):
+        return f"Expression({self.text!r})"
+
+    def evaluate(self, columns, nulls="default"):
+        # three-valued result: (true, known) boolean arrays
+        n_rows = _n_rows(columns)
+        if isinstance(columns, pa.Table):
+            columns = {name: columns.column(name) for name in columns.column_names}
+        cache = {}
+
+        def lookup(name):
+            if name not in cache:
+                if name not in columns:
+                    raise KeyError(f"{name} is used in {self.text!r} but is not a column")
+                cache[name] = column_value(columns[name], nulls)
+            return cache[name]
+
+        def constant(kind, value):
+            return Value(kind, np.array([value], dtype=object if kind == "str" else float), np.ones(1, dtype=bool))
+
+        def value_of(node):
+            op = node[0]
+            if op == "number":
+                return constant("num", node[1])
+            if op == "string":
+                return constant("str", node[1])
+            if op == "name":
+                return lookup(node[1])
+            if op == "arith":
+                left, right = _coerce(value_of(node[2]), value_of(node[3]))
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    data = ARITHMETIC[node[1]](left.data.astype(float), right.data.astype(float))
+                valid = left.valid & right.valid & np.isfinite(data)
+                return Value("date" if "date" in (left.kind, right.kind) and node[1] in "+-" else "num", data, valid)
+            true, known = condition(node)
+            return Value("bool", true, known)
+
+        def condition(node):
+            op = node[0]
+            if op == "and":
+                a, ak = condition(node[1])
+                b, bk = condition(node[2])
+                # false if either side is known false, true if both known true
+                false = (ak & ~a) | (bk & ~b)
+                return a & b, (ak & bk) | false
+            if op == "or":
+                a, ak = condition(node[1])
+                b, bk = condition(node[2])
+                return a | b, (ak & bk) | a | b
+            if op == "not":
+                a, ak = condition(node[1])
+                return ~a & ak, ak
+            if op == "compare":
+                left, right = _coerce(value_of(node[2]), value_of(node[3]))
+                known = left.valid & right.valid
+                return COMPARE[node[1]](left.data, right.data).astype(bool) & known, known
+            return truth(value_of(node))
+
+        true, known = condition(self.tree)
+        return np.broadcast_to(true, n_rows).copy(), np.broadcast_to(known, n_rows).copy()
+
+    def __call__(self, columns, nulls="default"):
+        # satisfied rows; unknown counts as not satisfied
+        return self.evaluate(columns, nulls)[0]
+
+
+def _n_rows(columns):
+    if isinstance(columns, pa.Table):
+        return columns.num_rows
+    for column in columns.values():
+        return len(column)
+    return 0
+
+
+## study definition helpers ----
+
+def satisfying(expression, columns, nulls="default"):
+    # boolean array, as `patients.satisfying(expression)`
+    return pa.array(Expression(expression)(columns, nulls))
+
+
+def categorised_as(categories, columns, nulls="default"):
+    # category of each row, as `patients.categorised_as(categories)`: the first category
+    # (in the given order) whose condition is satisfied, else the DEFAULT category if
+    # there is one, else missing
+    n_rows = _n_rows(columns)
+    labels = [label for label in categories if categories[label].strip() != DEFAULT]
+    default = [label for label in categories if categories[label].strip() == DEFAULT]
+    codes = np.full(n_rows, -1, dtype=np.int32)
+    for code, label in enumerate(labels):
+        unassigned = codes == -1
+        if not unassigned.any():
+            break
+        satisfied = Expression(categories[label])(columns, nulls)
+        codes[unassigned & satisfied] = code
+    levels = labels + default
+    if default:
+        codes[codes == -1] = len(labels)
+    return pa.DictionaryArray.from_arrays(pa.array(codes, mask=codes == -1), pa.array(levels, type=pa.string()))
+
+
+def definitions_from_source(path):
+    # {variable: categories dict or expression string} for every
+    # `name=patients.categorised_as({...})` / `name=patients.satisfying("...")` in a file
+    tree = ast.parse(Path(path).read_text())
+    definitions = {}
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.keyword) or not isinstance(node.value, ast.Call):
+            continue
+        function = node.value.func
+        if not (isinstance(function, ast.Attribute) and function.attr in ("categorised_as", "satisfying")):
+            continue
+        if not node.value.args:
+            continue
+        try:
+            spec = ast.literal_eval(node.value.args[0])
+        except ValueError:
+            continue
+        definitions[node.arg] = spec
+    return definitions
+
+
+def recategorise(table, definitions, nulls="default"):
+    # evaluate definitions in order, each able to use the ones before it
+    columns = {name: table.column(name) for name in table.column_names}
+    results = {}
+    for name, spec in definitions.items():
+        if isinstance(spec, dict):
+            values = categorised_as(spec, columns, nulls)
+        else:
+            values = satisfying(spec, columns, nulls)
+        columns[name] = values
+        results[name] = values
+    return pa.table(results)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recompute categorised_as / satisfying variables locally")
+    parser.add_argument("--input", default=str(ROOT / "output" / "input_snapshot.csv.gz"))
+    parser.add_argument("--source", action="append", help="study definition file(s) to take expressions from")
+    parser.add_argument("--nulls", choices=["default", "kleene"], default="default",
+                        help="missing values as 0 / \"\" (cohortextractor), or three-valued logic")
+    parser.add_argument("--output", help="write the recomputed variables to this arrow file")
+    args = parser.parse_args(argv)
+
+    definitions = {}
+    for source in args.source or SNAPSHOT_SOURCES:
+        definitions.update(definitions_from_source(source))
+
+    if str(args.input).endswith((".csv", ".csv.gz")):
+        import pyarrow.csv as pacsv
+
+        table = pacsv.read_csv(args.input)
+    else:
+        table = arrow_io.read_table(args.input)
+
+    # only variables whose inputs are all in the table
+    usable = {}
+    available = set(table.column_names)
+    for name, spec in definitions.items():
+        expressions = spec.values() if isinstance(spec, dict) else [spec]
+        needed = {n for text in expressions if text.strip() != DEFAULT for n in Expression(text).names}
+        if needed <= available:
+            usable[name] = spec
+            available.add(name)
+        else:
+            print(f"skipping {name}: missing {', '.join(sorted(needed - available))}", file=sys.stderr)
+
+    result = recategorise(table, usable, args.nulls)
+    for name in result.column_names:
+        if name in table.column_names:
+            recomputed = result.column(name).cast(pa.string()).to_pylist()
+            extracted = table.column(name).cast(pa.string()).to_pylist()
+            differ = sum(a != b for a, b in zip(recomputed, extracted))
+            print(f"{name}: {differ} of {table.num_rows} rows differ from the extract", file=sys.stderr)
+
+    if args.output:
+        arrow_io.write_table(result, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
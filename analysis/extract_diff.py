@@ -0,0 +1,201 @@
+##########################
+# patient-level differences between two versions of an extract
+##########################
+
+# This script:
+# compares two versions of an extract with one row per patient (extract_fixed,
+# extract_varying, the snapshot) and writes a delta of the patients whose rows were
+# inserted, removed or changed, so that what a refresh changed can be passed downstream
+# instead of rerunning everything on the full extract.
+#  - files written with sorted_extract.py (including those of local_engine.py and
+#    sampling.py) record a content hash of each record batch in their index, and
+#    parquet_store.py files one of each row group; a batch or row group with the same hash
+#    in both versions holds the same rows, so it is set aside without being read
+#  - the rest are read, their rows matched by patient_id and compared by a hash of their
+#    values (`sorted_extract.row_hashes()`); only rows that differ are compared column by
+#    column
+#  - other files (eg csv.gz) are compared in full
+#
+# The delta (sorted_extract.py format) has one row per inserted or removed patient and two
+# per changed patient, with the extract's columns and
+#   change:          inserted, removed or changed
+#   version:         old or new, the version the row's values come from
+#   changed_columns: the columns whose values differ, separated by commas (changed rows)
+# A count over the old version is brought up to date by subtracting the counts over the
+# delta's old rows and adding those over its new rows.
+#
+# usage:
+#   python analysis/extract_diff.py OLD NEW [--output output/delta/extract_varying_delta.arrow]
+
+import argparse
+import collections
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import arrow_io
+import parquet_store
+import sorted_extract
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+KEY = sorted_extract.KEY
+CHANGES = ("inserted", "removed", "changed")
+VERSIONS = ("old", "new")
+
+
+def pieces(path):
+    # [(content hash or None, function reading the piece as a table)] of a file's record
+    # batches or row groups; a file without hashes is a single piece
+    path = Path(path)
+    if path.suffix == ".parquet":
+        parquet = pq.ParquetFile(path)
+        metadata = parquet.schema_arrow.metadata or {}
+        if parquet_store.ROW_GROUP_HASHES in metadata:
+            hashes = json.loads(metadata[parquet_store.ROW_GROUP_HASHES])
+            if len(hashes) == parquet.num_row_groups:
+                return [(hash, lambda i=i: parquet.read_row_group(i)) for i, hash in enumerate(hashes)]
+        return [(None, lambda: pq.read_table(path))]
+    if path.name.endswith((".csv", ".csv.gz")):
+        import pyarrow.csv as pacsv
+
+        return [(None, lambda: pacsv.read_csv(path))]
+
+    index_path = sorted_extract.index_path(path)
+    if index_path.exists():
+        index = pa.ipc.open_file(pa.memory_map(str(index_path))).read_all()
+        reader = pa.ipc.open_file(pa.memory_map(str(path)))
+        if "content_hash" in index.column_names and index.num_rows == reader.num_record_batches:
+            return [
+                (hash, lambda i=i: pa.Table.from_batches([reader.get_batch(i)]))
+                for i, hash in enumerate(index.column("content_hash").to_pylist())
+            ]
+    return [(None, lambda: arrow_io.read_table(path))]
+
+
+def unshared(old, new):
+    # the pieces of each version with no piece of the same hash in the other, and the
+    # number of pieces set aside
+    counts = [collections.Counter(hash for hash, _ in side if hash is not None) for side in (old, new)]
+    shared = counts[0] & counts[1]
+    rest = []
+    for side in (old, new):
+        budget = collections.Counter(shared)
+        kept = []
+        for hash, read in side:
+            if budget[hash] > 0:
+                budget[hash] -= 1
+            else:
+                kept.append(read)
+        rest.append(kept)
+    return rest[0], rest[1], sum(shared.values())
+
+
+def read_pieces(side, rest):
+    if rest:
+        return pa.concat_tables([read() for read in rest], promote_options="permissive").unify_dictionaries()
+    # nothing to compare; an empty table with the file's columns
+    return side[0][1]().slice(0, 0) if side else pa.table({KEY: pa.array([], type=pa.int64())})
+
+
+def unique_ids(table, path):
+    patient_id = table.column(KEY).to_numpy()
+    if len(np.unique(patient_id)) != len(patient_id):
+        raise ValueError(f"{path} has more than one row for some patients; only extracts with one row per patient can be compared")
+    return patient_id
+
+
+def delta_rows(table, rows, change, version, changed_columns=None):
+    # rows of one version of the extract, with the delta's columns in front
+    rows = table.take(pa.array(rows, type=pa.int64()))
+    n = rows.num_rows
+    columns = {
+        KEY: rows.column(KEY),
+        "change": pa.array([change] * n, type=pa.string()),
+        "version": pa.array([version] * n, type=pa.string()),
+        "changed_columns": pa.array(changed_columns if changed_columns is not None else [None] * n, type=pa.string()),
+    }
+    for name in rows.column_names:
+        if name != KEY:
+            columns[name] = rows.column(name)
+    return pa.table(columns)
+
+
+def diff(old_path, new_path):
+    # (delta table, stats)
+    start = time.perf_counter()
+    old_pieces, new_pieces = pieces(old_path), pieces(new_path)
+    old_rest, new_rest, n_shared = unshared(old_pieces, new_pieces)
+    old = read_pieces(old_pieces, old_rest)
+    new = read_pieces(new_pieces, new_rest)
+    old_id, new_id = unique_ids(old, old_path), unique_ids(new, new_path)
+
+    # the columns of either version; one that only one version has counts as missing in the other
+    columns = new.column_names + [name for name in old.column_names if name not in new.column_names]
+    old_hashes, new_hashes = sorted_extract.row_hashes(old, columns), sorted_extract.row_hashes(new, columns)
+    _, old_common, new_common = np.intersect1d(old_id, new_id, assume_unique=True, return_indices=True)
+    changed = old_hashes[old_common] != new_hashes[new_common]
+    old_changed, new_changed = old_common[changed], new_common[changed]
+
+    # which columns differ, for the changed rows only
+    compared = [name for name in columns if name != KEY]
+    differs = np.zeros((len(old_changed), len(compared)), dtype=bool)
+    for k, name in enumerate(compared):
+        hashes = []
+        for table, rows in ((old, old_changed), (new, new_changed)):
+            if name in table.column_names:
+                hashes.append(sorted_extract.column_hashes(table.column(name).take(pa.array(rows, type=pa.int64()))))
+            else:
+                hashes.append(np.full(len(rows), sorted_extract.NULL_HASH, dtype=np.uint64))
+        differs[:, k] = hashes[0] != hashes[1]
+    changed_columns = [",".join(name for name, d in zip(compared, row) if d) for row in differs]
+
+    parts = [
+        delta_rows(new, np.flatnonzero(~np.isin(new_id, old_id)), "inserted", "new"),
+        delta_rows(old, np.flatnonzero(~np.isin(old_id, new_id)), "removed", "old"),
+        delta_rows(old, old_changed, "changed", "old", changed_columns),
+        delta_rows(new, new_changed, "changed", "new", changed_columns),
+    ]
+    delta = pa.concat_tables(parts, promote_options="permissive").unify_dictionaries()
+    # by patient, with a changed patient's old row before the new one
+    version = np.array([VERSIONS.index(v) for v in delta.column("version").to_pylist()], dtype=np.int8)
+    delta = delta.take(pa.array(np.lexsort([version, delta.column(KEY).to_numpy()])))
+
+    stats = {
+        "old": str(old_path),
+        "new": str(new_path),
+        "pieces_old": len(old_pieces),
+        "pieces_new": len(new_pieces),
+        "pieces_shared": n_shared,
+        "rows_read_old": old.num_rows,
+        "rows_read_new": new.num_rows,
+        **{change: parts[k].num_rows for k, change in enumerate(CHANGES)},
+        "changed_by_column": {name: int(n) for name, n in zip(compared, differs.sum(axis=0)) if n},
+        "seconds": round(time.perf_counter() - start, 4),
+    }
+    return delta, stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write the patient-level differences between two versions of an extract")
+    parser.add_argument("old", help="arrow, parquet or csv extract")
+    parser.add_argument("new", help="arrow, parquet or csv extract")
+    parser.add_argument("--output", help="default: output/delta/<new name>_delta.arrow")
+    args = parser.parse_args(argv)
+
+    output = Path(args.output or ROOT / "output" / "delta" / (Path(args.new).name.split(".")[0] + "_delta.arrow"))
+    delta, stats = diff(args.old, args.new)
+    sorted_extract.write_sorted(delta, output)
+    print(json.dumps(stats, indent=2))
+    print(f"wrote {output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,388 @@
+##########################
+# disk-backed cache of per-patient features, recomputed only for patients whose events changed
+##########################
+
+# This script:
+# keeps the values of codelist-based variables (eg the ever-diagnosed comorbidity flags of
+# snapshot_comorbidity_vars.py) between runs of a local_engine.py definition, so that a
+# refresh recomputes them only for patients with new, changed or removed relevant events.
+#
+# Feature variables are the variables that read nothing but clinical_events and codelists
+# (no frames, other variables or other source tables), and that no other variable refers
+# to; they must return no row for a patient with no events in their codelists. For each
+# patient the cache holds a key made from every event with a code in one of the codelists:
+# the sum of a hash of each event's codelist, code, date and numeric_value, so any
+# inserted, deleted or edited event changes it (up to a 64-bit hash collision). A run:
+#  - computes the keys in one grouped scan of clinical_events per coding system
+#  - recomputes every feature for the patients whose key differs from the cached one,
+#    on the source tables restricted to those patients (`Engine.restrict()`)
+#  - recomputes a feature for every patient if its version has changed: the version is a
+#    hash of its SQL, in which codelists appear as content-addressed tables, so a new
+#    version of a codelist invalidates the features that use it
+#  - takes the other values from the cache
+#
+# Each feature set (a definition, and the sample it's run on) is a directory of the cache
+# with the features (sorted by patient_id, see sorted_extract.py) and a manifest of the
+# versions and when the set was last requested. The least recently requested sets are
+# evicted beyond `max_sets` sets or `max_bytes` bytes.
+#
+# usage:
+#   python analysis/local_engine.py --definition snapshot --database db.sqlite --feature-cache output/feature_cache
+#   python analysis/feature_cache.py [--cache-dir output/feature_cache] [--max-sets 8] [--max-bytes 2e9]
+#   # lists the cached feature sets, evicting the least recently requested beyond the limits
+
+import argparse
+import hashlib
+import json
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import arrow_io
+import hashing
+import local_engine
+import schema_registry
+import sorted_extract
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+SOURCE = "clinical_events"
+CODE_COLUMNS = {"ctv3": "ctv3_code", "snomed": "snomedct_code"}
+MAX_SETS = 8
+
+KEY = "_key"
+LAST_DATE = "_last_date"
+FEATURES = "features.arrow"
+MANIFEST = "manifest.json"
+
+
+## features of a definition ----
+
+def feature_variables(definition):
+    # the variables that can be cached
+    stored = definition.stored_variables()
+    names = []
+    for variable in definition.variables:
+        references = variable.references
+        reads = local_engine.table_reads(variable.sql)
+        if (
+            variable.name not in stored
+            and references
+            and all(ref.startswith("codelist:") for ref in references)
+            and reads[SOURCE] > 0
+            and sum(reads.values()) == reads[SOURCE]
+        ):
+            names.append(variable.name)
+    return names
+
+
+def feature_codelists(definition, names):
+    # the codelists the feature variables refer to
+    by_name = {v.name: v for v in definition.variables}
+    used = [ref.split(":", 1)[1] for name in names for ref in by_name[name].references]
+    return [definition.codelists[name] for name in dict.fromkeys(used)]
+
+
+def versions(definition, names, engine):
+    # {variable: hash of its SQL with the codelists' content-addressed tables, and the sample}
+    tables = {"codelist:" + name: codelist.table for name, codelist in definition.codelists.items()}
+    sample = f"{engine.fraction}:{engine.seed}"
+    result = {}
+    for variable in definition.variables:
+        if variable.name in names:
+            sql = local_engine.REFERENCE.sub(lambda m: tables[m.group(1)], variable.sql)
+            result[variable.name] = hashlib.sha256(f"{sample}\n{sql}".encode()).hexdigest()[:16]
+    return result
+
+
+def set_name(definition, engine):
+    name = definition.name
+    if engine.fraction is not None:
+        name += f"-sample-{engine.fraction:g}-{engine.seed}"
+    return name
+
+
+## patient keys ----
+
+def _code_hashes(codes):
+    # {code: uint64 hash}
+    return {
+        code: int.from_bytes(hashlib.blake2b(code.encode(), digest_size=8).digest(), "little")
+        for code in codes
+    }
+
+
+def patient_keys(engine, codelists):
+    # (patient_id, key, latest event date) of the patients with an event in any of the
+    # codelists; the key is a sum of one hash per event, of its codelist's digest, code,
+    # date and numeric_value
+    rows = []
+    for system, column in CODE_COLUMNS.items():
+        lists = [(k, c) for k, c in enumerate(codelists) if c.system == system]
+        if not lists:
+            continue
+        with engine.connection:
+            engine.connection.execute("DROP TABLE IF EXISTS temp._feature_codes")
+            engine.connection.execute(
+                "CREATE TEMP TABLE _feature_codes (code TEXT, codelist INTEGER, PRIMARY KEY (code, codelist)) WITHOUT ROWID"
+            )
+            engine.connection.executemany(
+                "INSERT OR IGNORE INTO temp._feature_codes VALUES (?, ?)",
+                [(code, k) for k, codelist in lists for code in codelist.codes],
+            )
+        rows += engine.query(f"""
+            SELECT e.patient_id, c.codelist, e.{column}, e.date, e.numeric_value
+            FROM {SOURCE} AS e JOIN temp._feature_codes AS c ON c.code = e.{column}
+        """)
+    engine.connection.execute("DROP TABLE IF EXISTS temp._feature_codes")
+
+    empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint64), np.zeros(0, dtype="datetime64[D]"))
+    if not rows:
+        return empty
+    patient_id = np.array([r[0] for r in rows], dtype=np.int64)
+    codelist = np.array([r[1] for r in rows], dtype=np.int64)
+    code_hashes = _code_hashes({r[2] for r in rows})
+    code = np.array([code_hashes[r[2]] for r in rows], dtype=np.uint64)
+    date = np.array([r[3] if r[3] is not None else "NaT" for r in rows], dtype="datetime64[D]")
+    value = np.array([r[4] if r[4] is not None else np.nan for r in rows], dtype=np.float64)
+
+    # one hash per event, added up per patient so the order doesn't matter; a missing
+    # date or value hashes as a fixed bit pattern (NaT / NaN)
+    digests = np.array([int(c.digest, 16) for c in codelists], dtype=np.uint64)
+    hashes = hashing.splitmix64(digests[codelist] ^ code)
+    hashes = hashing.splitmix64(hashes ^ date.astype(np.int64).view(np.uint64))
+    hashes = hashing.splitmix64(hashes ^ value.view(np.uint64))
+    order = np.argsort(patient_id, kind="stable")
+    patient_id, hashes, date = patient_id[order], hashes[order], date[order]
+    starts = np.flatnonzero(np.r_[True, patient_id[1:] != patient_id[:-1]])
+    with np.errstate(over="ignore"):
+        keys = np.add.reduceat(hashes, starts)
+    # the latest known date (NaT sorts below every date here)
+    last = np.maximum.reduceat(np.where(np.isnat(date), np.datetime64("0001-01-01"), date), starts)
+    return patient_id[starts], keys, last
+
+
+def align(ids, table):
+    # rows of table (sorted by patient_id) for each id, as take indices with nulls where missing
+    if table is None or table.num_rows == 0:
+        return pa.nulls(len(ids), pa.int64()), np.zeros(len(ids), dtype=bool)
+    cached_ids = table.column("patient_id").to_numpy()
+    position = np.minimum(np.searchsorted(cached_ids, ids), len(cached_ids) - 1)
+    found = cached_ids[position] == ids
+    return pa.array(np.where(found, position, 0), mask=~found), found
+
+
+def combine(keep, old, new):
+    # old where keep, else new, in a type both can be cast to
+    if pa.types.is_null(new.type):
+        new = new.cast(old.type)
+    elif pa.types.is_null(old.type) or old.type != new.type:
+        old = old.cast(new.type)
+    return pc.if_else(pa.array(keep), old, new)
+
+
+## cache ----
+
+class FeatureCache:
+
+    def __init__(self, root=ROOT / "output" / "feature_cache", max_sets=MAX_SETS, max_bytes=None):
+        self.root = Path(root)
+        self.max_sets = max_sets
+        self.max_bytes = max_bytes
+
+    def path(self, name):
+        return self.root / name
+
+    def manifest(self, name):
+        path = self.path(name) / MANIFEST
+        return json.loads(path.read_text()) if path.exists() else None
+
+    def load(self, name):
+        # (features table, manifest), or (None, None) if the set isn't cached
+        manifest = self.manifest(name)
+        if manifest is None or not (self.path(name) / FEATURES).exists():
+            return None, None
+        return arrow_io.read_table(self.path(name) / FEATURES), manifest
+
+    def save(self, name, table, manifest):
+        directory = self.path(name)
+        directory.mkdir(parents=True, exist_ok=True)
+        # written under temporary names and renamed, so an interrupted save leaves the old set
+        sorted_extract.write_sorted(table, directory / ("_" + FEATURES))
+        (directory / ("_" + MANIFEST)).write_text(json.dumps(manifest, indent=2))
+        sorted_extract.index_path(directory / ("_" + FEATURES)).replace(sorted_extract.index_path(directory / FEATURES))
+        (directory / ("_" + FEATURES)).replace(directory / FEATURES)
+        (directory / ("_" + MANIFEST)).replace(directory / MANIFEST)
+
+    def sets(self):
+        # [(name, last used, bytes)], most recently used first
+        result = []
+        if self.root.exists():
+            for directory in self.root.iterdir():
+                manifest = self.manifest(directory.name)
+                if directory.is_dir() and manifest is not None:
+                    size = sum(f.stat().st_size for f in directory.iterdir() if f.is_file())
+                    result.append((directory.name, manifest.get("last_used", 0), size))
+        return sorted(result, key=lambda s: -s[1])
+
+    def evict(self, keep=()):
+        # remove the least recently used sets beyond the limits; returns the names removed
+        removed, total = [], 0
+        for k, (name, _, size) in enumerate(self.sets()):
+            total += size
+            over = k >= self.max_sets or (self.max_bytes is not None and total > self.max_bytes)
+            if over and name not in keep:
+                shutil.rmtree(self.path(name))
+                removed.append(name)
+                total -= size
+        return removed
+
+
+def value_type(definition, cached, name):
+    # the type of a feature with no values: declared by the definition's schema, else as
+    # cached, else null (as Engine.run() gives a variable with no values)
+    if definition.schema is not None:
+        try:
+            return definition.schema.column(name).arrow_type
+        except KeyError:
+            pass
+    if cached is not None and name in cached.column_names:
+        return cached.schema.field(name).type
+    return pa.null()
+
+
+def cached_features(engine, definition, cache, names=None):
+    # (table of patient_id and the feature variables for the patients with relevant events,
+    # stats), from the cache where the patients' keys and the features' versions are unchanged
+    names = feature_variables(definition) if names is None else names
+    codelists = feature_codelists(definition, names)
+    current_versions = versions(definition, names, engine)
+    name = set_name(definition, engine)
+    stats = {"feature_set": name, "feature_variables": len(names)}
+
+    start = time.perf_counter()
+    ids, keys, last_date = patient_keys(engine, codelists)
+    stats["key_seconds"] = round(time.perf_counter() - start, 4)
+
+    cached, manifest = cache.load(name)
+    cached_versions = manifest["versions"] if manifest else {}
+    stale = [n for n in names if cached_versions.get(n) != current_versions[n]]
+    current = [n for n in names if n not in stale]
+
+    take, found = align(ids, cached)
+    unchanged = found.copy()
+    if cached is not None:
+        unchanged[found] = cached.column(KEY).to_numpy()[take.drop_null().to_numpy()] == keys[found]
+        # patients no longer with any relevant event: their features become null
+        dropped = np.setdiff1d(cached.column("patient_id").to_numpy(), ids)
+    else:
+        dropped = np.zeros(0, dtype=np.int64)
+    changed = ids[~unchanged]
+    stats.update({
+        "patients_with_events": len(ids),
+        "patients_changed": int(len(changed) + len(dropped)),
+        "variables_invalidated": stale,
+    })
+
+    def recompute(variables, patient_ids):
+        # the variables for the given patients, aligned to ids
+        if not variables:
+            return {}
+        if not len(patient_ids):
+            return {n: pa.nulls(len(ids), value_type(definition, cached, n)) for n in variables}
+        engine.restrict(patient_ids)
+        try:
+            partial = local_engine.Definition(
+                definition.name,
+                population="SELECT patient_id FROM patients",
+                variables=[v for v in definition.variables if v.name in variables],
+                codelists=definition.codelists.values(),
+            )
+            table, _ = engine.run(partial)
+        finally:
+            engine.unrestrict()
+        rows, _ = align(ids, table)
+        return {n: table.column(n).take(rows) for n in variables}
+
+    start = time.perf_counter()
+    recomputed = recompute(current, changed)
+    # features with a new version: every patient
+    recomputed.update(recompute(stale, ids))
+    stats["recompute_seconds"] = round(time.perf_counter() - start, 4)
+    stats["patients_recomputed"] = int(len(ids) if stale else len(changed))
+
+    columns = {
+        "patient_id": pa.array(ids, type=pa.int64()),
+        KEY: pa.array(keys, type=pa.uint64()),
+        LAST_DATE: pa.array(last_date).cast(pa.date32()),
+    }
+    for n in names:
+        if n in stale:
+            columns[n] = recomputed[n]
+        elif n in recomputed:
+            columns[n] = combine(unchanged, cached.column(n).take(take), recomputed[n])
+        else:
+            columns[n] = cached.column(n).take(take).combine_chunks()
+    table = pa.table(columns)
+
+    cache.save(name, table, {
+        "definition": definition.name,
+        "versions": current_versions,
+        "patients": len(ids),
+        "last_used": time.time(),
+    })
+    stats["evicted"] = cache.evict(keep=[name])
+    return table.select(["patient_id"] + names), stats
+
+
+def run_cached(engine, definition, cache):
+    # Engine.run(definition), with the feature variables taken from the cache
+    names = feature_variables(definition)
+    if not names:
+        return engine.run(definition)
+    rest = local_engine.Definition(
+        definition.name,
+        population=definition.population,
+        variables=[v for v in definition.variables if v.name not in names],
+        frames=definition.frames.values(),
+        codelists=definition.codelists.values(),
+    )
+    start = time.perf_counter()
+    table, stats = engine.run(rest)
+    features, feature_stats = cached_features(engine, definition, cache, names)
+    stats["feature_cache"] = feature_stats
+    stats["total_seconds"] = round(time.perf_counter() - start, 4)
+
+    joined = sorted_extract.join_sorted(table, features, how="left")
+    order = ["patient_id"] + [v.name for v in definition.variables]
+    if schema_registry.SAMPLE_WEIGHT in joined.column_names:
+        order.append(schema_registry.SAMPLE_WEIGHT)
+    table = joined.select(order)
+    if definition.schema is not None:
+        table = schema_registry.conform(table, definition.schema)
+    return table, stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List cached feature sets and evict the least recently used")
+    parser.add_argument("--cache-dir", default=str(ROOT / "output" / "feature_cache"))
+    parser.add_argument("--max-sets", type=int, default=MAX_SETS)
+    parser.add_argument("--max-bytes", type=float, help="total size to keep")
+    args = parser.parse_args(argv)
+
+    cache = FeatureCache(args.cache_dir, args.max_sets, args.max_bytes)
+    for name in cache.evict():
+        print(f"evicted {name}", file=sys.stderr)
+    for name, last_used, size in cache.sets():
+        print(f"{name}\t{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_used))}\t{size}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
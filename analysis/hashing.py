@@ -0,0 +1,43 @@
+##########################
+# stable 64-bit hashes of patient ids and values
+##########################
+
+# This script:
+# holds the splitmix64 hash the other scripts build on, with no imports of its own beyond
+# numpy, so that any of them can use it without importing each other:
+#  - sampling.py and local_engine.py (`--sample`) hash patient_id to a number in [0, 1)
+#  - sorted_extract.py hashes values, rows and batch boundaries
+#  - feature_cache.py hashes clinical events
+
+import numpy as np
+
+
+DEFAULT_SEED = 0
+
+MASK64 = (1 << 64) - 1
+
+
+def splitmix64(x):
+    # splitmix64 finaliser over a uint64 array
+    x = np.asarray(x).astype(np.uint64)
+    with np.errstate(over="ignore"):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def hash_unit(patient_id, seed=DEFAULT_SEED):
+    # patient_id -> stable pseudo-random number in [0, 1)
+    x = np.asarray(patient_id).astype(np.int64).view(np.uint64) ^ np.uint64(seed & MASK64)
+    return (splitmix64(x) >> np.uint64(11)).astype(np.float64) * 2.0 ** -53
+
+
+def hash_unit_scalar(patient_id, seed=DEFAULT_SEED):
+    # the same for a single id, eg as an SQL function (in plain integers, which is much
+    # faster than numpy for one value)
+    x = ((patient_id & MASK64) ^ (seed & MASK64)) + 0x9E3779B97F4A7C15 & MASK64
+    x = (x ^ (x >> 30)) * 0xBF58476D1CE4E5B9 & MASK64
+    x = (x ^ (x >> 27)) * 0x94D049BB133111EB & MASK64
+    x = x ^ (x >> 31)
+    return (x >> 11) * 2.0 ** -53
@@ -0,0 +1,702 @@
+##########################
+# dataset definitions for the local SQLite engine
+##########################
+
+# This script:
+# turns the real definitions into frames and variable queries for local_engine.py, so
+# that they can be run and timed against a local database.
+#  - fixed and varying are translated from dataset_definition_fixed.py and
+#    dataset_definition_varying.py: each file is run with `ehrql` standing for a small
+#    translator whose tables, frames and series build SQL instead of ehrql queries. It
+#    covers what the two files use (where / sort_by / first_for_patient /
+#    last_for_patient, exists_for_patient, for_patient_on, age_on, is_in and
+#    comparisons, with the column names of the local tables); anything else raises
+#    Untranslatable, rather than being translated approximately. Frames are named after
+#    the table and the step that made them (eg vaccinations_first_2).
+#  - snapshot takes the `with_these_clinical_events()` variables of the cohortextractor
+#    files (`source_events()`, read from their source as cohortextractor isn't needed)
+#    that return a flag, date or numeric value of named codelists, with the codelists of
+#    codelists.py. Others (eg returning a category) are left out and listed by `check()`.
+#    The population (alive, aged 18 to 110, female or male) is restated from
+#    study_definition_snapshot.py without its IMD condition, as there are no addresses
+#    in the local tables; `check()` reports if the study definition's changes.
+#
+# usage:
+#   python analysis/local_definitions.py   # exits with status 1 if a definition can't be
+#                                          # translated or the snapshot population changed
+#
+# (the definitions are run with local_engine.py)
+
+import argparse
+import ast
+import builtins
+import csv
+import datetime
+import re
+import sys
+import types
+from pathlib import Path
+
+import schema_registry
+from local_engine import Aggregation, Codelist, Definition, Frame, Variable
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# clinical_events column holding each coding system's codes
+CODE_COLUMNS = {"ctv3": "ctv3_code", "snomed": "snomedct_code"}
+
+INDEX_DATE = "2023-09-01"
+
+# the real definitions
+FIXED_SOURCE = ROOT / "analysis" / "dataset_definition_fixed.py"
+VARYING_SOURCE = ROOT / "analysis" / "dataset_definition_varying.py"
+SNAPSHOT_SOURCES = [
+    ROOT / "analysis" / "study_definition_snapshot.py",
+    ROOT / "analysis" / "snapshot_demographic_vars.py",
+    ROOT / "analysis" / "snapshot_comorbidity_vars.py",
+]
+
+# columns of the local tables (see local_engine.create_dummy_database()); patients has
+# one row per patient
+LOCAL_TABLES = {
+    "patients": ["patient_id", "sex", "date_of_birth"],
+    "vaccinations": ["patient_id", "vaccination_id", "date", "target_disease", "product_name"],
+    "practice_registrations": [
+        "patient_id", "start_date", "end_date", "practice_pseudo_id", "practice_nuts1_region_name", "practice_stp",
+    ],
+    "ons_deaths": ["patient_id", "date"],
+    "clinical_events": ["patient_id", "date", "snomedct_code", "ctv3_code", "numeric_value"],
+}
+
+# the population condition of study_definition_snapshot.py that snapshot() restates
+SNAPSHOT_POPULATION = (
+    'NOT died AND (age >=18 AND age <= 110) AND (sex = "M" OR sex = "F") AND index_of_multiple_deprivation != -1'
+)
+
+
+def age_on(date_of_birth, date):
+    # whole years between two ISO date columns
+    return (
+        f"(CAST(strftime('%Y', {date}) AS INTEGER) - CAST(strftime('%Y', {date_of_birth}) AS INTEGER)"
+        f" - (strftime('%m-%d', {date}) < strftime('%m-%d', {date_of_birth})))"
+    )
+
+
+def active_registration(date):
+    # registrations active on `date` and their order of preference, as in ehrql's
+    # `for_patient_on()`: started on or before the date and not ended before it; the last
+    # by start_date, end_date (missing end dates first) and practice_pseudo_id
+    return (
+        f"r.start_date <= {date} AND (r.end_date >= {date} OR r.end_date IS NULL)",
+        "r.start_date DESC, r.end_date IS NULL, r.end_date DESC, r.practice_pseudo_id DESC",
+    )
+
+
+## translating ehrql ----
+
+class Untranslatable(ValueError):
+    pass
+
+
+def _literal(value):
+    # python value in an ehrql expression -> SQL
+    if isinstance(value, Series):
+        return value
+    if isinstance(value, bool):
+        return Series(str(int(value)))
+    if isinstance(value, (int, float)):
+        return Series(repr(value))
+    if isinstance(value, (str, datetime.date)):
+        return Series("'" + str(value).replace("'", "''") + "'")
+    raise Untranslatable(f"can't translate the value {value!r}")
+
+
+class Series:
+    # an SQL expression over the rows of `table` (aliased t) when it is an event-level
+    # series, or one value per patient otherwise; `sources` are the frames it reads
+    # patient-level values from, {alias: frame or table}, joined on patient_id
+
+    def __init__(self, sql, sources=None, table=None):
+        self.sql = sql
+        self.sources = dict(sources or {})
+        self.table = table
+
+    def _combine(self, other, template):
+        other = _literal(other)
+        if self.table and other.table and self.table != other.table:
+            raise Untranslatable(f"can't combine columns of {self.table} and {other.table}")
+        return Series(template.format(self.sql, other.sql), {**self.sources, **other.sources}, self.table or other.table)
+
+    def __eq__(self, other):
+        return self._combine(other, "({} = {})")
+
+    def __ne__(self, other):
+        return self._combine(other, "({} != {})")
+
+    def __lt__(self, other):
+        return self._combine(other, "({} < {})")
+
+    def __le__(self, other):
+        return self._combine(other, "({} <= {})")
+
+    def __gt__(self, other):
+        return self._combine(other, "({} > {})")
+
+    def __ge__(self, other):
+        return self._combine(other, "({} >= {})")
+
+    def __and__(self, other):
+        return self._combine(other, "({} AND {})")
+
+    def __or__(self, other):
+        return self._combine(other, "({} OR {})")
+
+    def __invert__(self):
+        return Series(f"(NOT {self.sql})", self.sources, self.table)
+
+    def is_in(self, values):
+        return Series(f"({self.sql} IN ({', '.join(_literal(v).sql for v in values)}))", self.sources, self.table)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        raise Untranslatable(f"series method {name}() isn't translated")
+
+    def select(self):
+        # SQL of a patient-level series as a variable: patient_id and value
+        if self.table:
+            raise Untranslatable(f"a column of {self.table} needs reducing to one row per patient")
+        if not self.sources:
+            raise Untranslatable(f"{self.sql} doesn't depend on the patient")
+        (base, source), *rest = self.sources.items()
+        joins = "".join(f" JOIN {s} AS {a} ON {a}.patient_id = {base}.patient_id" for a, s in rest)
+        return f"SELECT {base}.patient_id, {self.sql} AS value FROM {source} AS {base}{joins}"
+
+
+class Frames:
+    # the frames a translation creates, in order, with names from the table and the step
+    # that made them
+
+    def __init__(self):
+        self.frames = []
+        self._counts = {}
+
+    def add(self, table, step, sql):
+        key = f"{table}_{step}"
+        self._counts[key] = self._counts.get(key, 0) + 1
+        frame = Frame(f"{key}_{self._counts[key]}", sql)
+        self.frames.append(frame)
+        return frame.name
+
+
+class PatientFrame:
+    # one row per patient (or none), from `first_for_patient()` or `for_patient_on()`
+
+    def __init__(self, frames, table, name):
+        self._frames = frames
+        self._table = table
+        self._name = name
+
+    def __getattr__(self, column):
+        if column.startswith("_"):
+            raise AttributeError(column)
+        if column not in LOCAL_TABLES[self._table]:
+            raise Untranslatable(f"{self._table} has no column {column} in the local tables")
+        return Series(f"{self._name}.{column}", {self._name: f"{{{self._name}}}"})
+
+    def exists_for_patient(self):
+        return _exists(self._name)
+
+
+def _exists(frame):
+    # false rather than missing for patients without a row, as exists_for_patient()
+    return Series(f"EXISTS (SELECT 1 FROM {{{frame}}} AS e WHERE e.patient_id = patients.patient_id)", {"patients": "patients"})
+
+
+class EventFrame:
+    # rows of an event table, filtered and sorted
+
+    def __init__(self, frames, table, conditions=(), order=()):
+        self._frames = frames
+        self._table = table
+        self._conditions = list(conditions)
+        self._order = list(order)
+
+    def __getattr__(self, column):
+        if column.startswith("_"):
+            raise AttributeError(column)
+        if column not in LOCAL_TABLES[self._table]:
+            raise Untranslatable(f"{self._table} has no column {column} in the local tables")
+        return Series(f"t.{column}", table=self._table)
+
+    def _event_series(self, series, method):
+        series = _literal(series)
+        if series.table not in (None, self._table):
+            raise Untranslatable(f"{method}() on {self._table} with a column of {series.table}")
+        return series
+
+    def where(self, condition):
+        return EventFrame(self._frames, self._table, self._conditions + [self._event_series(condition, "where")], self._order)
+
+    def except_where(self, condition):
+        return self.where(~self._event_series(condition, "except_where"))
+
+    def sort_by(self, *columns):
+        return EventFrame(self._frames, self._table, self._conditions, [self._event_series(c, "sort_by") for c in columns])
+
+    def _rows(self):
+        # FROM and WHERE of the filtered rows, with the patient-level frames they compare with
+        sources = {a: s for c in self._conditions for a, s in c.sources.items()}
+        joins = "".join(f" JOIN {s} AS {a} ON {a}.patient_id = t.patient_id" for a, s in sources.items())
+        where = " AND ".join(c.sql for c in self._conditions) or "1"
+        return f"FROM {self._table} AS t{joins} WHERE {where}"
+
+    def _pick(self, step, descending):
+        if not self._order:
+            raise Untranslatable(f"{step}_for_patient() on {self._table} without sort_by()")
+        # ties are broken by the table's other columns, so that the translation is
+        # deterministic where ehrql leaves the choice open
+        keys = [c.sql for c in self._order] + [f"t.{c}" for c in LOCAL_TABLES[self._table] if c != "patient_id"]
+        order = ", ".join(f"{key}{' DESC' if descending else ''}" for key in keys)
+        columns = ", ".join(LOCAL_TABLES[self._table])
+        name = self._frames.add(self._table, step, f"""
+            SELECT {columns} FROM (
+                SELECT t.*, ROW_NUMBER() OVER (PARTITION BY t.patient_id ORDER BY {order}) AS _k
+                {self._rows()}
+            ) WHERE _k = 1
+        """)
+        return PatientFrame(self._frames, self._table, name)
+
+    def first_for_patient(self):
+        return self._pick("first", descending=False)
+
+    def last_for_patient(self):
+        return self._pick("last", descending=True)
+
+    def exists_for_patient(self):
+        return _exists(self._frames.add(self._table, "where", f"SELECT t.* {self._rows()}"))
+
+    def for_patient_on(self, date):
+        if self._table != "practice_registrations":
+            raise Untranslatable(f"for_patient_on() on {self._table}")
+        date = _literal(date)
+        condition, preference = active_registration(date.sql)
+        joins = "".join(f" JOIN {s} AS {a} ON {a}.patient_id = r.patient_id" for a, s in date.sources.items())
+        columns = ", ".join(LOCAL_TABLES[self._table])
+        name = self._frames.add(self._table, "on", f"""
+            SELECT {columns} FROM (
+                SELECT r.*, ROW_NUMBER() OVER (PARTITION BY r.patient_id ORDER BY {preference}) AS _k
+                FROM {self._table} AS r{joins}
+                WHERE {condition}
+            ) WHERE _k = 1
+        """)
+        return PatientFrame(self._frames, self._table, name)
+
+    def __repr__(self):
+        return f"<{self._table}>"
+
+
+class Patients:
+    # the patients table, one row per patient
+
+    def __getattr__(self, column):
+        if column.startswith("_"):
+            raise AttributeError(column)
+        if column not in LOCAL_TABLES["patients"]:
+            raise Untranslatable(f"patients has no column {column} in the local tables")
+        return Series(f"patients.{column}", {"patients": "patients"})
+
+    def age_on(self, date):
+        date = _literal(date)
+        return Series(age_on("patients.date_of_birth", date.sql), {"patients": "patients", **date.sources})
+
+
+class Dataset:
+
+    def __init__(self):
+        object.__setattr__(self, "population", None)
+        object.__setattr__(self, "variables", {})
+
+    def define_population(self, condition):
+        object.__setattr__(self, "population", _literal(condition))
+
+    def __setattr__(self, name, series):
+        self.variables[name] = _literal(series)
+
+
+class _Tables(types.ModuleType):
+    # `ehrql.tables.*`: the local tables, and an error for any other
+
+    def __init__(self, frames):
+        super().__init__("ehrql.tables.beta.tpp")
+        self.patients = Patients()
+        for table in LOCAL_TABLES:
+            if table != "patients":
+                setattr(self, table, EventFrame(frames, table))
+
+    def __getattr__(self, name):
+        # imported but not translated: only an error when used
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return _UntranslatedTable(name)
+
+
+class _UntranslatedTable:
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        raise Untranslatable(f"there is no local table {self._name}")
+
+
+def translate(path, n_slots=None):
+    # (population sql, {name: variable sql}, frames) of an ehrql dataset definition, run
+    # with ehrql standing for the translator; with n_slots, schema_registry.slot_count()
+    # gives that number
+    frames = Frames()
+    tables = _Tables(frames)
+    ehrql = types.ModuleType("ehrql")
+    ehrql.Dataset = Dataset
+    registry = types.ModuleType("schema_registry")
+    registry.__dict__.update(vars(schema_registry))
+    if n_slots is not None:
+        registry.slot_count = lambda dataset, path=None: n_slots
+
+    def import_(name, globals=None, locals=None, fromlist=(), level=0):
+        if name == "ehrql":
+            return ehrql
+        if name.startswith("ehrql.tables"):
+            return tables
+        if name == "schema_registry":
+            return registry
+        return builtins.__import__(name, globals, locals, fromlist, level)
+
+    namespace = {"__builtins__": {**vars(builtins), "__import__": import_}, "__name__": "__translated__"}
+    exec(compile(Path(path).read_text(), str(path), "exec"), namespace)
+    datasets = [value for value in namespace.values() if isinstance(value, Dataset)]
+    if len(datasets) != 1:
+        raise Untranslatable(f"{path} defines {len(datasets)} datasets")
+    dataset = datasets[0]
+    if dataset.population is None:
+        raise Untranslatable(f"{path} doesn't define a population")
+
+    population = dataset.population
+    (base, source), *rest = population.sources.items()
+    joins = "".join(f" JOIN {s} AS {a} ON {a}.patient_id = {base}.patient_id" for a, s in rest)
+    population_sql = f"SELECT {base}.patient_id FROM {source} AS {base}{joins} WHERE {population.sql}"
+    return population_sql, {name: series.select() for name, series in dataset.variables.items()}, frames.frames
+
+
+## fixed ----
+
+def fixed():
+    population, variables, frames = translate(FIXED_SOURCE)
+    return Definition(
+        "fixed",
+        population=population,
+        variables=[Variable(name, sql) for name, sql in variables.items()],
+        frames=frames,
+        schema=schema_registry.fixed,
+    )
+
+
+## varying ----
+
+def varying(n_slots=None):
+    dataset = schema_registry.varying
+    n_slots = schema_registry.slot_count(dataset) if n_slots is None else n_slots
+    population, variables, frames = translate(VARYING_SOURCE, n_slots)
+
+    # vax_counts_stratified.csv of report.R
+    vax_counts = Aggregation(
+        "vax_counts_stratified",
+        by=["vax_index", "vax_type", "vax_week", "sex", "ageband", "region"],
+        variables=[Variable("sex", "SELECT patient_id, sex AS value FROM patients")],
+        rounding=100,
+    )
+
+    return Definition(
+        "varying",
+        population=population,
+        variables=[Variable(name, sql) for name, sql in variables.items()],
+        frames=frames,
+        schema=dataset,
+        aggregations=[vax_counts],
+    )
+
+
+## codelists ----
+
+def read_codelists(path=ROOT / "analysis" / "codelists.py"):
+    # {name: Codelist} for the `codelist()` / `codelist_from_csv()` assignments in codelists.py
+    codelists = {}
+    for node in ast.parse(Path(path).read_text()).body:
+        if not (isinstance(node, ast.Assign) and isinstance(node.value, ast.Call)):
+            continue
+        call = node.value
+        kind = getattr(call.func, "id", None)
+        if kind not in ("codelist", "codelist_from_csv"):
+            continue
+        name = node.targets[0].id
+        options = {k.arg: ast.literal_eval(k.value) for k in call.keywords}
+        if kind == "codelist":
+            codes = ast.literal_eval(call.args[0])
+        else:
+            with open(ROOT / ast.literal_eval(call.args[0]), newline="") as f:
+                codes = [row[options["column"]] for row in csv.DictReader(f)]
+        codelists[name] = Codelist(name, options["system"], codes)
+    return codelists
+
+
+def combine_codelists(*codelists):
+    first = codelists[0]
+    return Codelist("_".join(c.name for c in codelists), first.system, [code for c in codelists for code in c.codes])
+
+
+def event_codes():
+    # all codes of each system, for filling a dummy database's clinical_events
+    codes = {}
+    for codelist in read_codelists().values():
+        codes.setdefault(codelist.system, []).extend(codelist.codes)
+    return {system: list(dict.fromkeys(c)) for system, c in codes.items()}
+
+
+def in_codelist(codelist):
+    # condition on clinical_events for a code in the codelist, read from its table
+    return f"{CODE_COLUMNS[codelist.system]} IN (SELECT code FROM {{codelist:{codelist.name}}})"
+
+
+## snapshot ----
+
+class Events:
+
+    def __init__(self, codelists, returning="binary_flag", between=(None, None), date_format="YYYY-MM-DD", last=True):
+        # a `patients.with_these_clinical_events()` variable: the names of the codelists it
+        # combines, what it returns, and its window as cohortextractor date expressions
+        # (None for an open end)
+        self.codelists = tuple(codelists)
+        self.returning = returning
+        self.between = tuple(" ".join(d.split()) if d else None for d in between)
+        self.date_format = date_format
+        # whether the last match in the window is taken, rather than the first
+        self.last = last
+
+    def describe(self):
+        returning = self.returning + (f" ({self.date_format})" if self.returning == "date" else "")
+        first = "" if self.last else ", first match"
+        return f"{'+'.join(self.codelists)}, returning {returning}, between {self.between[0]} and {self.between[1]}{first}"
+
+    def __eq__(self, other):
+        return isinstance(other, Events) and self.describe() == other.describe()
+
+
+DATE_EXPRESSION = re.compile(r"^index_date(?:\s*([+-])\s*(\d+)\s*(year|month|day)s?)?$")
+
+
+def resolve_date(expression, index_date):
+    # ISO date of a cohortextractor date expression such as "index_date - 15 months"
+    match = DATE_EXPRESSION.match(expression)
+    if match is None:
+        return str(datetime.date.fromisoformat(expression))
+    date = datetime.date.fromisoformat(index_date)
+    sign, n, unit = match.groups()
+    if sign is None:
+        return str(date)
+    n = int(n) * (1 if sign == "+" else -1)
+    if unit == "day":
+        return str(date + datetime.timedelta(days=n))
+    months = date.year * 12 + date.month - 1 + n * (12 if unit == "year" else 1)
+    return str(date.replace(year=months // 12, month=months % 12 + 1))
+
+
+def translatable(events):
+    # whether snapshot() can take a variable: named codelists of one system, returning
+    # a flag, date or numeric value
+    return not any(name.startswith("<") for name in events.codelists) and events.returning in (
+        "binary_flag", "date", "numeric_value",
+    )
+
+
+def snapshot(index_date=INDEX_DATE):
+    codelists = read_codelists()
+    # the codelists the variables use, by name
+    used = {}
+    # alive, aged 18 to 110 and female or male on the index date, as the population of
+    # study_definition_snapshot.py (without its IMD condition)
+    population = Frame("snapshot_population", f"""
+        SELECT p.patient_id FROM patients AS p
+        WHERE {age_on('p.date_of_birth', repr(index_date))} BETWEEN 18 AND 110
+            AND p.sex IN ('female', 'male')
+            AND NOT EXISTS (
+                SELECT 1 FROM ons_deaths AS d WHERE d.patient_id = p.patient_id AND d.date <= '{index_date}'
+            )
+    """)
+
+    def events_query(events):
+        codelist = combine_codelists(*(codelists[name] for name in events.codelists))
+        used[codelist.name] = codelist
+        conditions = [in_codelist(codelist)]
+        start, end = events.between
+        if start is not None:
+            conditions.append(f"date >= '{resolve_date(start, index_date)}'")
+        if end is not None:
+            conditions.append(f"date <= '{resolve_date(end, index_date)}'")
+        where = " AND ".join(conditions)
+        if events.returning == "binary_flag":
+            return f"SELECT patient_id, 1 AS value FROM clinical_events WHERE {where} GROUP BY patient_id"
+        returning = "numeric_value" if events.returning == "numeric_value" else "date"
+        if events.date_format == "YYYY-MM" and returning == "date":
+            returning = "substr(date, 1, 7)"
+        return f"""
+            SELECT patient_id, {returning} AS value FROM (
+                SELECT patient_id, date, numeric_value,
+                    ROW_NUMBER() OVER (PARTITION BY patient_id ORDER BY date {'DESC' if events.last else 'ASC'}) AS k
+                FROM clinical_events
+                WHERE {where}
+            ) WHERE k = 1
+        """
+
+    def age_at(date):
+        # age on the index date, or on the date another variable returns
+        if date == "index_date":
+            return f"SELECT patient_id, {age_on('date_of_birth', repr(index_date))} AS value FROM patients"
+        return (
+            f"SELECT v.patient_id, {age_on('p.date_of_birth', 'v.value')} AS value "
+            f"FROM {{{date}}} AS v JOIN patients AS p ON p.patient_id = v.patient_id"
+        )
+
+    events = {name: e for name, e in source_events().items() if translatable(e)}
+    variables = [Variable(name, events_query(e)) for name, e in events.items()]
+    variables += [
+        Variable(name, age_at(date)) for name, date in source_ages().items()
+        if date == "index_date" or date in events
+    ]
+
+    return Definition(
+        "snapshot",
+        population="SELECT patient_id FROM {snapshot_population}",
+        variables=variables,
+        frames=[population],
+        codelists=used.values(),
+    )
+
+
+## checks against the real definitions ----
+
+def _call_name(node):
+    return getattr(node.func, "attr", getattr(node.func, "id", None)) if isinstance(node, ast.Call) else None
+
+
+def _keyword_names(tree, function):
+    # names of the `name=...function(...)` keywords in a tree, with their calls
+    return {
+        node.arg: node.value for node in ast.walk(tree)
+        if isinstance(node, ast.keyword) and node.arg and _call_name(node.value) == function
+    }
+
+
+def _string_assignment(tree, name):
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and any(getattr(t, "id", None) == name for t in node.targets):
+            try:
+                return ast.literal_eval(node.value)
+            except ValueError:
+                return None
+    return None
+
+
+def source_events(paths=SNAPSHOT_SOURCES):
+    # {name: Events} of the `with_these_clinical_events()` variables of cohortextractor
+    # files, including the `{name}_date` columns of include_date_of_match
+    events = {}
+    for path in paths:
+        tree = ast.parse(Path(path).read_text())
+        for name, call in _keyword_names(tree, "with_these_clinical_events").items():
+            argument = call.args[0] if call.args else None
+            if isinstance(argument, ast.Attribute):
+                names = [argument.attr]
+            elif _call_name(argument) == "combine_codelists" and all(isinstance(a, ast.Attribute) for a in argument.args):
+                names = [a.attr for a in argument.args]
+            else:
+                # eg filter_codes_by_category(), which the local queries don't restate
+                names = ["<" + ast.unparse(argument) + ">"]
+            options = {}
+            for keyword in call.keywords:
+                try:
+                    options[keyword.arg] = ast.literal_eval(keyword.value)
+                except ValueError:
+                    continue
+            if "between" in options:
+                between = options["between"]
+            elif "on_or_before" in options or "on_or_after" in options:
+                between = (options.get("on_or_after"), options.get("on_or_before"))
+            else:
+                between = (None, None)
+            returning = options.get("returning", "binary_flag")
+            last = returning == "binary_flag" or bool(options.get("find_last_match_in_period"))
+            date_format = options.get("date_format", "YYYY-MM-DD")
+            events[name] = Events(names, returning, between, date_format, last)
+            if options.get("include_date_of_match"):
+                events[f"{name}_date"] = Events(names, "date", between, date_format, last)
+    return events
+
+
+def source_ages(paths=SNAPSHOT_SOURCES):
+    # {name: date} of the `age_as_of()` variables of cohortextractor files, the date being
+    # "index_date" or the name of a variable
+    ages = {}
+    for path in paths:
+        for name, call in _keyword_names(ast.parse(Path(path).read_text()), "age_as_of").items():
+            ages[name] = ast.literal_eval(call.args[0])
+    return ages
+
+
+def source_population(path=SNAPSHOT_SOURCES[0]):
+    # the population condition of a study definition, with whitespace normalised
+    for node in ast.walk(ast.parse(Path(path).read_text())):
+        if isinstance(node, ast.keyword) and node.arg == "population" and _call_name(node.value) == "satisfying":
+            return " ".join(ast.literal_eval(node.value.args[0]).split())
+    return None
+
+
+def check():
+    # the ways the local definitions can't follow the real ones, as messages
+    problems = []
+
+    for name, definition in [("fixed", fixed), ("varying", lambda: varying(n_slots=2))]:
+        try:
+            definition()
+        except Untranslatable as e:
+            problems.append(f"{name}: {e}")
+
+    # snapshot: the same index date and population
+    if _string_assignment(ast.parse(SNAPSHOT_SOURCES[0].read_text()), "snapshot_date") != INDEX_DATE:
+        problems.append(f"snapshot: snapshot_date is no longer {INDEX_DATE}")
+    if source_population() != SNAPSHOT_POPULATION:
+        problems.append(f"snapshot: the population is now {source_population()!r}")
+    return problems
+
+
+DEFINITIONS = {
+    "fixed": fixed,
+    "varying": varying,
+    "snapshot": snapshot,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the local definitions against the real ones")
+    parser.parse_args(argv)
+
+    problems = check()
+    for problem in problems:
+        print(problem)
+    left_out = sorted(name for name, events in source_events().items() if not translatable(events))
+    print(f"{len(problems)} problems; clinical-event variables left out of snapshot: {', '.join(left_out)}", file=sys.stderr)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
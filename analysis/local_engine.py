@@ -0,0 +1,843 @@
+##########################
+# local SQLite stand-in for running dataset definitions
+##########################
+
+# This script:
+# runs definitions written as SQL against a SQLite database with the same tables as
+# the backend (patients, vaccinations, practice_registrations, ons_deaths,
+# clinical_events), so that the way a definition is evaluated can be tested and timed
+# locally. `create_dummy_database()` fills such a database with synthetic records.
+#
+# A definition is made of:
+#  - frames: intermediate queries, eg vaccinations filtered to SARS-2 CORONAVIRUS, that
+#    other frames and variables refer to as `{frame_name}`
+#  - a population query returning patient_id
+#  - variables: one query each, returning patient_id and a single `value` column; a
+#    variable can use another variable's values as `{variable_name}`, eg an age at the
+#    date of another variable
+#  - optionally, aggregations: the tables of counts that aggregate_extract.py computes
+#    instead of (or as well as) writing the patient-level extract
+#
+# A frame is either inlined as a subquery wherever it is referenced, or materialised:
+# computed once into a table (indexed on patient_id by default) that every later
+# reference reads instead. By default a frame is materialised when it is referenced more
+# than once. `Engine.run()` reports, per definition, how many times the source tables
+# are read with and without materialisation (references to a source table in the SQL
+# that is executed), alongside timings.
+#
+# Statements that don't read each other's tables are independent. With `workers` > 1,
+# `Engine.run()` builds the graph of which statement reads which frame or variable table
+# and runs every statement as soon as the ones it reads from are done, on a bounded pool
+# of connections to the same database file; the values are then put together by
+# patient_id. `study_dependencies()` builds the same kind of graph for cohortextractor
+# variables, which refer to each other by name inside strings (eg "creatinine_date",
+# "covid_vax_date_1 + 14 days").
+#
+# Codelists are referred to as `{codelist:name}` and sent to the database as tables named
+# by a hash of their codes (`_codelist_<hash>`, indexed on the code), rather than as an IN
+# list in every statement. Each distinct codelist is uploaded once per connection as a
+# temporary table and shared by every statement that uses it, even under another name,
+# or once per database file with `persistent_codelists`, where later runs reuse it.
+#
+# `Engine.sample()` restricts every source table to a stable hash-based fraction of
+# patients (see sampling.py), by shadowing each with a temporary view of the same name, so
+# that definitions run unchanged on the sample; the output then has a sample_weight column.
+# `Engine.restrict()` and `Engine.restrict_range()` restrict them in the same way to a set
+# of patient ids (see feature_cache.py) or a patient_id range (see resumable_extract.py).
+#
+# usage:
+#   python analysis/local_engine.py [--definition fixed] [--patients 10000] [--inline] [--sample 0.05] [--workers 4]
+#                                   [--persistent-codelists] [--feature-cache output/feature_cache]
+#                                   [--output - [--batches 10] [--tee extract.arrow]]
+#   python analysis/local_engine.py --dependencies analysis/snapshot_comorbidity_vars.py
+
+import argparse
+import ast
+import concurrent.futures
+import hashlib
+import json
+import queue
+import re
+import sqlite3
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+import hashing
+import schema_registry
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+SOURCE_TABLES = ["patients", "vaccinations", "practice_registrations", "ons_deaths", "clinical_events"]
+
+# `{name}` references to frames (or other variables), and `{codelist:name}` references to
+# codelists, in definition SQL
+REFERENCE = re.compile(r"\{((?:codelist:)?[A-Za-z_][A-Za-z0-9_]*)\}")
+# table reads in executed SQL
+TABLE_READ = re.compile(r"\b(?:FROM|JOIN)\s+([A-Za-z_][A-Za-z0-9_]*)", re.IGNORECASE)
+
+FRAME_PREFIX = "_frame_"
+VARIABLE_PREFIX = "_variable_"
+CODELIST_PREFIX = "_codelist_"
+# patient ids of the sample, when sampling
+SAMPLE_TABLE = "_sample"
+# patient ids the source tables are restricted to by restrict(), eg to recompute features
+RESTRICT_TABLE = "_restrict"
+
+
+## definitions ----
+
+class Frame:
+
+    def __init__(self, name, sql, index=("patient_id",), materialise=None):
+        self.name = name
+        self.sql = sql
+        # columns to index when materialised
+        self.index = list(index)
+        # True / False to force, None to materialise frames referenced more than once
+        self.materialise = materialise
+
+    @property
+    def references(self):
+        return REFERENCE.findall(self.sql)
+
+
+class Variable:
+
+    def __init__(self, name, sql):
+        # sql returns patient_id and `value`, at most one row per patient
+        self.name = name
+        self.sql = sql
+
+    @property
+    def references(self):
+        return REFERENCE.findall(self.sql)
+
+
+class Codelist:
+
+    def __init__(self, name, system, codes):
+        self.name = name
+        self.system = system
+        self.codes = list(dict.fromkeys(codes))
+
+    @property
+    def digest(self):
+        # content address: the same codes give the same table, whatever the list is called
+        text = "\n".join([self.system] + sorted(self.codes))
+        return hashlib.sha256(text.encode()).hexdigest()[:12]
+
+    @property
+    def table(self):
+        return CODELIST_PREFIX + self.digest
+
+
+class Aggregation:
+
+    def __init__(self, name, by, variables=(), rounding=1):
+        # counts of doses by `by`: columns of the long dose table (see dose_table.py), the
+        # derived vax_week and ageband, or names of `variables`
+        self.name = name
+        self.by = list(by)
+        # patient-level variables the counts are also split by, eg sex
+        self.variables = list(variables)
+        # counts are rounded up to a multiple of this, as ceiling_any() in utility.R
+        self.rounding = rounding
+
+
+class Definition:
+
+    def __init__(self, name, population, variables, frames=(), schema=None, codelists=(), aggregations=()):
+        self.name = name
+        self.population = population
+        self.variables = list(variables)
+        self.frames = {frame.name: frame for frame in frames}
+        # codelists referred to as `{codelist:name}`
+        self.codelists = {codelist.name: codelist for codelist in codelists}
+        # tables of counts an aggregate-only extraction writes (see aggregate_extract.py)
+        self.aggregations = list(aggregations)
+        # schema_registry dataset the output is conformed to, if any
+        self.schema = schema
+
+    def frame_order(self):
+        # frames in dependency order
+        order, seen = [], set()
+
+        def visit(name, path=()):
+            if name in seen:
+                return
+            if name in path:
+                raise ValueError(f"frames refer to each other in a cycle: {' -> '.join(path + (name,))}")
+            for ref in self.frames[name].references:
+                if ref in self.frames:
+                    visit(ref, path + (name,))
+            seen.add(name)
+            order.append(name)
+
+        for name in self.frames:
+            visit(name)
+        return order
+
+    def reference_counts(self):
+        # number of references to each frame, from the population, variables and other frames
+        counts = dict.fromkeys(self.frames, 0)
+        sql = [self.population] + [v.sql for v in self.variables] + [f.sql for f in self.frames.values()]
+        for text in sql:
+            for ref in REFERENCE.findall(text):
+                if ref in counts:
+                    counts[ref] += 1
+        return counts
+
+    def variable_references(self):
+        # {variable: names of the other variables its sql refers to}
+        names = {v.name for v in self.variables}
+        return {v.name: [ref for ref in v.references if ref in names] for v in self.variables}
+
+    def stored_variables(self):
+        # variables referred to by other variables, which are kept as tables
+        return {ref for refs in self.variable_references().values() for ref in refs}
+
+    def variable_order(self):
+        # variables with each one after the variables it refers to, otherwise in declared order
+        references = self.variable_references()
+        by_name = {v.name: v for v in self.variables}
+        order, seen = [], set()
+
+        def visit(name, path=()):
+            if name in seen:
+                return
+            if name in path:
+                raise ValueError(f"variables refer to each other in a cycle: {' -> '.join(path + (name,))}")
+            for ref in references[name]:
+                visit(ref, path + (name,))
+            seen.add(name)
+            order.append(by_name[name])
+
+        for variable in self.variables:
+            visit(variable.name)
+        return order
+
+    def materialised(self, inline=False):
+        # names of the frames to materialise
+        if inline:
+            return set()
+        counts = self.reference_counts()
+        return {
+            name for name, frame in self.frames.items()
+            if frame.materialise or (frame.materialise is None and counts[name] > 1)
+        }
+
+
+## engine ----
+
+def table_reads(sql, tables=SOURCE_TABLES):
+    # number of times each table is read by a statement
+    reads = dict.fromkeys(tables, 0)
+    for name in TABLE_READ.findall(sql):
+        if name in reads:
+            reads[name] += 1
+    return reads
+
+
+class Engine:
+
+    def __init__(self, path=":memory:", workers=1, persistent_codelists=False):
+        self.path = str(path)
+        if workers > 1 and self.path == ":memory:":
+            raise ValueError("running statements concurrently needs a database file, not :memory:")
+        self.workers = workers
+        self.connection = self._connect()
+        if workers > 1:
+            # readers don't wait for a frame being written by another connection
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        # connections for concurrent statements, created when first needed
+        self.pool = queue.Queue()
+        self.connections = [self.connection]
+        self.pool.put(self.connection)
+        # sampling fraction set by sample(), if any
+        self.fraction = None
+        self.seed = None
+        self.restricted = False
+        # (low, high) set by restrict_range(), if any
+        self.id_range = None
+        # codelist tables are temporary (per connection) unless persistent, when they are
+        # kept in the database file for later runs; {connection id, or None: digests present}
+        self.persistent_codelists = persistent_codelists
+        self.codelist_tables = {}
+        if persistent_codelists:
+            self.codelist_tables[None] = {
+                row[0][len(CODELIST_PREFIX):] for row in self.connection.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE ?", (CODELIST_PREFIX + "%",),
+                )
+            }
+        # (digest, number of codes) of each codelist table created, for run() statistics
+        self.codelist_uploads = []
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=600, check_same_thread=False)
+
+    def _grow_pool(self):
+        while len(self.connections) < self.workers:
+            connection = self._connect()
+            self._prepare(connection)
+            self.connections.append(connection)
+            self.pool.put(connection)
+
+    def _prepare(self, connection):
+        # per-connection state: the sampling / restriction views are temporary, so each
+        # connection has its own
+        for table in SOURCE_TABLES:
+            connection.execute(f"DROP VIEW IF EXISTS temp.{table}")
+        conditions = []
+        if self.fraction is not None:
+            conditions.append(f"patient_id IN (SELECT patient_id FROM main.{SAMPLE_TABLE})")
+        if self.restricted:
+            conditions.append(f"patient_id IN (SELECT patient_id FROM main.{RESTRICT_TABLE})")
+        if self.id_range is not None:
+            low, high = self.id_range
+            if low is not None:
+                conditions.append(f"patient_id > {int(low)}")
+            if high is not None:
+                conditions.append(f"patient_id <= {int(high)}")
+        if not conditions:
+            return
+        for table in SOURCE_TABLES:
+            connection.execute(
+                f"CREATE TEMP VIEW {table} AS SELECT * FROM main.{table} WHERE {' AND '.join(conditions)}"
+            )
+
+    def sample(self, fraction, seed=hashing.DEFAULT_SEED):
+        # restrict the source tables to patients whose hash is below `fraction`; the sampled
+        # ids are computed once, and temporary views take precedence over the tables they
+        # are named after
+        self.unsample()
+        self.connection.create_function(
+            "sample_hash", 1, lambda patient_id: hashing.hash_unit_scalar(patient_id, seed), deterministic=True,
+        )
+        self.connection.execute(f"CREATE TABLE main.{SAMPLE_TABLE} (patient_id INTEGER PRIMARY KEY)")
+        self.connection.execute(f"""
+            INSERT INTO main.{SAMPLE_TABLE}
+            SELECT patient_id FROM main.patients WHERE sample_hash(patient_id) < ?
+        """, (float(fraction),))
+        self.connection.commit()
+        self.fraction, self.seed = fraction, seed
+        for connection in self.connections:
+            self._prepare(connection)
+
+    def unsample(self):
+        self.fraction = self.seed = None
+        for connection in self.connections:
+            self._prepare(connection)
+        self.connection.execute(f"DROP TABLE IF EXISTS main.{SAMPLE_TABLE}")
+        self.connection.commit()
+
+    def restrict(self, patient_ids):
+        # restrict the source tables to the given patients (within the sample, if sampling)
+        self.unrestrict()
+        self.connection.execute(f"CREATE TABLE main.{RESTRICT_TABLE} (patient_id INTEGER PRIMARY KEY)")
+        self.connection.executemany(
+            f"INSERT OR IGNORE INTO main.{RESTRICT_TABLE} VALUES (?)", [(int(p),) for p in patient_ids],
+        )
+        self.connection.commit()
+        self.restricted = True
+        for connection in self.connections:
+            self._prepare(connection)
+
+    def unrestrict(self):
+        self.restricted = False
+        for connection in self.connections:
+            self._prepare(connection)
+        self.connection.execute(f"DROP TABLE IF EXISTS main.{RESTRICT_TABLE}")
+        self.connection.commit()
+
+    def restrict_range(self, low=None, high=None):
+        # restrict the source tables to low < patient_id <= high (either may be None)
+        self.id_range = None if low is None and high is None else (low, high)
+        for connection in self.connections:
+            self._prepare(connection)
+
+    def close(self):
+        if self.fraction is not None:
+            self.unsample()
+        if self.restricted:
+            self.unrestrict()
+        for connection in self.connections:
+            connection.close()
+        self.codelist_tables = {None: self.codelist_tables[None]} if self.persistent_codelists else {}
+
+    def expand(self, sql, substitutions):
+        # replace `{frame}` / `{variable}` references with a table name or an inlined subquery
+        def replace(match):
+            name = match.group(1)
+            if name not in substitutions:
+                raise KeyError(f"unknown reference {{{name}}}")
+            return substitutions[name]
+        return REFERENCE.sub(replace, sql)
+
+    def _substitutions(self, definition, materialised):
+        substitutions = {}
+        for name in definition.frame_order():
+            if name in materialised:
+                substitutions[name] = FRAME_PREFIX + name
+            else:
+                substitutions[name] = f"({self.expand(definition.frames[name].sql, substitutions)})"
+        for name in definition.stored_variables():
+            substitutions[name] = VARIABLE_PREFIX + name
+        for name, codelist in definition.codelists.items():
+            substitutions["codelist:" + name] = codelist.table
+        return substitutions
+
+    def plan(self, definition, inline=False):
+        # the statements that would be executed, without running them
+        materialised = definition.materialised(inline)
+        substitutions = self._substitutions(definition, materialised)
+        stored = definition.stored_variables()
+        statements = []
+        for name in definition.frame_order():
+            if name in materialised:
+                sql = self.expand(definition.frames[name].sql, substitutions)
+                statements.append(("frame", name, sql))
+        statements.append(("population", "population", self.expand(definition.population, substitutions)))
+        for variable in definition.variable_order():
+            kind = "stored_variable" if variable.name in stored else "variable"
+            statements.append((kind, variable.name, self.expand(variable.sql, substitutions)))
+        return statements
+
+    def graph(self, definition, inline=False):
+        # {statement name: names of the statements whose tables it reads}
+        statements = self.plan(definition, inline)
+        produces = {}
+        for kind, name, _ in statements:
+            if kind == "frame":
+                produces[FRAME_PREFIX + name] = name
+            elif kind == "stored_variable":
+                produces[VARIABLE_PREFIX + name] = name
+        return {
+            name: sorted({produces[table] for table in TABLE_READ.findall(sql) if table in produces})
+            for _, name, sql in statements
+        }
+
+    def count_reads(self, definition, inline=False):
+        reads = dict.fromkeys(SOURCE_TABLES, 0)
+        for _, _, sql in self.plan(definition, inline):
+            for table, n in table_reads(sql).items():
+                reads[table] += n
+        return reads
+
+    def materialise(self, frame, sql, connection=None):
+        connection = connection or self.connection
+        table = FRAME_PREFIX + frame.name
+        with connection:
+            connection.execute(f"DROP TABLE IF EXISTS {table}")
+            connection.execute(f"CREATE TABLE {table} AS {sql}")
+            if frame.index:
+                connection.execute(
+                    f"CREATE INDEX {table}_index ON {table} ({', '.join(frame.index)})"
+                )
+
+    def store(self, name, sql, connection=None):
+        # a variable other variables refer to, kept as a table
+        connection = connection or self.connection
+        table = VARIABLE_PREFIX + name
+        with connection:
+            connection.execute(f"DROP TABLE IF EXISTS {table}")
+            connection.execute(f"CREATE TABLE {table} AS {sql}")
+            connection.execute(f"CREATE INDEX {table}_index ON {table} (patient_id)")
+        return self.query(f"SELECT patient_id, value FROM {table}", connection)
+
+    def drop_frames(self, definition):
+        with self.connection:
+            for name in definition.frames:
+                self.connection.execute(f"DROP TABLE IF EXISTS {FRAME_PREFIX}{name}")
+            for name in definition.stored_variables():
+                self.connection.execute(f"DROP TABLE IF EXISTS {VARIABLE_PREFIX}{name}")
+
+    def query(self, sql, connection=None):
+        cursor = (connection or self.connection).execute(sql)
+        return cursor.fetchall()
+
+    def codelists_read(self, definition, sql):
+        # the definition's codelists whose tables a statement reads
+        by_table = {codelist.table: codelist for codelist in definition.codelists.values()}
+        return [by_table[table] for table in dict.fromkeys(TABLE_READ.findall(sql)) if table in by_table]
+
+    def upload_codelist(self, codelist, connection=None):
+        # create the codelist's table (one indexed `code` column) unless the connection can
+        # already read it; every statement using the same codes shares the table
+        connection = connection or self.connection
+        key = None if self.persistent_codelists else id(connection)
+        present = self.codelist_tables.setdefault(key, set())
+        if codelist.digest in present:
+            return
+        schema = "main" if self.persistent_codelists else "temp"
+        with connection:
+            connection.execute("BEGIN")
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {schema}.{codelist.table} (code TEXT PRIMARY KEY) WITHOUT ROWID"
+            )
+            connection.executemany(
+                f"INSERT OR IGNORE INTO {schema}.{codelist.table} VALUES (?)", [(code,) for code in codelist.codes],
+            )
+        present.add(codelist.digest)
+        self.codelist_uploads.append((codelist.digest, len(codelist.codes)))
+
+    def _execute(self, definition, kind, name, sql):
+        # run one statement on a pooled connection; returns (result, seconds)
+        connection = self.pool.get()
+        try:
+            t0 = time.perf_counter()
+            for codelist in self.codelists_read(definition, sql):
+                self.upload_codelist(codelist, connection)
+            if kind == "frame":
+                result = self.materialise(definition.frames[name], sql, connection)
+            elif kind == "stored_variable":
+                result = self.store(name, sql, connection)
+            else:
+                result = self.query(sql, connection)
+            return result, time.perf_counter() - t0
+        finally:
+            self.pool.put(connection)
+
+    def execute(self, definition, inline=False):
+        # run every statement, each as soon as the statements it reads from have finished,
+        # at most `workers` at a time; returns ({name: result}, {name: seconds})
+        statements = {name: (kind, sql) for kind, name, sql in self.plan(definition, inline)}
+        dependencies = self.graph(definition, inline)
+        results, seconds = {}, {}
+
+        if self.workers == 1:
+            for name, (kind, sql) in statements.items():
+                results[name], seconds[name] = self._execute(definition, kind, name, sql)
+            return results, seconds
+
+        self._grow_pool()
+        if self.persistent_codelists:
+            # written once up front rather than by several connections at once
+            for _, sql in statements.values():
+                for codelist in self.codelists_read(definition, sql):
+                    self.upload_codelist(codelist)
+        waiting = dict(dependencies)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            running = {}
+            while waiting or running:
+                ready = [name for name, needs in waiting.items() if all(n in results for n in needs)]
+                for name in ready:
+                    del waiting[name]
+                    kind, sql = statements[name]
+                    running[executor.submit(self._execute, definition, kind, name, sql)] = name
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name], seconds[name] = future.result()
+        return results, seconds
+
+    def run(self, definition, inline=False):
+        # evaluate a definition; returns an arrow table with patient_id and one column per
+        # variable, and a dict of statistics
+        materialised = definition.materialised(inline)
+        stats = {
+            "definition": definition.name,
+            "materialised": sorted(materialised),
+            "workers": self.workers,
+        }
+        start = time.perf_counter()
+        self.codelist_uploads = []
+        try:
+            results, seconds = self.execute(definition, inline)
+        finally:
+            self.drop_frames(definition)
+        stats["statements"] = len(seconds)
+        stats["seconds"] = {name: round(t, 4) for name, t in seconds.items()}
+        stats["total_seconds"] = round(time.perf_counter() - start, 4)
+        # time spent in statements; more than total_seconds when they overlap
+        stats["statement_seconds"] = round(sum(seconds.values()), 4)
+
+        reads = self.count_reads(definition, inline)
+        reads_inlined = self.count_reads(definition, inline=True)
+        stats["source_table_reads"] = sum(reads.values())
+        stats["source_table_reads_inlined"] = sum(reads_inlined.values())
+        stats["source_table_reads_saved"] = stats["source_table_reads_inlined"] - stats["source_table_reads"]
+        stats["reads_by_table"] = reads
+
+        # codelist tables: each reference would otherwise send the codes as an IN list
+        references = [
+            codelist for _, _, sql in self.plan(definition, inline) for codelist in self.codelists_read(definition, sql)
+        ]
+        stats["codelist_references"] = len(references)
+        stats["codelists_distinct"] = len({codelist.digest for codelist in references})
+        stats["codelist_uploads"] = len(self.codelist_uploads)
+        stats["codelist_reuses"] = len(references) - len(self.codelist_uploads)
+        stats["codelist_codes_uploaded"] = sum(n for _, n in self.codelist_uploads)
+        stats["codelist_codes_inlined"] = sum(len(codelist.codes) for codelist in references)
+
+        population = np.array(sorted({row[0] for row in results["population"]}), dtype=np.int64)
+        table = assemble(population, results, [v.name for v in definition.variables])
+        if self.fraction is not None:
+            table = table.append_column(
+                schema_registry.SAMPLE_WEIGHT, pa.array(np.full(table.num_rows, 1 / self.fraction)),
+            )
+            stats["sample_fraction"] = self.fraction
+        if definition.schema is not None:
+            table = schema_registry.conform(table, definition.schema)
+        return table, stats
+
+
+def assemble(population, values, names):
+    # one row per patient in the population, with each variable's value (null if missing)
+    columns = {"patient_id": pa.array(population, type=pa.int64())}
+    for name in names:
+        rows = [row for row in values.get(name, []) if row[0] is not None]
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        position = np.searchsorted(population, ids)
+        keep = position < len(population)
+        keep[keep] = population[position[keep]] == ids[keep]
+        # row of each patient's value, -1 (null) where there is none
+        take = np.full(len(population), -1, dtype=np.int64)
+        take[position[keep]] = np.flatnonzero(keep)
+        column = pa.array([row[1] for row in rows])
+        columns[name] = column.take(pa.array(take, mask=take < 0))
+    return pa.table(columns)
+
+
+## dependencies between cohortextractor variables ----
+
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+def string_references(text, names):
+    # names of variables mentioned in a string, eg "covid_vax_date_1 + 14 days"
+    return [name for name in dict.fromkeys(IDENTIFIER.findall(text)) if name in names]
+
+
+def _is_variable_call(node):
+    # `patients.something(...)`
+    return (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Attribute)
+        and isinstance(node.func.value, ast.Name)
+        and node.func.value.id == "patients"
+    )
+
+
+def study_dependencies(paths):
+    # {variable: variables it refers to} for every `name=patients.xxx(...)` in the files,
+    # from the names mentioned in the strings of its arguments (return_expectations aside)
+    strings = {}
+    for path in paths:
+        tree = ast.parse(Path(path).read_text())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.keyword) and node.arg and _is_variable_call(node.value):
+                arguments = list(node.value.args) + [
+                    k.value for k in node.value.keywords if k.arg != "return_expectations"
+                ]
+                strings[node.arg] = [
+                    n.value for argument in arguments for n in ast.walk(argument)
+                    if isinstance(n, ast.Constant) and isinstance(n.value, str)
+                ]
+    names = set(strings)
+    return {
+        name: [ref for ref in dict.fromkeys(r for text in texts for r in string_references(text, names)) if ref != name]
+        for name, texts in strings.items()
+    }
+
+
+def levels(dependencies):
+    # statements grouped into waves that can each run concurrently: every statement is in
+    # the wave after the last of its dependencies
+    level = {}
+
+    def visit(name, path=()):
+        if name not in level:
+            if name in path:
+                raise ValueError(f"cycle: {' -> '.join(path + (name,))}")
+            level[name] = 1 + max((visit(d, path + (name,)) for d in dependencies.get(name, [])), default=-1)
+        return level[name]
+
+    for name in dependencies:
+        visit(name)
+    waves = [[] for _ in range(max(level.values(), default=-1) + 1)]
+    for name in dependencies:
+        waves[level[name]].append(name)
+    return waves
+
+
+## synthetic database ----
+
+def create_dummy_database(connection, n_patients=10000, seed=10, event_codes=None):
+    # synthetic records with the columns the local definitions use; distributions are
+    # only loosely realistic. Clinical events are drawn from `event_codes`
+    # ({"ctv3": [...], "snomed": [...]}) if given
+    rng = np.random.default_rng(seed)
+    epoch = np.datetime64("1970-01-01", "D")
+
+    def iso(days):
+        return [str(epoch + int(d)) for d in days]
+
+    connection.executescript("""
+        DROP TABLE IF EXISTS patients;
+        DROP TABLE IF EXISTS vaccinations;
+        DROP TABLE IF EXISTS practice_registrations;
+        DROP TABLE IF EXISTS ons_deaths;
+        DROP TABLE IF EXISTS clinical_events;
+        CREATE TABLE patients (patient_id INTEGER PRIMARY KEY, sex TEXT, date_of_birth TEXT);
+        CREATE TABLE vaccinations (
+            patient_id INTEGER, vaccination_id INTEGER, date TEXT, target_disease TEXT, product_name TEXT
+        );
+        CREATE TABLE practice_registrations (
+            patient_id INTEGER, start_date TEXT, end_date TEXT, practice_pseudo_id INTEGER,
+            practice_nuts1_region_name TEXT, practice_stp TEXT
+        );
+        CREATE TABLE ons_deaths (patient_id INTEGER, date TEXT);
+        CREATE TABLE clinical_events (
+            patient_id INTEGER, date TEXT, snomedct_code TEXT, ctv3_code TEXT, numeric_value REAL
+        );
+    """)
+
+    patient_id = np.arange(1, n_patients + 1)
+    sex = np.array(["female", "male", "intersex", "unknown"])[rng.choice(4, n_patients, p=[0.5, 0.48, 0.01, 0.01])]
+    birth = rng.integers(-25_000, 18_000, n_patients)
+    connection.executemany(
+        "INSERT INTO patients VALUES (?, ?, ?)",
+        zip(patient_id.tolist(), sex.tolist(), iso(birth)),
+    )
+
+    # registrations: mostly one, sometimes a second practice after moving
+    practices = rng.integers(1, 500, n_patients)
+    region_of_practice = np.array(schema_registry.REGIONS)[np.arange(500) % len(schema_registry.REGIONS)]
+    stp_of_practice = np.array([f"E540000{k:02d}" for k in range(42)])[np.arange(500) % 42]
+    start = rng.integers(0, 18_000, n_patients)
+    moved = rng.random(n_patients) < 0.1
+    move_date = rng.integers(18_700, 19_600, n_patients)
+    rows = []
+    for p, practice, s, m, d in zip(patient_id, practices, start, moved, move_date):
+        end = iso([d])[0] if m else None
+        rows.append((int(p), iso([s])[0], end, int(practice), region_of_practice[practice], stp_of_practice[practice]))
+        if m:
+            second = int((practice + 37) % 500)
+            rows.append((int(p), iso([d])[0], None, second, region_of_practice[second], stp_of_practice[second]))
+    connection.executemany("INSERT INTO practice_registrations VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    # vaccinations: 0-8 doses a few months apart, plus some other vaccines
+    products = list(schema_registry.VAX_PRODUCTS.values())
+    n_doses = rng.choice(9, n_patients, p=[0.1, 0.05, 0.15, 0.2, 0.15, 0.15, 0.1, 0.05, 0.05])
+    rows = []
+    vaccination_id = 0
+    for p, n in zip(patient_id, n_doses):
+        day = 18_605 + int(rng.integers(0, 120))
+        for _ in range(n):
+            vaccination_id += 1
+            rows.append((int(p), vaccination_id, iso([day])[0], "SARS-2 CORONAVIRUS", products[int(rng.integers(0, len(products)))]))
+            day += int(rng.integers(21, 200))
+        if rng.random() < 0.3:
+            vaccination_id += 1
+            rows.append((int(p), vaccination_id, iso([int(rng.integers(17_000, 19_600))])[0], "INFLUENZA", "Flu vaccine"))
+    connection.executemany("INSERT INTO vaccinations VALUES (?, ?, ?, ?, ?)", rows)
+
+    died = rng.random(n_patients) < 0.02
+    connection.executemany(
+        "INSERT INTO ons_deaths VALUES (?, ?)",
+        zip(patient_id[died].tolist(), iso(rng.integers(18_300, 19_700, died.sum()))),
+    )
+
+    # clinical events: about 30 per patient, a fifth of them with a code of interest
+    if event_codes:
+        ctv3, snomed = list(event_codes.get("ctv3", [])), list(event_codes.get("snomed", []))
+        codes = ctv3 + snomed
+        codes += [f"Y{k:04d}" for k in range(4 * len(codes))]
+        codes = np.asarray(codes, dtype=object)
+        is_snomed = np.zeros(len(codes), dtype=bool)
+        is_snomed[len(ctv3):len(ctv3) + len(snomed)] = True
+        n_events = rng.poisson(30, n_patients)
+        event_patient = np.repeat(patient_id, n_events)
+        n = len(event_patient)
+        k = rng.integers(0, len(codes), n)
+        connection.executemany(
+            "INSERT INTO clinical_events VALUES (?, ?, ?, ?, ?)",
+            zip(
+                event_patient.tolist(),
+                iso(rng.integers(14_000, 19_600, n)),
+                np.where(is_snomed[k], codes[k], None).tolist(),
+                np.where(is_snomed[k], None, codes[k]).tolist(),
+                np.round(rng.gamma(4, 20, n), 1).tolist(),
+            ),
+        )
+
+    connection.executescript("""
+        CREATE INDEX vaccinations_patient ON vaccinations (patient_id);
+        CREATE INDEX practice_registrations_patient ON practice_registrations (patient_id);
+        CREATE INDEX ons_deaths_patient ON ons_deaths (patient_id);
+        CREATE INDEX clinical_events_patient ON clinical_events (patient_id);
+    """)
+    connection.commit()
+
+
+def main(argv=None):
+    import arrow_stream
+    import local_definitions
+
+    parser = argparse.ArgumentParser(description="Run a definition against a local SQLite database")
+    parser.add_argument("--definition", choices=sorted(local_definitions.DEFINITIONS), default="fixed")
+    parser.add_argument("--database", default=":memory:", help="SQLite file; created with dummy data if missing")
+    parser.add_argument("--patients", type=int, default=10000, help="number of dummy patients")
+    parser.add_argument("--inline", action="store_true", help="inline every frame instead of materialising")
+    parser.add_argument("--sample", type=float, help="run on this fraction of patients (see sampling.py)")
+    parser.add_argument("--seed", type=int, default=hashing.DEFAULT_SEED, help="seed of the sampling hash")
+    parser.add_argument("--workers", type=int, default=1, help="statements to run at once (needs --database)")
+    parser.add_argument("--persistent-codelists", action="store_true",
+                        help="keep codelist tables in the database for later runs")
+    parser.add_argument("--feature-cache", metavar="DIR",
+                        help="take codelist-based variables from this cache, recomputing changed patients (see feature_cache.py)")
+    parser.add_argument("--output", help="write the extract to this arrow file, or stream it to `-` (stdout) or a named pipe")
+    parser.add_argument("--batches", type=int, default=1,
+                        help="stream the extract in this many patient_id ranges (see arrow_stream.py)")
+    parser.add_argument("--tee", metavar="PATH", help="also write a streamed extract to this arrow file")
+    parser.add_argument("--dependencies", nargs="+", metavar="PATH",
+                        help="print the waves of independent variables of cohortextractor variable files, and exit")
+    args = parser.parse_args(argv)
+
+    if args.dependencies:
+        dependencies = study_dependencies(args.dependencies)
+        print(json.dumps({"waves": levels(dependencies), "dependencies": {k: v for k, v in dependencies.items() if v}}, indent=2))
+        return 0
+
+    fresh = args.database == ":memory:" or not Path(args.database).exists()
+    engine = Engine(args.database, workers=args.workers, persistent_codelists=args.persistent_codelists)
+    if fresh:
+        create_dummy_database(engine.connection, args.patients, event_codes=local_definitions.event_codes())
+
+    if args.sample is not None:
+        engine.sample(args.sample, args.seed)
+    definition = local_definitions.DEFINITIONS[args.definition]()
+    if args.output and arrow_stream.is_stream(args.output):
+        try:
+            stats = arrow_stream.stream_definition(engine, definition, args.output, args.batches, tee=args.tee)
+        finally:
+            engine.close()
+        # stdout may be carrying the stream
+        print(json.dumps(stats, indent=2), file=sys.stderr)
+        return 0
+    if args.batches > 1 or args.tee:
+        parser.error("--batches and --tee only apply to a streamed --output")
+    if args.feature_cache:
+        import feature_cache
+
+        table, stats = feature_cache.run_cached(engine, definition, feature_cache.FeatureCache(args.feature_cache))
+    else:
+        table, stats = engine.run(definition, inline=args.inline)
+    engine.close()
+
+    if args.output:
+        import sorted_extract
+
+        sorted_extract.write_sorted(table, args.output)
+    stats["rows"] = table.num_rows
+    print(json.dumps(stats, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
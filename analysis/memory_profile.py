@@ -0,0 +1,411 @@
+##########################
+# memory profiling for pipeline actions
+##########################
+
+# This script:
+# samples resident memory (RSS) over the lifetime of an action, records the peak,
+# and writes a per-column byte breakdown of every Arrow / Parquet artifact that the
+# action produced under output/, split into data, validity and dictionary buffers.
+#
+# Any action can be profiled locally by wrapping its command (run_local.py --profile
+# does this for every action, passing its declared outputs with --outputs):
+#   python analysis/memory_profile.py --action process -- Rscript analysis/process.R
+#
+# Python stages can profile a block of code instead:
+#   with profile_action("dose_qa"):
+#       ...
+# which is a no-op unless PROFILE_MEMORY=1 is set in the environment.
+#
+# Limits:
+#  - this is a local tool. No project.yaml action is wrapped or calls profile_action, and
+#    on the backend an R action can't be wrapped at all (the r image has no python, and
+#    the python image has no R), so nothing is profiled on real data.
+#  - for a block, peak_rss_bytes is the highest RSS sampled while the block ran (every
+#    --interval seconds, so a shorter spike can be missed). The kernel's exact high-water
+#    mark (ru_maxrss) covers the whole process, including anything before the block, so
+#    it is reported separately as process_peak_rss_bytes.
+#  - for a wrapped command, peak_rss_bytes is the largest of the sampled RSS of the
+#    process tree and ru_maxrss of the largest single child, not of the tree's total.
+#
+# Summaries are written to logs/memory_<action>.json and
+# logs/memory_<action>_columns.csv so that regressions show up in the commit history.
+
+import argparse
+import contextlib
+import csv
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+ROOT = Path(__file__).resolve().parent.parent
+OUTPUT_DIR = ROOT / "output"
+LOG_DIR = ROOT / "logs"
+
+ARROW_SUFFIXES = (".arrow", ".feather")
+PARQUET_SUFFIXES = (".parquet",)
+
+# number of timeline points kept in the json summary
+MAX_TIMELINE_POINTS = 200
+
+
+## RSS sampling ----
+
+def _page_rss_bytes(pid):
+    # VmRSS from /proc is reported in kB
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        pass
+    return 0
+
+
+def _child_pids(pid):
+    # all descendants of pid, found by walking the parent links in /proc
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # the command name is parenthesised and may itself contain spaces
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (FileNotFoundError, ProcessLookupError, PermissionError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    descendants = []
+    stack = [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            descendants.append(child)
+            stack.append(child)
+    return descendants
+
+
+def tree_rss_bytes(pid, include_children=True):
+    pids = [pid] + (_child_pids(pid) if include_children else [])
+    return sum(_page_rss_bytes(p) for p in pids)
+
+
+class RSSSampler:
+    # samples the RSS of a process (and its descendants) on a background thread
+
+    def __init__(self, pid=None, interval=0.1, include_children=True):
+        self.pid = pid or os.getpid()
+        self.interval = interval
+        self.include_children = include_children
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._start_time = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.samples.append(
+                (time.monotonic() - self._start_time, tree_rss_bytes(self.pid, self.include_children))
+            )
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._start_time = time.monotonic()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self
+
+    @property
+    def peak_bytes(self):
+        return max((rss for _, rss in self.samples), default=0)
+
+    def timeline(self, max_points=MAX_TIMELINE_POINTS):
+        step = max(1, len(self.samples) // max_points)
+        return [[round(t, 3), rss] for t, rss in self.samples[::step]]
+
+
+## per-column footprint ----
+
+def _array_buffers(array, sizes, in_dictionary=False):
+    # accumulate buffer sizes of one array into sizes["data" | "validity" | "dictionary"]
+    if isinstance(array, pa.ChunkedArray):
+        for chunk in array.chunks:
+            _array_buffers(chunk, sizes, in_dictionary)
+        return
+
+    if pa.types.is_dictionary(array.type):
+        _array_buffers(array.indices, sizes, in_dictionary)
+        _array_buffers(array.dictionary, sizes, in_dictionary=True)
+        return
+
+    # the first buffer of every arrow layout is the validity bitmap
+    own_buffers = array.buffers()[: _own_buffer_count(array.type)]
+    for i, buf in enumerate(own_buffers):
+        if buf is None:
+            continue
+        if in_dictionary:
+            sizes["dictionary"] += buf.size
+        elif i == 0:
+            sizes["validity"] += buf.size
+        else:
+            sizes["data"] += buf.size
+
+    # nested types keep their children's buffers after their own
+    if pa.types.is_struct(array.type):
+        for i in range(array.type.num_fields):
+            _array_buffers(array.field(i), sizes, in_dictionary)
+    elif pa.types.is_list(array.type) or pa.types.is_large_list(array.type) or pa.types.is_fixed_size_list(array.type):
+        _array_buffers(array.values, sizes, in_dictionary)
+    elif pa.types.is_map(array.type):
+        _array_buffers(array.keys, sizes, in_dictionary)
+        _array_buffers(array.items, sizes, in_dictionary)
+
+
+def _own_buffer_count(arrow_type):
+    if pa.types.is_struct(arrow_type) or pa.types.is_fixed_size_list(arrow_type) or pa.types.is_null(arrow_type):
+        return 1
+    if pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type) or pa.types.is_map(arrow_type):
+        return 2
+    if (
+        pa.types.is_string(arrow_type) or pa.types.is_binary(arrow_type)
+        or pa.types.is_large_string(arrow_type) or pa.types.is_large_binary(arrow_type)
+    ):
+        return 3
+    return 2
+
+
+def _empty_sizes():
+    return {"data": 0, "validity": 0, "dictionary": 0}
+
+
+def arrow_column_footprint(path):
+    # reads the file one record batch at a time through a memory map,
+    # so the footprint of large extracts can be measured without loading them
+    with pa.memory_map(str(path)) as source:
+        reader = pa.ipc.open_file(source)
+        schema = reader.schema
+        sizes = {name: _empty_sizes() for name in schema.names}
+        previous_dictionaries = {}
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            for name, column in zip(schema.names, batch.columns):
+                if pa.types.is_dictionary(column.type):
+                    # dictionaries are shared between batches unless replaced, so only count new ones
+                    _array_buffers(column.indices, sizes[name])
+                    previous = previous_dictionaries.get(name)
+                    if previous is None or not previous.equals(column.dictionary):
+                        _array_buffers(column.dictionary, sizes[name], in_dictionary=True)
+                        previous_dictionaries[name] = column.dictionary
+                else:
+                    _array_buffers(column, sizes[name])
+    return schema, sizes
+
+
+def parquet_column_footprint(path):
+    # parquet interleaves validity (definition levels) with the data pages,
+    # so decode one column chunk at a time and measure the resulting arrow buffers
+    parquet_file = pq.ParquetFile(str(path))
+    schema = parquet_file.schema_arrow
+    sizes = {name: _empty_sizes() for name in schema.names}
+    for rg in range(parquet_file.num_row_groups):
+        for name in schema.names:
+            table = parquet_file.read_row_group(rg, columns=[name])
+            _array_buffers(table.column(0), sizes[name])
+    return schema, sizes
+
+
+def column_footprint(path):
+    path = Path(path)
+    if path.suffix in PARQUET_SUFFIXES:
+        schema, sizes = parquet_column_footprint(path)
+    else:
+        schema, sizes = arrow_column_footprint(path)
+
+    rows = []
+    for field in schema:
+        s = sizes[field.name]
+        rows.append({
+            "file": str(path.relative_to(ROOT)) if path.is_relative_to(ROOT) else str(path),
+            "column": field.name,
+            "type": str(field.type),
+            "data_bytes": s["data"],
+            "validity_bytes": s["validity"],
+            "dictionary_bytes": s["dictionary"],
+            "total_bytes": s["data"] + s["validity"] + s["dictionary"],
+        })
+    return rows
+
+
+def find_artifacts(directory=OUTPUT_DIR, since=None, outputs=None):
+    # arrow and parquet files under directory, optionally only those modified after `since`;
+    # with `outputs` (an action's declared output globs, relative to the repo root), only
+    # the files matching those, as `since` also picks up whatever concurrent actions wrote
+    directory = Path(directory)
+    if outputs is not None:
+        paths = {path for pattern in outputs for path in ROOT.glob(pattern)}
+    elif directory.exists():
+        paths = directory.rglob("*")
+    else:
+        return []
+    artifacts = []
+    for path in sorted(paths):
+        if path.suffix not in ARROW_SUFFIXES + PARQUET_SUFFIXES or not path.is_file():
+            continue
+        if since is not None and path.stat().st_mtime < since:
+            continue
+        artifacts.append(path)
+    return artifacts
+
+
+## summaries ----
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_summary(action, sampler, started, finished, peak_bytes, command=None, returncode=None,
+                  artifacts=None, log_dir=LOG_DIR, process_peak_bytes=None):
+    log_dir = Path(log_dir)
+    log_dir.mkdir(parents=True, exist_ok=True)
+
+    column_rows = []
+    for path in artifacts or []:
+        column_rows.extend(column_footprint(path))
+
+    summary = {
+        "action": action,
+        "command": command,
+        "returncode": returncode,
+        "commit": _git_commit(),
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(started)),
+        "elapsed_seconds": round(finished - started, 3),
+        "peak_rss_bytes": peak_bytes,
+        "sampled_peak_rss_bytes": sampler.peak_bytes,
+        "process_peak_rss_bytes": process_peak_bytes,
+        "n_samples": len(sampler.samples),
+        "artifacts": sorted({row["file"] for row in column_rows}),
+        "artifact_bytes": sum(row["total_bytes"] for row in column_rows),
+        "rss_timeline": sampler.timeline(),
+    }
+
+    with open(log_dir / f"memory_{action}.json", "w") as f:
+        json.dump(summary, f, indent=2)
+
+    with open(log_dir / f"memory_{action}_columns.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=[
+            "file", "column", "type", "data_bytes", "validity_bytes", "dictionary_bytes", "total_bytes",
+        ])
+        writer.writeheader()
+        # largest columns first, as that is what we want to look at when an action is OOM-killed
+        writer.writerows(sorted(column_rows, key=lambda row: -row["total_bytes"]))
+
+    return summary
+
+
+@contextlib.contextmanager
+def profile_action(action, enabled=None, output_dir=OUTPUT_DIR, log_dir=LOG_DIR, interval=0.1, outputs=None):
+    # profile the current python process for the duration of the block (see the limits above)
+    if enabled is None:
+        enabled = os.environ.get("PROFILE_MEMORY", "") not in ("", "0")
+    if not enabled:
+        yield None
+        return
+
+    started = time.time()
+    sampler = RSSSampler(interval=interval, include_children=False).start()
+    try:
+        yield sampler
+    finally:
+        sampler.stop()
+        # the block's peak is only known from the samples: ru_maxrss (in kB on linux) is
+        # the peak of the whole process so far, which may predate the block
+        write_summary(
+            action, sampler, started, time.time(), sampler.peak_bytes,
+            command=" ".join(sys.argv),
+            artifacts=find_artifacts(output_dir, since=started, outputs=outputs),
+            log_dir=log_dir,
+            process_peak_bytes=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        )
+
+
+def profile_command(action, command, output_dir=OUTPUT_DIR, log_dir=LOG_DIR, interval=0.1, outputs=None):
+    # run command as a child process, sampling the RSS of its whole process tree
+    started = time.time()
+    process = subprocess.Popen(command, cwd=ROOT)
+    sampler = RSSSampler(pid=process.pid, interval=interval).start()
+    returncode = process.wait()
+    sampler.stop()
+    finished = time.time()
+
+    # high-water mark of the largest single (now reaped) descendant, in kB on linux
+    peak = max(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024, sampler.peak_bytes)
+    summary = write_summary(
+        action, sampler, started, finished, peak,
+        command=" ".join(command),
+        returncode=returncode,
+        artifacts=find_artifacts(output_dir, since=started, outputs=outputs),
+        log_dir=log_dir,
+    )
+    return returncode, summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Profile the memory use of a pipeline action")
+    parser.add_argument("--action", required=True, help="action name, used to name the log files")
+    parser.add_argument("--output-dir", default=str(OUTPUT_DIR), help="where the action writes its artifacts")
+    parser.add_argument("--log-dir", default=str(LOG_DIR))
+    parser.add_argument("--interval", type=float, default=0.1, help="RSS sampling interval in seconds")
+    parser.add_argument("--outputs", action="append", metavar="GLOB",
+                        help="the action's declared outputs (repeatable); by default, files modified while it ran")
+    parser.add_argument("--artifacts-only", action="store_true",
+                        help="don't run anything, just report the footprint of existing artifacts")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="command to run, after --")
+    args = parser.parse_args(argv)
+
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+
+    if args.artifacts_only:
+        now = time.time()
+        sampler = RSSSampler()
+        summary = write_summary(
+            args.action, sampler, now, now, 0,
+            artifacts=find_artifacts(args.output_dir, outputs=args.outputs), log_dir=args.log_dir,
+        )
+        returncode = 0
+    else:
+        if not command:
+            parser.error("no command given to profile")
+        returncode, summary = profile_command(
+            args.action, command, output_dir=args.output_dir, log_dir=args.log_dir, interval=args.interval,
+            outputs=args.outputs,
+        )
+
+    print(
+        f"{args.action}: peak RSS {summary['peak_rss_bytes'] / 2**20:.1f} MiB, "
+        f"{len(summary['artifacts'])} artifact(s), {summary['artifact_bytes'] / 2**20:.1f} MiB in memory",
+        file=sys.stderr,
+    )
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
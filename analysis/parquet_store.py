@@ -0,0 +1,204 @@
+##########################
+# parquet copies of the extracts, clustered by date, with row-group pruning
+##########################
+
+# This script:
+# writes the long dose table (see dose_table.py) and the extracts as parquet, sorted
+# (clustered) by a date column so that each row group covers a narrow range of dates, with
+# min / max statistics for every column chunk and page indexes. `read_filtered()` reads
+# such a file with a date range and categorical conditions (eg region, product):
+#  - row groups whose statistics rule out any match are skipped without being read
+#  - the remaining row groups are read (only the requested columns) and filtered exactly
+# so an analysis of a few weeks reads a few row groups rather than the whole file.
+# The file's metadata also holds a content hash of each row group (`row_group_hashes`),
+# so that extract_diff.py can tell which row groups two versions of a file share.
+#
+#   doses, stats = read_filtered(
+#       "output/parquet/doses.parquet",
+#       date_range=("vax_date", "2022-09-01", "2022-12-31"),
+#       where={"region": ["London"], "vax_type": ["pfizerBA45"]},
+#   )
+#
+# It isn't a project.yaml action, as no action reads the parquet copies (they would only
+# be another highly sensitive copy of the extracts); make them locally for exploratory
+# reads of narrow date ranges.
+#
+# usage:
+#   python analysis/parquet_store.py [--varying output/extracts/extract_varying.arrow] [--row-group-size 131072]
+#   # -> output/parquet/doses.parquet (long table, clustered by vax_date),
+#   #    extract_varying.parquet (by covid_vax_1_date) and extract_fixed.parquet (by region)
+
+import argparse
+import datetime
+import json
+import sys
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import arrow_io
+import dose_table
+import schema_registry
+import sorted_extract
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+ROW_GROUP_SIZE = 131_072
+ROW_GROUP_HASHES = b"row_group_hashes"
+
+
+## writing ----
+
+def write_clustered(table, path, cluster_by, row_group_size=ROW_GROUP_SIZE, compression=None):
+    # write a table sorted by cluster_by (then patient_id), with statistics and page indexes
+    # and the content hash of each row group, compressed with the arrow_io.py setting
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    sort_keys = [(cluster_by, "ascending")]
+    if cluster_by != "patient_id" and "patient_id" in table.column_names:
+        sort_keys.append(("patient_id", "ascending"))
+    # dictionary columns are sorted by their values
+    keys = {}
+    for name, _ in sort_keys:
+        column = table.column(name)
+        keys[name] = column.cast(column.type.value_type) if pa.types.is_dictionary(column.type) else column
+    table = table.take(pc.sort_indices(pa.table(keys), sort_keys=sort_keys))
+    sorting_columns = [pq.SortingColumn(table.column_names.index(name)) for name, _ in sort_keys]
+    # content hash of each row group, for extract_diff.py
+    hashes = sorted_extract.row_hashes(table)
+    starts = range(0, table.num_rows, row_group_size)
+    metadata = dict(table.schema.metadata or {})
+    metadata[ROW_GROUP_HASHES] = json.dumps(
+        [sorted_extract.content_hash(hashes[start:start + row_group_size], table.column_names) for start in starts]
+    ).encode()
+    pq.write_table(
+        table.replace_schema_metadata(metadata),
+        path,
+        row_group_size=row_group_size,
+        **arrow_io.parquet_options(compression),
+        write_statistics=True,
+        write_page_index=True,
+        sorting_columns=sorting_columns,
+    )
+    return path
+
+
+## reading ----
+
+def _as_stat(value, type):
+    # condition value -> the python type parquet statistics are read as
+    if pa.types.is_date(type) and isinstance(value, str):
+        return datetime.date.fromisoformat(value)
+    return value
+
+
+def row_group_matches(row_group, conditions):
+    # False if the row group's statistics show no row can satisfy every condition;
+    # conditions are (column index, low, high) ranges or (column index, set of values)
+    for condition in conditions:
+        column_index = condition[0]
+        statistics = row_group.column(column_index).statistics
+        if statistics is None or not statistics.has_min_max:
+            continue
+        low, high = statistics.min, statistics.max
+        if len(condition) == 3:
+            _, start, end = condition
+            if (start is not None and high < start) or (end is not None and low > end):
+                return False
+        else:
+            _, values = condition
+            if not any(low <= value <= high for value in values):
+                return False
+    return True
+
+
+def read_filtered(path, columns=None, date_range=None, where=None):
+    # (table, stats) of the rows with date_range[0] column between date_range[1] and
+    # date_range[2] (inclusive, either may be None) and, for each column in `where`, a
+    # value in the given list
+    parquet = pq.ParquetFile(path)
+    schema = parquet.schema_arrow
+    names = parquet.schema.names
+    where = where or {}
+
+    conditions, filters = [], []
+    if date_range is not None:
+        name, start, end = date_range
+        type = schema.field(name).type
+        start, end = _as_stat(start, type), _as_stat(end, type)
+        conditions.append((names.index(name), start, end))
+        column = pc.field(name)
+        if start is not None:
+            filters.append(column >= pa.scalar(start, type=pa.date32() if pa.types.is_date(type) else type))
+        if end is not None:
+            filters.append(column <= pa.scalar(end, type=pa.date32() if pa.types.is_date(type) else type))
+    for name, values in where.items():
+        type = schema.field(name).type
+        value_type = type.value_type if pa.types.is_dictionary(type) else type
+        values = [_as_stat(v, value_type) for v in values]
+        conditions.append((names.index(name), set(values)))
+        filters.append(pc.field(name).isin(pa.array(values, type=value_type)))
+
+    metadata = parquet.metadata
+    keep = [i for i in range(metadata.num_row_groups) if row_group_matches(metadata.row_group(i), conditions)]
+    read_columns = None
+    if columns is not None:
+        read_columns = list(dict.fromkeys(list(columns) + ([date_range[0]] if date_range else []) + list(where)))
+    table = parquet.read_row_groups(keep, columns=read_columns) if keep else schema.empty_table()
+    if filters and table.num_rows:
+        expression = filters[0]
+        for f in filters[1:]:
+            expression = expression & f
+        table = table.filter(expression)
+    if columns is not None:
+        table = table.select(list(columns))
+
+    stats = {
+        "row_groups": metadata.num_row_groups,
+        "row_groups_read": len(keep),
+        "rows": metadata.num_rows,
+        "rows_read": sum(metadata.row_group(i).num_rows for i in keep),
+        "rows_matched": table.num_rows,
+    }
+    return table, stats
+
+
+def read_doses(path, start=None, end=None, region=None, vax_type=None, columns=None):
+    # doses of the parquet long table in a date range, optionally in some regions / products
+    where = {}
+    if region is not None:
+        where["region"] = list(region)
+    if vax_type is not None:
+        where["vax_type"] = list(vax_type)
+    return read_filtered(path, columns=columns, date_range=("vax_date", start, end), where=where)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write date-clustered parquet copies of the extracts")
+    parser.add_argument("--fixed", default=str(ROOT / "output" / "extracts" / "extract_fixed.arrow"))
+    parser.add_argument("--varying", default=str(ROOT / "output" / "extracts" / "extract_varying.arrow"))
+    parser.add_argument("--row-group-size", type=int, default=ROW_GROUP_SIZE)
+    parser.add_argument("--output-dir", default=str(ROOT / "output" / "parquet"))
+    args = parser.parse_args(argv)
+
+    output_dir = Path(args.output_dir)
+    varying = schema_registry.read_extract(args.varying, schema_registry.varying)
+    fixed = schema_registry.read_extract(args.fixed, schema_registry.fixed)
+    outputs = [
+        (dose_table.wide_to_long(varying), "doses.parquet", "vax_date"),
+        (varying, "extract_varying.parquet", schema_registry.varying.slot_name("covid_vax_{i}_date", 1)),
+        (fixed, "extract_fixed.parquet", "region"),
+    ]
+    for table, name, cluster_by in outputs:
+        path = write_clustered(table, output_dir / name, cluster_by, args.row_group_size)
+        n_row_groups = pq.ParquetFile(path).metadata.num_row_groups
+        print(f"wrote {path}: {table.num_rows} rows in {n_row_groups} row groups, clustered by {cluster_by}",
+              file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
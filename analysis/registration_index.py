@@ -0,0 +1,168 @@
+##########################
+# per-patient index of practice registration periods
+##########################
+
+# This script:
+# indexes registration periods (one row per patient per practice registration) by
+# patient and start date, so that the registration active on any number of dates can be
+# found in one vectorised sorted search, rather than one range join per vaccination slot
+# as in the dataset definitions (`practice_registrations.for_patient_on(current_vax.date)`
+# for each of the `_{i}` slots).
+#
+# The rules follow ehrql's `for_patient_on(date)`: a registration is active on a date if
+# it started on or before it and didn't end before it (or hasn't ended); if several are
+# active, they are ordered by start_date, end_date (missing end dates first) and
+# practice_pseudo_id, and the last is used.
+#
+#   index = RegistrationIndex.from_table(registrations)
+#   long = resolve_doses(dose_table.read_long(path), index)
+#   # -> long table with registered, deregistered_date, practice_pseudo_id, region, stp
+#   #    as at each vaccination date
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import dose_table
+
+
+# registration table column -> long table column
+ATTRIBUTES = {
+    "practice_pseudo_id": "practice_pseudo_id",
+    "practice_nuts1_region_name": "region",
+    "practice_stp": "stp",
+}
+
+# stands in for a missing end date (still registered)
+OPEN_END = np.iinfo(np.int32).max
+
+
+class RegistrationIndex:
+
+    def __init__(self, patient_id, offsets, start, end, attributes):
+        # patient_id: sorted unique ids, length P
+        # offsets: int64, length P+1, registrations of patient p are rows offsets[p]:offsets[p+1]
+        # start, end: int64 days since epoch, in order of preference (start, then end with
+        # open registrations first, then practice) within each patient
+        # attributes: arrow table of per-registration columns, in the same row order
+        self.patient_id = np.asarray(patient_id)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.start = np.asarray(start, dtype=np.int64)
+        self.end = np.asarray(end, dtype=np.int64)
+        self.attributes = attributes
+
+        # latest end date of each patient's registrations so far, to tell when there's no
+        # point searching further back for an active registration
+        segment = self.segment()
+        span = int(OPEN_END) + 1
+        self.running_end = np.maximum.accumulate(self.end + segment * span) - segment * span
+
+        self._lowest = int(self.start.min(initial=0))
+        self._span = int(OPEN_END) - self._lowest + 2
+
+    @classmethod
+    def from_table(cls, registrations, attributes=ATTRIBUTES):
+        # from a table with patient_id, start_date, end_date and the registration attributes
+        # as ehrql, open registrations come before closed ones with the same start
+        keys = {
+            "patient_id": registrations.column("patient_id"),
+            "start_date": registrations.column("start_date"),
+            "end_date": registrations.column("end_date").cast(pa.int32()).fill_null(np.iinfo(np.int32).min),
+        }
+        if "practice_pseudo_id" in registrations.column_names:
+            keys["practice_pseudo_id"] = registrations.column("practice_pseudo_id")
+        order = pc.sort_indices(pa.table(keys), sort_keys=[(name, "ascending") for name in keys])
+        registrations = registrations.take(order)
+
+        patient_id = registrations.column("patient_id").to_numpy()
+        starts = np.flatnonzero(dose_table.patient_starts(patient_id))
+        offsets = np.append(starts, len(patient_id)).astype(np.int64)
+
+        start = dose_table.to_days(registrations.column("start_date"))
+        end = registrations.column("end_date").combine_chunks().cast(pa.int32()).fill_null(int(OPEN_END))
+        end = end.to_numpy(zero_copy_only=False)
+        columns = registrations.select([c for c in attributes if c in registrations.column_names])
+        return cls(patient_id[starts], offsets, start, end, columns.combine_chunks())
+
+    def __len__(self):
+        return len(self.patient_id)
+
+    @property
+    def n_registrations(self):
+        return len(self.start)
+
+    def segment(self):
+        # patient number of each registration
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.offsets))
+
+    def lookup(self, patient_id, dates):
+        # row of the registration active on each (patient_id, date), or -1 if there is none;
+        # patient_id and dates are equal-length arrays, dates as days since epoch
+        patient_id = np.asarray(patient_id)
+        dates = np.asarray(dates, dtype=np.int64)
+        result = np.full(len(dates), -1, dtype=np.int64)
+        if self.n_registrations == 0:
+            return result
+
+        p = np.minimum(np.searchsorted(self.patient_id, patient_id), len(self) - 1)
+        known = self.patient_id[p] == patient_id
+
+        # last registration of the patient starting on or before the date: one search over
+        # all patients at once, by offsetting each patient's start dates into its own range
+        keys = self.segment() * self._span + (self.start - self._lowest)
+        query = p * self._span + (np.clip(dates, self._lowest, None) - self._lowest)
+        row = np.searchsorted(keys, query, side="right") - 1
+        first = self.offsets[p]
+        row = np.where(known & (row >= first) & (dates >= self._lowest), row, -1)
+
+        # overlapping registrations: if the candidate ended before the date, an earlier one
+        # may still be active; step back only while an earlier registration ends on or after
+        # the date
+        pending = np.flatnonzero(row >= 0)
+        while len(pending):
+            r = row[pending]
+            active = self.end[r] >= dates[pending]
+            result[pending[active]] = r[active]
+            # the running end includes the candidate itself, so anything before the date rules
+            # out every earlier registration of the patient too
+            retry = ~active & (r > first[pending]) & (self.running_end[r] >= dates[pending])
+            pending = pending[retry]
+            row[pending] -= 1
+        return result
+
+    def take(self, rows, column):
+        # attribute of each matched registration, null where there was none
+        matched = rows >= 0
+        if self.n_registrations == 0:
+            return pa.nulls(len(rows), self.attributes.schema.field(column).type)
+        values = self.attributes.column(column).take(pa.array(np.where(matched, rows, 0)))
+        return pc.if_else(pa.array(~matched), pa.scalar(None, values.type), values)
+
+    def end_date(self, rows):
+        # end date of each matched registration, null where there was none or it hasn't ended
+        end = np.full(len(rows), OPEN_END, dtype=np.int64)
+        matched = rows >= 0
+        end[matched] = self.end[rows[matched]]
+        return pa.array(end.astype(np.int32), mask=end == OPEN_END).cast(pa.date32())
+
+
+def resolve_doses(long, index, attributes=ATTRIBUTES):
+    # registration columns as at each dose of a long vaccination table (see dose_table.py),
+    # replacing any already there
+    rows = index.lookup(long.column("patient_id").to_numpy(), dose_table.to_days(long.column("vax_date")))
+    resolved = {
+        "registered": pa.array(rows >= 0),
+        "deregistered_date": index.end_date(rows),
+    }
+    for column, name in attributes.items():
+        if column in index.attributes.column_names:
+            resolved[name] = index.take(rows, column)
+
+    for name, values in resolved.items():
+        if name in long.column_names:
+            if pa.types.is_dictionary(long.schema.field(name).type):
+                values = values.dictionary_encode()
+            long = long.set_column(long.schema.get_field_index(name), name, values)
+        else:
+            long = long.append_column(name, values)
+    return long
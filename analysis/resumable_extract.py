@@ -0,0 +1,206 @@
+##########################
+# checkpointed extraction in patient_id ranges, resumable after a failure
+##########################
+
+# This script:
+# runs a local_engine.py definition over the population in chunks of patient_id ranges,
+# committing each chunk to a checkpoint directory as it finishes, so that a run that fails
+# late (timeout, out of memory, a killed process) carries on from where it stopped rather
+# than from zero.
+#
+#  - the chunk boundaries split the patients into about equal parts, and together with a
+#    fingerprint of the definition's statements they are fixed in the manifest by the
+#    first run; each chunk covers low < patient_id <= high, and the first and last are
+#    open-ended, so every patient is in exactly one chunk
+#  - a chunk is evaluated on the source tables restricted to its range
+#    (`Engine.restrict_range()`), written under a temporary name and renamed, and only
+#    then recorded as done in the manifest (with its rows and a sha256 of the file), which
+#    is itself replaced atomically; a chunk interrupted at any point is simply redone
+#  - a rerun checks the fingerprint, skips the chunks that are done and whose files still
+#    match their hashes, and runs the rest
+#  - once every chunk is done, the chunks are concatenated in patient_id order into the
+#    output (sorted_extract.py format), so the result doesn't depend on how many runs it
+#    took
+#
+# A manifest for a different definition, sample or number of chunks is an error unless
+# `--restart` is given. Changes to the database between runs are not detected.
+#
+# usage:
+#   python analysis/resumable_extract.py --definition snapshot --database db.sqlite [--chunks 20]
+#       [--checkpoint-dir output/checkpoints/snapshot] [--output output/local/extract_snapshot.arrow] [--restart]
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+import arrow_io
+import hashing
+import local_engine
+import sorted_extract
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+MANIFEST = "manifest.json"
+N_CHUNKS = 20
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_json(path, data):
+    # replace a json file atomically
+    path = Path(path)
+    temporary = path.with_name("_" + path.name)
+    temporary.write_text(json.dumps(data, indent=2))
+    os.replace(temporary, path)
+
+
+def fingerprint(engine, definition, n_chunks):
+    # what the chunks depend on: the statements, the sample and the number of chunks
+    text = "\n".join(sql for _, _, sql in engine.plan(definition))
+    text += f"\n{engine.fraction}:{engine.seed}:{n_chunks}"
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def chunk_bounds(patient_id, n_chunks):
+    # [(low, high)] covering every patient_id, splitting the given ids into about equal parts
+    patient_id = np.unique(np.asarray(patient_id, dtype=np.int64))
+    parts = [part for part in np.array_split(patient_id, max(min(n_chunks, len(patient_id)), 1)) if len(part)]
+    highs = [int(part[-1]) for part in parts[:-1]] + [None]
+    lows = [None] + highs[:-1]
+    return list(zip(lows, highs))
+
+
+def new_manifest(engine, definition, n_chunks):
+    ids = [row[0] for row in engine.query("SELECT patient_id FROM patients")]
+    return {
+        "definition": definition.name,
+        "fingerprint": fingerprint(engine, definition, n_chunks),
+        "n_chunks": n_chunks,
+        "chunks": [
+            {"chunk": k, "low": low, "high": high, "done": False}
+            for k, (low, high) in enumerate(chunk_bounds(ids, n_chunks))
+        ],
+    }
+
+
+def chunk_path(directory, chunk):
+    return Path(directory) / f"chunk_{chunk['chunk']:05d}.arrow"
+
+
+def is_done(directory, chunk):
+    path = chunk_path(directory, chunk)
+    return chunk["done"] and path.exists() and file_sha256(path) == chunk["sha256"]
+
+
+def run_chunks(engine, definition, directory, n_chunks=N_CHUNKS, restart=False):
+    # run the chunks that aren't done; returns the manifest and stats
+    directory = Path(directory)
+    if restart and directory.exists():
+        shutil.rmtree(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    manifest_path = directory / MANIFEST
+
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest["fingerprint"] != fingerprint(engine, definition, n_chunks):
+            raise ValueError(
+                f"{manifest_path} is for a different definition, sample or number of chunks; "
+                "rerun with --restart to discard it"
+            )
+    else:
+        manifest = new_manifest(engine, definition, n_chunks)
+        write_json(manifest_path, manifest)
+
+    stats = {"chunks": len(manifest["chunks"]), "chunks_resumed": 0, "chunks_run": 0, "seconds": {}}
+    try:
+        for chunk in manifest["chunks"]:
+            if is_done(directory, chunk):
+                stats["chunks_resumed"] += 1
+                continue
+            start = time.perf_counter()
+            engine.restrict_range(chunk["low"], chunk["high"])
+            table, _ = engine.run(definition)
+            path = chunk_path(directory, chunk)
+            temporary = path.with_name("_" + path.name)
+            arrow_io.write_table(table, temporary)
+            os.replace(temporary, path)
+            chunk.update({"done": True, "rows": table.num_rows, "sha256": file_sha256(path)})
+            write_json(manifest_path, manifest)
+            stats["chunks_run"] += 1
+            stats["seconds"][chunk["chunk"]] = round(time.perf_counter() - start, 4)
+    finally:
+        engine.restrict_range()
+    return manifest, stats
+
+
+def stitch(directory, manifest, output):
+    # concatenate the finished chunks in order into the output
+    directory = Path(directory)
+    tables = []
+    for chunk in manifest["chunks"]:
+        if not is_done(directory, chunk):
+            raise ValueError(f"chunk {chunk['chunk']} of {directory} is not done")
+        tables.append(arrow_io.read_table(chunk_path(directory, chunk)))
+    # a column that is all null in one chunk takes its type from the others
+    table = pa.concat_tables(tables, promote_options="permissive")
+    sorted_extract.write_sorted(table, output)
+    return table
+
+
+def main(argv=None):
+    import local_definitions
+
+    parser = argparse.ArgumentParser(description="Run a definition in checkpointed patient_id chunks")
+    parser.add_argument("--definition", choices=sorted(local_definitions.DEFINITIONS), default="snapshot")
+    parser.add_argument("--database", required=True, help="SQLite file; created with dummy data if missing")
+    parser.add_argument("--patients", type=int, default=10000, help="number of dummy patients")
+    parser.add_argument("--sample", type=float, help="run on this fraction of patients (see sampling.py)")
+    parser.add_argument("--seed", type=int, default=hashing.DEFAULT_SEED, help="seed of the sampling hash")
+    parser.add_argument("--workers", type=int, default=1, help="statements to run at once")
+    parser.add_argument("--chunks", type=int, default=N_CHUNKS, help="number of patient_id ranges")
+    parser.add_argument("--checkpoint-dir", help="default: output/checkpoints/<definition>")
+    parser.add_argument("--output", help="default: output/local/extract_<definition>.arrow")
+    parser.add_argument("--restart", action="store_true", help="discard the checkpoints and start again")
+    args = parser.parse_args(argv)
+
+    directory = Path(args.checkpoint_dir or ROOT / "output" / "checkpoints" / args.definition)
+    output = Path(args.output or ROOT / "output" / "local" / f"extract_{args.definition}.arrow")
+
+    fresh = not Path(args.database).exists()
+    engine = local_engine.Engine(args.database, workers=args.workers)
+    if fresh:
+        local_engine.create_dummy_database(engine.connection, args.patients, event_codes=local_definitions.event_codes())
+    if args.sample is not None:
+        engine.sample(args.sample, args.seed)
+    definition = local_definitions.DEFINITIONS[args.definition]()
+
+    start = time.perf_counter()
+    try:
+        manifest, stats = run_chunks(engine, definition, directory, args.chunks, args.restart)
+    finally:
+        engine.close()
+    table = stitch(directory, manifest, output)
+    stats["rows"] = table.num_rows
+    stats["total_seconds"] = round(time.perf_counter() - start, 4)
+    print(json.dumps(stats, indent=2))
+    print(f"wrote {output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,405 @@
+##########################
+# run project.yaml actions locally, in parallel, skipping anything already up to date
+##########################
+
+# This script:
+# reads the actions and their `needs:` from project.yaml and runs them locally,
+# starting each action as soon as the actions it needs have finished, with at most
+# --workers actions running at once.
+# Each action is keyed by a hash of what it reads: its command, the script or definition
+# file it runs, the modules of analysis/ that file imports (followed through each
+# module's import-time imports, from the syntax tree) or the R scripts it sources, the
+# other files its command names (eg dummy data), the codelists for definitions, and the
+# outputs of the actions it needs.
+# Outputs are stored in a content-addressed cache under .local_cache/, so an action
+# whose key has been seen before is restored from the cache instead of being rerun.
+# For example, editing report.R only reruns `report`, not the two extractions.
+#
+# usage:
+#   python analysis/run_local.py                  # everything
+#   python analysis/run_local.py report           # report and whatever it needs
+#   python analysis/run_local.py --workers 1 --force extract_snapshot
+#   python analysis/run_local.py --dry-run        # show what would run
+#
+# By default R and python actions run with the local Rscript / python, and other
+# images (ehrql, cohortextractor) through `opensafely exec`; --docker runs everything
+# through `opensafely exec`.
+
+import argparse
+import ast
+import glob
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import yaml
+
+
+ROOT = Path(__file__).resolve().parent.parent
+CACHE_DIR = ROOT / ".local_cache"
+LOG_DIR = ROOT / "logs"
+
+# read by the R scripts (via utility.R) but not named in any command
+R_INPUTS = "lib/schema/*.json"
+
+# read by every dataset / study definition
+DEFINITION_INPUTS = ["codelists/*.csv", "codelists/codelists.txt"]
+DEFINITION_PREFIXES = ("dataset_definition", "study_definition")
+
+
+## reading project.yaml ----
+
+def load_actions(project_file=ROOT / "project.yaml"):
+    with open(project_file) as f:
+        project = yaml.safe_load(f)
+
+    actions = {}
+    for name, spec in project["actions"].items():
+        outputs = []
+        for files in (spec.get("outputs") or {}).values():
+            outputs.extend(files.values())
+        actions[name] = {
+            "name": name,
+            "run": " ".join(spec["run"].split()),
+            "needs": list(spec.get("needs") or []),
+            "outputs": outputs,
+        }
+
+    for action in actions.values():
+        for need in action["needs"]:
+            if need not in actions:
+                raise ValueError(f"{action['name']} needs unknown action {need}")
+    return actions
+
+
+def with_needs(actions, targets):
+    # targets plus everything they need, transitively
+    selected = set()
+    stack = list(targets)
+    while stack:
+        name = stack.pop()
+        if name not in actions:
+            raise ValueError(f"unknown action {name}")
+        if name not in selected:
+            selected.add(name)
+            stack.extend(actions[name]["needs"])
+    return selected
+
+
+def topological_order(actions, names):
+    order, done = [], set()
+
+    def visit(name, path):
+        if name in done:
+            return
+        if name in path:
+            raise ValueError("circular needs: " + " -> ".join(path + [name]))
+        for need in actions[name]["needs"]:
+            visit(need, path + [name])
+        done.add(name)
+        order.append(name)
+
+    for name in sorted(names):
+        visit(name, [])
+    return order
+
+
+## commands ----
+
+def local_command(action, docker=False):
+    image, *args = shlex.split(action["run"])
+    image_name = image.split(":")[0]
+
+    if not docker and image_name == "r":
+        return ["Rscript", *args]
+    if not docker and image_name == "python":
+        return [sys.executable, *args]
+    return ["opensafely", "exec", image, *args]
+
+
+## input discovery and hashing ----
+
+def python_imports(path, module_level=False):
+    # modules a python file imports, from its syntax tree; with module_level, only the
+    # imports run when the file itself is imported (not those inside functions)
+    tree = ast.parse(Path(path).read_text())
+    nodes = tree.body if module_level else ast.walk(tree)
+    modules = set()
+    for node in nodes:
+        if isinstance(node, ast.Import):
+            modules.update(alias.name.split(".")[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules.add(node.module.split(".")[0])
+    return modules
+
+
+def python_inputs(script):
+    # a python script and the modules of analysis/ it imports: all of the script's own
+    # imports, and then the module-level imports of each module, transitively
+    found = set()
+    pending = [(Path(script), False)]
+    while pending:
+        path, module_level = pending.pop()
+        if path in found:
+            continue
+        found.add(path)
+        for module in python_imports(path, module_level):
+            candidate = path.parent / f"{module}.py"
+            if candidate.is_file():
+                pending.append((candidate, True))
+    return found
+
+
+def r_inputs(script):
+    # an R script and the R scripts it sources (R has no imports to follow, so these are
+    # found by name)
+    found = set()
+    pending = [Path(script)]
+    while pending:
+        path = pending.pop()
+        if path in found:
+            continue
+        found.add(path)
+        text = re.sub(r"#[^\n]*", "", path.read_text(errors="ignore"))
+        for name in re.findall(r"([\w.-]+\.R)\b", text):
+            candidate = next((p for p in (ROOT / "analysis").rglob(name) if p.is_file()), None)
+            if candidate is not None:
+                pending.append(candidate)
+    return found
+
+
+def action_inputs(action):
+    # the files an action's key is built from: the script or definition it runs, with its
+    # python imports or sourced R scripts, the other existing files its command names
+    # (eg dummy data) and, for definitions, the codelists; the outputs of the actions it
+    # needs are added to the key from their manifests
+    args = shlex.split(action["run"])[1:]
+    # cohortextractor names its study definition without a path or suffix, and
+    # `r -e 'rmarkdown::render("....Rmd")'` names its script inside an R expression
+    if "--study-definition" in args:
+        args.append(f"analysis/{args[args.index('--study-definition') + 1]}.py")
+    args += re.findall(r"[\"']([\w./-]+\.Rmd?)[\"']", action["run"])
+
+    inputs = set()
+    for arg in args:
+        path = ROOT / arg
+        if not arg or not path.is_file() or path.is_relative_to(ROOT / "output"):
+            continue
+        if path.suffix == ".py":
+            inputs.update(python_inputs(path))
+        elif path.suffix in (".R", ".Rmd"):
+            inputs.update(r_inputs(path))
+        else:
+            inputs.add(path)
+
+    # utility.R reads the column types from the registry's json
+    if any(p.name == "utility.R" for p in inputs):
+        inputs.update(Path(p) for p in glob.glob(str(ROOT / R_INPUTS)))
+    if any(p.name.startswith(DEFINITION_PREFIXES) for p in inputs):
+        for pattern in DEFINITION_INPUTS:
+            inputs.update(Path(p) for p in glob.glob(str(ROOT / pattern)))
+    return sorted(inputs)
+
+
+def file_hash(path, chunk_size=2**20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def action_key(action, input_hashes, need_manifests):
+    h = hashlib.sha256()
+    h.update(action["run"].encode())
+    for path, digest in sorted(input_hashes.items()):
+        h.update(f"{path}={digest}\n".encode())
+    for need in sorted(need_manifests):
+        h.update(f"{need}:{json.dumps(need_manifests[need]['outputs'], sort_keys=True)}\n".encode())
+    return h.hexdigest()
+
+
+## content-addressed cache ----
+
+class Cache:
+
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = Path(directory)
+        self.objects = self.directory / "objects"
+        self.manifests = self.directory / "actions"
+        self._lock = threading.Lock()
+
+    def manifest_path(self, action_name, key):
+        return self.manifests / action_name / f"{key}.json"
+
+    def lookup(self, action_name, key):
+        path = self.manifest_path(action_name, key)
+        if not path.exists():
+            return None
+        with open(path) as f:
+            manifest = json.load(f)
+        if not all((self.objects / digest).exists() for digest in manifest["outputs"].values()):
+            return None
+        return manifest
+
+    def restore(self, manifest):
+        for relpath, digest in manifest["outputs"].items():
+            target = ROOT / relpath
+            if target.exists() and file_hash(target) == digest:
+                continue
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(self.objects / digest, target)
+
+    def store(self, action, key, inputs):
+        outputs = {}
+        for pattern in action["outputs"]:
+            for path in sorted(glob.glob(str(ROOT / pattern))):
+                digest = file_hash(path)
+                obj = self.objects / digest
+                with self._lock:
+                    if not obj.exists():
+                        obj.parent.mkdir(parents=True, exist_ok=True)
+                        tmp = obj.with_suffix(f".tmp{threading.get_ident()}")
+                        shutil.copyfile(path, tmp)
+                        os.replace(tmp, obj)
+                outputs[str(Path(path).relative_to(ROOT))] = digest
+
+        manifest = {
+            "action": action["name"],
+            "key": key,
+            "run": action["run"],
+            "inputs": inputs,
+            "outputs": outputs,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        path = self.manifest_path(action["name"], key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        return manifest
+
+
+## running ----
+
+def run_action(action, command, log_dir=LOG_DIR):
+    log_dir.mkdir(parents=True, exist_ok=True)
+    with open(log_dir / f"local_{action['name']}.log", "w") as log:
+        log.write(f"$ {shlex.join(command)}\n")
+        log.flush()
+        result = subprocess.run(command, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+    return result.returncode
+
+
+def run(actions, targets=None, workers=2, force=(), docker=False, profile=False, dry_run=False, cache=None):
+    cache = cache or Cache()
+    names = with_needs(actions, targets or list(actions))
+    order = topological_order(actions, names)
+
+    manifests = {}
+    status = {}
+    lock = threading.Lock()
+
+    def prepare(name):
+        # hash inputs once all needed actions have produced their manifests
+        action = actions[name]
+        inputs = {str(p.relative_to(ROOT)): file_hash(p) for p in action_inputs(action)}
+        key = action_key(action, inputs, {n: manifests[n] for n in action["needs"]})
+        return inputs, key
+
+    def execute(name):
+        action = actions[name]
+        inputs, key = prepare(name)
+
+        cached = None if (name in force or "all" in force) else cache.lookup(name, key)
+        if cached is not None:
+            if not dry_run:
+                cache.restore(cached)
+            return name, "cached", cached
+
+        if dry_run:
+            # pretend the outputs are unchanged so that dependents can be keyed
+            return name, "would run", {"outputs": {"pending": key}}
+
+        command = local_command(action, docker=docker)
+        if profile:
+            # credit the action with its declared outputs, not whatever else changed meanwhile
+            outputs = [arg for pattern in action["outputs"] for arg in ("--outputs", pattern)]
+            command = [sys.executable, str(ROOT / "analysis" / "memory_profile.py"), "--action", name, *outputs, "--", *command]
+
+        started = time.monotonic()
+        returncode = run_action(action, command)
+        if returncode != 0:
+            return name, f"failed ({returncode})", None
+        manifest = cache.store(action, key, inputs)
+        return name, f"ran in {time.monotonic() - started:.1f}s", manifest
+
+    pending = set(order)
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            for name in sorted(pending):
+                needs = actions[name]["needs"]
+                if any(status.get(n, "").startswith(("failed", "skipped")) for n in needs):
+                    status[name] = "skipped (a needed action failed)"
+                    pending.discard(name)
+                elif all(n in manifests for n in needs):
+                    running[pool.submit(execute, name)] = name
+                    pending.discard(name)
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                name, outcome, manifest = future.result()
+                with lock:
+                    status[name] = outcome
+                    if manifest is not None:
+                        manifests[name] = manifest
+                print(f"{name}: {outcome}", file=sys.stderr)
+
+    for name in order:
+        if status[name].startswith("skipped"):
+            print(f"{name}: {status[name]}", file=sys.stderr)
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run project.yaml actions locally with caching")
+    parser.add_argument("actions", nargs="*", help="actions to run (default: all), along with whatever they need")
+    parser.add_argument("--workers", type=int, default=2, help="maximum number of actions to run at once")
+    parser.add_argument("--force", action="append", default=[], metavar="ACTION",
+                        help="rerun this action even if cached; 'all' reruns everything")
+    parser.add_argument("--docker", action="store_true", help="run every action through `opensafely exec`")
+    parser.add_argument("--profile", action="store_true",
+                        help="record memory use of each action in logs/ (see memory_profile.py)")
+    parser.add_argument("--dry-run", action="store_true", help="report what would run without running it")
+    parser.add_argument("--cache-dir", default=str(CACHE_DIR))
+    args = parser.parse_args(argv)
+
+    status = run(
+        load_actions(),
+        targets=args.actions or None,
+        workers=args.workers,
+        force=set(args.force),
+        docker=args.docker,
+        profile=args.profile,
+        dry_run=args.dry_run,
+        cache=Cache(args.cache_dir),
+    )
+    failed = [name for name, outcome in status.items() if outcome.startswith(("failed", "skipped"))]
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+##########################
+# stable, stratified subsample of patients for development runs
+##########################
+
+# This script:
+# restricts extracts to a fixed fraction of patients, so that the downstream actions can
+# be iterated on in minutes rather than hours while still giving representative outputs.
+#
+# A patient is in the sample if a hash of their patient_id (splitmix64, with a seed; see
+# hashing.py)
+# falls below the sampling fraction. The hash doesn't depend on anything else, so:
+#  - the same patients are sampled on every run, and in every extract
+#  - the sample for a smaller fraction is contained in the sample for a larger one
+# Sampling is stratified by region and age band: every stratum keeps at least
+# `min_per_stratum` patients (the ones with the smallest hashes), and each sampled
+# patient gets `sample_weight` = patients in the stratum / patients sampled from it, so
+# that weighted counts add up to the full population in every stratum. dose_coverage.py,
+# dose_qa.py and campaigns.py weight their counts by sample_weight when it is present.
+#
+# The backend query languages can't hash patient_id, so sampling is applied to the
+# extracts here, and to the source tables in local_engine.py (`--sample`).
+#
+# This is a development tool, not a project.yaml action: run it locally after the
+# extractions and point the downstream scripts' --fixed / --varying / --input at the
+# sampled extracts.
+#
+# usage:
+#   python analysis/sampling.py --fraction 0.05 [--seed 0]
+#   # -> output/sample/extract_fixed.arrow and extract_varying.arrow, with sample_weight,
+#   #    sorted by patient_id with their indexes (see sorted_extract.py)
+#   python analysis/dose_coverage.py --fixed output/sample/extract_fixed.arrow \
+#     --varying output/sample/extract_varying.arrow
+
+import argparse
+import csv
+import sys
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+import dose_coverage
+import dose_qa
+import hashing
+import schema_registry
+import sorted_extract
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+DEFAULT_SEED = hashing.DEFAULT_SEED
+MIN_PER_STRATUM = 10
+
+
+def strata(region, age):
+    # (codes, labels) for region x ageband, with missing region or age as their own level
+    region_codes, region_levels = dose_coverage.level_codes(region)
+    age_codes = dose_coverage.ageband_codes(age)
+    region_levels = region_levels + ["missing"]
+    age_levels = dose_coverage.AGEBAND_LABELS + ["missing"]
+    region_codes = np.where(region_codes < 0, len(region_levels) - 1, region_codes)
+    age_codes = np.where(age_codes < 0, len(age_levels) - 1, age_codes)
+    codes = region_codes * len(age_levels) + age_codes
+    labels = [(r, a) for r in region_levels for a in age_levels]
+    return codes, labels
+
+
+def sample(patient_id, stratum, fraction, seed=DEFAULT_SEED, min_per_stratum=MIN_PER_STRATUM):
+    # (selected mask, weight per selected patient)
+    patient_id = np.asarray(patient_id)
+    stratum = np.asarray(stratum, dtype=np.int64)
+    u = hashing.hash_unit(patient_id, seed)
+    selected = u < fraction
+
+    if min_per_stratum:
+        # rank of each patient's hash within their stratum
+        order = np.lexsort((u, stratum))
+        sorted_stratum = stratum[order]
+        starts = np.ones(len(order), dtype=bool)
+        starts[1:] = sorted_stratum[1:] != sorted_stratum[:-1]
+        position = np.arange(len(order))
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = position - np.maximum.accumulate(np.where(starts, position, 0))
+        selected |= rank < min_per_stratum
+
+    n_strata = int(stratum.max()) + 1 if len(stratum) else 0
+    population = np.bincount(stratum, minlength=n_strata)
+    sampled = np.bincount(stratum[selected], minlength=n_strata)
+    weight = population / np.maximum(sampled, 1)
+    return selected, weight[stratum[selected]]
+
+
+def sample_table(table, fraction, seed=DEFAULT_SEED, min_per_stratum=MIN_PER_STRATUM, region="region", age="age"):
+    # sampled rows of a one-row-per-patient table, with a sample_weight column; also
+    # returns the stratum codes and labels, and the selection mask
+    codes, labels = strata(table.column(region), table.column(age))
+    selected, weight = sample(table.column("patient_id").to_numpy(), codes, fraction, seed, min_per_stratum)
+    sampled = table.filter(pa.array(selected))
+    if schema_registry.SAMPLE_WEIGHT in sampled.column_names:
+        sampled = sampled.drop_columns([schema_registry.SAMPLE_WEIGHT])
+    return sampled.append_column(schema_registry.SAMPLE_WEIGHT, pa.array(weight)), codes, labels, selected
+
+
+def restrict(table, patient_id, weight):
+    # (mask, weight) of the rows of another extract that belong to sampled patients
+    if len(patient_id) == 0:
+        return np.zeros(table.num_rows, dtype=bool), np.full(table.num_rows, np.nan)
+    order = np.argsort(patient_id)
+    patient_id, weight = np.asarray(patient_id)[order], np.asarray(weight)[order]
+    ids = table.column("patient_id").to_numpy()
+    position = np.searchsorted(patient_id, ids)
+    found = position < len(patient_id)
+    found[found] = patient_id[position[found]] == ids[found]
+    return found, np.where(found, weight[np.minimum(position, len(patient_id) - 1)], np.nan)
+
+
+def sample_varying(varying, fixed_sample, fraction, seed=DEFAULT_SEED):
+    # the varying extract restricted to the patients sampled from the fixed extract;
+    # vaccinated patients who aren't in the fixed extract are kept if their hash is below
+    # the fraction, with weight 1 / fraction
+    found, weight = restrict(
+        varying,
+        fixed_sample.column("patient_id").to_numpy(),
+        fixed_sample.column(schema_registry.SAMPLE_WEIGHT).to_numpy(),
+    )
+    # (anyone in the fixed extract with a hash below the fraction is in its sample, so
+    # these are only patients missing from the fixed extract)
+    outside = ~found & (hashing.hash_unit(varying.column("patient_id").to_numpy(), seed) < fraction)
+    keep = found | outside
+    weight = np.where(found, weight, 1 / fraction)
+    sampled = varying.filter(pa.array(keep))
+    if schema_registry.SAMPLE_WEIGHT in sampled.column_names:
+        sampled = sampled.drop_columns([schema_registry.SAMPLE_WEIGHT])
+    return sampled.append_column(schema_registry.SAMPLE_WEIGHT, pa.array(weight[keep]))
+
+
+def write_strata(path, codes, labels, selected_codes, rounding=6):
+    # patients in and sampled from each stratum
+    n_strata = len(labels)
+    population = np.bincount(codes, minlength=n_strata)
+    sampled = np.bincount(selected_codes, minlength=n_strata)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["region", "ageband", "n_population", "n_sampled", "sample_weight"])
+        for k, (region, ageband) in enumerate(labels):
+            if population[k]:
+                n_population = int(dose_qa.roundmid_any(population[k], rounding))
+                n_sampled = int(dose_qa.roundmid_any(sampled[k], rounding))
+                # from the rounded counts, so the weight doesn't undo the rounding
+                writer.writerow([region, ageband, n_population, n_sampled, round(n_population / max(n_sampled, 1), 3)])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stable stratified subsample of the extracts")
+    parser.add_argument("--fixed", default=str(ROOT / "output" / "extracts" / "extract_fixed.arrow"))
+    parser.add_argument("--varying", default=str(ROOT / "output" / "extracts" / "extract_varying.arrow"))
+    parser.add_argument("--fraction", type=float, required=True, help="expected fraction of patients to keep")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--min-per-stratum", type=int, default=MIN_PER_STRATUM)
+    parser.add_argument("--output-dir", default=str(ROOT / "output" / "sample"))
+    args = parser.parse_args(argv)
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    fixed = schema_registry.read_extract(args.fixed, schema_registry.fixed)
+    fixed_sample, codes, labels, selected = sample_table(fixed, args.fraction, args.seed, args.min_per_stratum)
+    sorted_extract.write_sorted(fixed_sample, output_dir / "extract_fixed.arrow")
+
+    varying = schema_registry.read_extract(args.varying, schema_registry.varying)
+    varying_sample = sample_varying(varying, fixed_sample, args.fraction, args.seed)
+    sorted_extract.write_sorted(varying_sample, output_dir / "extract_varying.arrow")
+
+    write_strata(output_dir / "sample_strata.csv", codes, labels, codes[selected])
+    print(
+        f"sampled {fixed_sample.num_rows} of {fixed.num_rows} patients from the fixed extract and "
+        f"{varying_sample.num_rows} of {varying.num_rows} from the varying extract into {output_dir}",
+        file=sys.stderr,
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,456 @@
+##########################
+# single declaration of the columns in each extract
+##########################
+
+# This script:
+# declares the columns of the fixed, varying and snapshot extracts once, with their
+# arrow types, whether they are dictionary-encoded, and which of them are repeated
+# per vaccination as `_{i}` slots.
+# Everything that writes, simulates or reads an extract takes its column names and
+# types from here:
+#  - the dataset definitions check their variables against it
+#  - `dummy_table()` simulates typed dummy data
+#  - `read_extract()` reads an extract with explicit types (no type inference)
+#  - the R scripts read the json exported to lib/schema/ (see `registry_col_types()`
+#    in utility.R)
+# The number of slots declared here is a default: once dose_slots.py has counted the
+# doses actually recorded, `slot_count()` returns the number it chose instead.
+#
+# After changing a schema here, regenerate the json with:
+#   python analysis/schema_registry.py
+
+import argparse
+import json
+import re
+import sys
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+
+ROOT = Path(__file__).resolve().parent.parent
+SCHEMA_DIR = ROOT / "lib" / "schema"
+# written by dose_slots.py
+DOSE_SLOTS_PATH = ROOT / "output" / "dose_slots" / "dose_slots.json"
+
+# placeholder for the vaccination number in repeated column names
+SLOT = "{i}"
+
+# weight of each patient in a sampled extract (see sampling.py); not declared in any
+# dataset, but kept by the readers whenever an extract has it
+SAMPLE_WEIGHT = "sample_weight"
+
+
+## column declarations ----
+
+class Column:
+
+    def __init__(self, name, type, dictionary=False, levels=None, r_col_type=None):
+        self.name = name
+        self.type = type
+        # dictionary-encoded string columns, with their known levels if any
+        self.dictionary = dictionary
+        self.levels = levels
+        # readr column type; derived from the arrow type unless given
+        self.r_col_type = r_col_type or _r_col_type(type)
+
+    @property
+    def arrow_type(self):
+        if self.dictionary:
+            return pa.dictionary(pa.int32(), self.type)
+        return self.type
+
+    @property
+    def repeated(self):
+        return SLOT in self.name
+
+    def slot_name(self, i):
+        return self.name.replace(SLOT, str(i))
+
+    def slot_regex(self):
+        # matches the expanded column names and captures the slot number
+        return "^" + re.escape(self.name).replace(re.escape(SLOT), r"(\d+)") + "$"
+
+
+def _r_col_type(arrow_type):
+    # single-letter readr codes, as accepted by readr::cols(.default=) and readr::as.col_spec()
+    if pa.types.is_boolean(arrow_type):
+        return "l"
+    if pa.types.is_integer(arrow_type):
+        return "i"
+    if pa.types.is_floating(arrow_type):
+        return "n"
+    if pa.types.is_date(arrow_type):
+        return "D"
+    return "c"
+
+
+class DatasetSchema:
+
+    def __init__(self, name, columns, n_slots=0):
+        self.name = name
+        self.columns = columns
+        # default number of `_{i}` slots extracted for the repeated columns
+        self.n_slots = n_slots
+
+    @property
+    def fixed_columns(self):
+        return [c for c in self.columns if not c.repeated]
+
+    @property
+    def repeated_columns(self):
+        return [c for c in self.columns if c.repeated]
+
+    @property
+    def slot_patterns(self):
+        return [c.name for c in self.repeated_columns]
+
+    def expand(self, n_slots=None):
+        # concrete columns, in output order: fixed columns then each slot in turn
+        n_slots = self.n_slots if n_slots is None else n_slots
+        expanded = [(c.name, c) for c in self.fixed_columns]
+        for i in range(1, n_slots + 1):
+            expanded.extend((c.slot_name(i), c) for c in self.repeated_columns)
+        return expanded
+
+    def column_names(self, n_slots=None):
+        return [name for name, _ in self.expand(n_slots)]
+
+    def arrow_schema(self, n_slots=None):
+        return pa.schema(
+            [pa.field(name, c.arrow_type) for name, c in self.expand(n_slots)],
+            metadata={"dataset": self.name, "n_slots": str(self.n_slots if n_slots is None else n_slots)},
+        )
+
+    def column(self, name):
+        # declaration for a concrete (possibly expanded) column name
+        for c in self.columns:
+            if c.name == name or (c.repeated and re.match(c.slot_regex(), name)):
+                return c
+        raise KeyError(f"{name} is not a column of the {self.name} dataset")
+
+    def slot_name(self, pattern, i):
+        if pattern not in self.slot_patterns:
+            raise KeyError(f"{pattern} is not a repeated column of the {self.name} dataset")
+        return pattern.replace(SLOT, str(i))
+
+    def n_slots_in(self, names):
+        # highest slot number present in a list of column names
+        slots = [0]
+        for c in self.repeated_columns:
+            regex = re.compile(c.slot_regex())
+            slots.extend(int(m.group(1)) for m in map(regex.match, names) if m)
+        return max(slots)
+
+    def check_variables(self, names, repeated=False):
+        # raise if a definition's variables have drifted from the declared columns
+        declared = self.slot_patterns if repeated else [c.name for c in self.fixed_columns]
+        missing = [n for n in declared if n not in names]
+        extra = [n for n in names if n not in declared]
+        if missing or extra:
+            raise ValueError(
+                f"variables don't match the {self.name} schema: "
+                f"missing {', '.join(missing) or 'none'}; undeclared {', '.join(extra) or 'none'}"
+            )
+
+    def to_json(self):
+        return {
+            "dataset": self.name,
+            "n_slots": self.n_slots,
+            "columns": [
+                {
+                    "name": c.name,
+                    "type": str(c.type),
+                    "dictionary": c.dictionary,
+                    "levels": c.levels,
+                    "r_col_type": c.r_col_type,
+                    "repeated": c.repeated,
+                    "regex": c.slot_regex() if c.repeated else None,
+                }
+                for c in self.columns
+            ],
+        }
+
+
+## known levels ----
+
+# nuts1 region names as returned by the tpp backend
+REGIONS = [
+    "North East",
+    "North West",
+    "Yorkshire and The Humber",
+    "East Midlands",
+    "West Midlands",
+    "East",
+    "London",
+    "South East",
+    "South West",
+]
+
+# short name -> product name; keep in sync with `vax_product_lookup` in utility.R
+VAX_PRODUCTS = {
+    "pfizer": "COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)",
+    "az": "COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)",
+    "moderna": "COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)",
+    "pfizerBA1": "Comirnaty Original/Omicron BA.1 COVID-19 Vacc md vials",
+    "pfizerBA45": "Comirnaty Original/Omicron BA.4-5 COVID-19 Vacc md vials",
+    "pfizerXBB15": "Comirnaty Omicron XBB.1.5 COVID-19 Vacc md vials",
+    "vidprevtyn": "COVID-19 Vacc VidPrevtyn (B.1.351) 0.5ml inj multidose vials",
+    "modernaomicron": "COVID-19 Vac Spikevax (Zero)/(Omicron) inj md vials",
+    "pfizerchildren": "COVID-19 mRNA Vaccine Comirnaty Children 5-11yrs 10mcg/0.2ml dose conc for disp for inj MDV (Pfizer)",
+    "azhalf": "COVID-19 Vac AZD2816 (ChAdOx1 nCOV-19) 3.5x10*9 viral part/0.5ml dose sol for inj MDV (AstraZeneca)",
+    "modernaXBB15": "COVID-19 Vacc Spikevax (XBB.1.5) 0.1mg/1ml inj md vials",
+}
+
+
+## datasets ----
+
+fixed = DatasetSchema("fixed", [
+    Column("patient_id", pa.int64()),
+    Column("sex", pa.string(), dictionary=True, levels=["female", "male", "intersex", "unknown"]),
+    Column("age", pa.int32()),
+    Column("registered", pa.bool_()),
+    Column("region", pa.string(), dictionary=True, levels=REGIONS),
+    Column("stp", pa.string(), dictionary=True),
+    Column("death_date", pa.date32()),
+])
+
+varying = DatasetSchema("varying", [
+    Column("patient_id", pa.int64()),
+    Column("covid_vax_{i}_date", pa.date32()),
+    Column("covid_vax_type_{i}", pa.string(), dictionary=True, levels=list(VAX_PRODUCTS.values())),
+    Column("age_{i}", pa.int32()),
+    Column("registered_{i}", pa.bool_()),
+    Column("deregistered_{i}_date", pa.date32()),
+    Column("region_{i}", pa.string(), dictionary=True, levels=REGIONS),
+    Column("stp_{i}", pa.string(), dictionary=True),
+], n_slots=10)
+
+# the columns of the snapshot extract used by snapshot_process.R
+snapshot = DatasetSchema("snapshot", [
+    Column("patient_id", pa.int64()),
+    Column("has_follow_up", pa.bool_()),
+
+    # demographics
+    Column("age", pa.int32()),
+    Column("agegroup_narrow", pa.string(), dictionary=True,
+           levels=["18-49", "50-54", "55-59", "60-64", "65-69", "70-74", "75-79", "80plus", "missing"]),
+    Column("agegroup_medium", pa.string(), dictionary=True, levels=["18-49", "50-64", "65-74", "75plus", "missing"]),
+    Column("agegroup_broad", pa.string(), dictionary=True, levels=["18-49", "50-64", "65plus", "missing"]),
+    Column("sex", pa.string(), dictionary=True, levels=["M", "F"]),
+    Column("ethnicity_primary", pa.float64()),
+    Column("ethnicity_sus", pa.float64()),
+    Column("ethnicity", pa.float64()),
+    Column("ethnicity_primary_16", pa.float64()),
+    Column("ethnicity_sus_16", pa.float64()),
+    Column("ethnicity_16", pa.float64()),
+    Column("bmi_value", pa.float64(), r_col_type="d"),
+    Column("bmi", pa.string(), dictionary=True,
+           levels=["Not obese", "Obese I (30-34.9)", "Obese II (35-39.9)", "Obese III (40+)"]),
+    Column("smoking_status", pa.string(), dictionary=True, levels=["S", "E", "N", "M"]),
+    Column("smoking_status_comb", pa.string(), dictionary=True, levels=["S", "E", "N + M"]),
+    Column("imd", pa.float64()),
+    Column("imd_decile", pa.float64()),
+    Column("region", pa.string(), dictionary=True),
+
+    # comorbidities (multilevel)
+    Column("asthma", pa.float64()),
+    Column("bp", pa.float64()),
+    Column("bp_ht", pa.bool_()),
+    Column("diabetes_controlled", pa.float64()),
+
+    # ckd/rrt
+    Column("rrt_cat", pa.float64()),
+    Column("creatinine", pa.float64()),
+    Column("creatinine_operator", pa.string()),
+    Column("creatinine_age", pa.float64()),
+
+    # organ or kidney transplant
+    Column("organ_kidney_transplant", pa.string(), dictionary=True, levels=["No transplant", "Kidney", "Organ"]),
+
+    # comorbidities (binary)
+    Column("hypertension", pa.bool_()),
+    Column("chronic_respiratory_disease", pa.bool_()),
+    Column("chronic_cardiac_disease", pa.bool_()),
+    Column("cancer", pa.bool_()),
+    Column("haem_cancer", pa.bool_()),
+    Column("chronic_liver_disease", pa.bool_()),
+    Column("stroke", pa.bool_()),
+    Column("dementia", pa.bool_()),
+    Column("other_neuro", pa.bool_()),
+    Column("asplenia", pa.bool_()),
+    Column("ra_sle_psoriasis", pa.bool_()),
+    Column("immunosuppression", pa.bool_()),
+    Column("learning_disability", pa.bool_()),
+    Column("sev_mental_ill", pa.bool_()),
+
+    # vaccination dates
+    Column("covid_vax_date_most_recent", pa.date32()),
+    Column("covid_vax_date_{i}", pa.date32()),
+], n_slots=7)
+
+# number of distinct vaccination dates per patient, used to choose the number of slots
+dose_count = DatasetSchema("dose_count", [
+    Column("patient_id", pa.int64()),
+    Column("n_doses", pa.int64()),
+])
+
+DATASETS = {schema.name: schema for schema in (fixed, varying, snapshot, dose_count)}
+
+
+def slot_count(dataset, path=DOSE_SLOTS_PATH):
+    # number of slots to extract: as chosen by dose_slots.py if it has run (for this
+    # dataset if it chose one, as with dummy data), else the default
+    path = Path(path)
+    if not path.exists():
+        return dataset.n_slots
+    with open(path) as f:
+        summary = json.load(f)
+    return int(summary.get("dataset_n_slots", {}).get(dataset.name, summary["n_slots"]))
+
+
+## typed readers ----
+
+def _cast_column(array, column):
+    if column.dictionary:
+        if not pa.types.is_dictionary(array.type):
+            array = array.cast(column.type).dictionary_encode()
+        return array.cast(column.arrow_type)
+    if pa.types.is_dictionary(array.type):
+        array = array.cast(array.type.value_type)
+    return array.cast(column.type)
+
+
+def conform(table, dataset, n_slots=None):
+    # select and cast the declared columns of an in-memory table
+    n_slots = dataset.n_slots_in(table.column_names) if n_slots is None else n_slots
+    schema = dataset.arrow_schema(n_slots)
+    columns = []
+    for field in schema:
+        column = dataset.column(field.name)
+        if field.name in table.column_names:
+            columns.append(_cast_column(table.column(field.name), column))
+        else:
+            columns.append(pa.nulls(table.num_rows, field.type))
+    if SAMPLE_WEIGHT in table.column_names:
+        columns.append(table.column(SAMPLE_WEIGHT).cast(pa.float64()))
+        schema = schema.append(pa.field(SAMPLE_WEIGHT, pa.float64()))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def read_extract(path, dataset, n_slots=None):
+    # read an arrow, parquet or csv(.gz) extract, or an arrow stream ("-" for stdin, see
+    # arrow_stream.py), with the declared column types
+    import arrow_stream
+
+    if arrow_stream.is_stream(path):
+        return conform(arrow_stream.read_table(path), dataset, n_slots)
+    path = Path(path)
+    suffixes = "".join(path.suffixes)
+
+    if suffixes.endswith((".csv", ".csv.gz")):
+        import pyarrow.csv as pacsv
+
+        with pacsv.open_csv(path) as reader:
+            names = reader.schema.names
+        n_slots = dataset.n_slots_in(names) if n_slots is None else n_slots
+        schema = dataset.arrow_schema(n_slots)
+        present = [f for f in schema if f.name in names]
+        column_types = {f.name: dataset.column(f.name).type for f in present}
+        if SAMPLE_WEIGHT in names:
+            column_types[SAMPLE_WEIGHT] = pa.float64()
+        table = pacsv.read_csv(
+            path,
+            convert_options=pacsv.ConvertOptions(
+                column_types=column_types,
+                include_columns=list(column_types),
+                # cohortextractor writes binary flags as 0/1
+                true_values=["1", "T", "TRUE", "True", "true"],
+                false_values=["0", "F", "FALSE", "False", "false"],
+            ),
+        )
+    elif suffixes.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path, memory_map=True)
+    else:
+        import arrow_io
+
+        table = arrow_io.read_table(path)
+
+    return conform(table, dataset, n_slots)
+
+
+## typed dummy data ----
+
+def dummy_table(dataset, n=1000, seed=10, n_slots=None, missing_rate=0.2):
+    # simulate data with exactly the declared schema; for checking readers and writers,
+    # not for realistic distributions (see the dd4d scripts for those)
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    schema = dataset.arrow_schema(n_slots)
+    arrays = []
+    for field in schema:
+        column = dataset.column(field.name)
+        if field.name == "patient_id":
+            arrays.append(pa.array(np.arange(1, n + 1), type=column.type))
+            continue
+
+        if pa.types.is_date(column.type):
+            values = pa.array(rng.integers(18_600, 19_600, n).astype("int32")).cast(pa.date32())
+        elif pa.types.is_boolean(column.type):
+            values = pa.array(rng.random(n) < 0.9)
+        elif pa.types.is_integer(column.type):
+            values = pa.array(rng.integers(18, 100, n), type=column.type)
+        elif pa.types.is_floating(column.type):
+            values = pa.array(rng.normal(25, 5, n), type=column.type)
+        else:
+            levels = column.levels or [f"{field.name}_{k}" for k in range(1, 11)]
+            values = pa.array(np.asarray(levels, dtype=object)[rng.integers(0, len(levels), n)], type=pa.string())
+
+        mask = pa.array(rng.random(n) < missing_rate)
+        arrays.append(_cast_column(pc.if_else(mask, pa.scalar(None, values.type), values), column))
+
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+## json export for R ----
+
+def write_json(directory=SCHEMA_DIR):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for dataset in DATASETS.values():
+        path = directory / f"{dataset.name}.json"
+        with open(path, "w") as f:
+            json.dump(dataset.to_json(), f, indent=2)
+            f.write("\n")
+        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the extract schemas for the R scripts")
+    parser.add_argument("--schema-dir", default=str(SCHEMA_DIR))
+    parser.add_argument("--dummy-data-dir", help="also write typed dummy data for each dataset to this directory")
+    parser.add_argument("--population-size", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    for path in write_json(args.schema_dir):
+        print(f"wrote {path}")
+
+    if args.dummy_data_dir:
+        import arrow_io
+
+        Path(args.dummy_data_dir).mkdir(parents=True, exist_ok=True)
+        for dataset in DATASETS.values():
+            path = Path(args.dummy_data_dir) / f"dummy_{dataset.name}.arrow"
+            arrow_io.write_table(dummy_table(dataset, n=args.population_size), path)
+            print(f"wrote {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+##########################
+# vaccination status at a series of snapshot dates, in one pass over the doses
+##########################
+
+# This script:
+# produces one row per (patient_id, snapshot_date) for a list of snapshot dates (eg the
+# first of every month), with the vaccination state on that date:
+#  - n_vax: number of doses on or before the date
+#  - last_vax_date, days_since_last_vax: most recent dose on or before the date
+#  - flags that become true on a date and stay true, eg `died` from death_date
+# without re-running the snapshot extraction for each date.
+#
+# Each dose is placed into the first snapshot on or after it with one sorted search, and
+# the per-snapshot counts and latest dates are accumulated across snapshots with a
+# cumulative sum / running maximum, so the cost is one pass over the doses plus the size
+# of the output, rather than one extraction per date.
+#
+# Monthly snapshots fall on the day of the month of --start, or on the last day of
+# shorter months (so a start on the 31st gives 28/29 Feb, 30 Apr, ...).
+# With --clean, only the doses process.R keeps in data_vax_clean are counted (the first
+# dose and any at least 14 days after the previous one), as in dose_coverage.py.
+#
+# usage:
+#   python analysis/snapshot_series.py [--start 2021-01-01] [--end 2023-09-01] [--every month] [--clean]
+
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+import arrow_io
+import dose_qa
+import dose_table
+import schema_registry
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# as in study_definition_snapshot.py
+SNAPSHOT_DATE = "2023-09-01"
+
+# no dose yet, in the running maximum of dose dates
+NO_DOSE = np.iinfo(np.int32).min
+
+
+def snapshot_dates(start, end, every="month"):
+    # days since epoch of each snapshot, from start to end inclusive
+    start, end = np.datetime64(start, "D"), np.datetime64(end, "D")
+    if every == "month":
+        months = np.arange(start.astype("datetime64[M]"), end.astype("datetime64[M]") + 1)
+        # same day of the month as `start`, or the last day of shorter months
+        offset = start - start.astype("datetime64[M]").astype("datetime64[D]")
+        dates = np.minimum(months.astype("datetime64[D]") + offset, (months + 1).astype("datetime64[D]") - 1)
+    elif every == "week":
+        dates = np.arange(start, end + 1, 7)
+    else:
+        dates = np.arange(start, end + 1, int(every))
+    dates = dates[(dates >= start) & (dates <= end)]
+    return (dates - dose_table.EPOCH).astype(np.int64)
+
+
+def series_schema(patient_id_type=pa.int64(), flags=("died",)):
+    # columns of the output, as sweep() gives them
+    return pa.schema(
+        [
+            pa.field("patient_id", patient_id_type),
+            pa.field("snapshot_date", pa.date32()),
+            pa.field("n_vax", pa.int32()),
+            pa.field("last_vax_date", pa.date32()),
+            pa.field("days_since_last_vax", pa.int32()),
+        ]
+        + [pa.field(name, pa.bool_()) for name in flags]
+    )
+
+
+def sweep(patient_id, dose_patient_id, dose_days, snapshots, first_dates=None):
+    # state of every patient at every snapshot
+    #   patient_id: sorted unique ids of the population
+    #   dose_patient_id, dose_days: one entry per dose (any order)
+    #   snapshots: sorted days since epoch
+    #   first_dates: name -> array of the date (days, or -1 for never) each patient's flag
+    #                becomes true, aligned with patient_id
+    patient_id = np.asarray(patient_id)
+    snapshots = np.asarray(snapshots, dtype=np.int64)
+    n_patients, n_snapshots = len(patient_id), len(snapshots)
+
+    # doses of patients outside the population are dropped
+    p = np.searchsorted(patient_id, dose_patient_id)
+    inside = p < n_patients
+    inside[inside] = patient_id[p[inside]] == np.asarray(dose_patient_id)[inside]
+    p, days = p[inside], np.asarray(dose_days, dtype=np.int64)[inside]
+
+    # first snapshot on or after each dose; doses after the last snapshot don't count
+    s = np.searchsorted(snapshots, days, side="left")
+    counted = s < n_snapshots
+    p, s, days = p[counted], s[counted], days[counted]
+
+    counts = np.zeros((n_patients, n_snapshots), dtype=np.int32)
+    np.add.at(counts, (p, s), 1)
+    n_vax = np.cumsum(counts, axis=1)
+
+    last = np.full((n_patients, n_snapshots), NO_DOSE, dtype=np.int64)
+    np.maximum.at(last, (p, s), days)
+    last = np.maximum.accumulate(last, axis=1)
+
+    has_dose = last != NO_DOSE
+    since = snapshots[None, :] - last
+
+    columns = {
+        "patient_id": pa.array(np.repeat(patient_id, n_snapshots)),
+        "snapshot_date": pa.array(np.tile(snapshots, n_patients).astype(np.int32)).cast(pa.date32()),
+        "n_vax": pa.array(n_vax.ravel().astype(np.int32)),
+        "last_vax_date": pa.array(np.where(has_dose, last, 0).ravel().astype(np.int32), mask=~has_dose.ravel()).cast(pa.date32()),
+        "days_since_last_vax": pa.array(np.where(has_dose, since, 0).ravel().astype(np.int32), mask=~has_dose.ravel()),
+    }
+    for name, first in (first_dates or {}).items():
+        first = np.asarray(first, dtype=np.int64)
+        flag = (first[:, None] >= 0) & (first[:, None] <= snapshots[None, :])
+        columns[name] = pa.array(flag.ravel())
+    return pa.table(columns)
+
+
+def sweep_batches(patient_id, dose_patient_id, dose_days, snapshots, first_dates=None, batch_size=100_000):
+    # sweep() over consecutive batches of patients, so that the state grids stay small;
+    # doses must be sorted by patient_id (as in the long table)
+    patient_id = np.asarray(patient_id)
+    dose_patient_id = np.asarray(dose_patient_id)
+    first_dates = first_dates or {}
+    for start in range(0, len(patient_id), batch_size):
+        batch = patient_id[start:start + batch_size]
+        lo = np.searchsorted(dose_patient_id, batch[0], side="left")
+        hi = np.searchsorted(dose_patient_id, batch[-1], side="right")
+        yield sweep(
+            batch, dose_patient_id[lo:hi], dose_days[lo:hi], snapshots,
+            {name: first[start:start + batch_size] for name, first in first_dates.items()},
+        )
+
+
+def first_date_days(column):
+    # date column -> days since epoch, with -1 for missing
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    return column.cast(pa.int32()).fill_null(-1).to_numpy(zero_copy_only=False).astype(np.int64)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Vaccination status at a series of snapshot dates")
+    parser.add_argument("--fixed", default=str(ROOT / "output" / "extracts" / "extract_fixed.arrow"))
+    parser.add_argument("--varying", default=str(ROOT / "output" / "extracts" / "extract_varying.arrow"))
+    parser.add_argument("--start", default="2021-01-01")
+    parser.add_argument("--end", default=SNAPSHOT_DATE)
+    parser.add_argument("--every", default="month", help="month, week, or a number of days")
+    parser.add_argument("--clean", action="store_true", help="keep only the doses process.R keeps in data_vax_clean")
+    parser.add_argument("--batch-size", type=int, default=100_000, help="patients per batch")
+    parser.add_argument("--output", default=str(ROOT / "output" / "snapshot_series" / "snapshot_series.arrow"))
+    args = parser.parse_args(argv)
+
+    fixed = schema_registry.read_extract(args.fixed, schema_registry.fixed)
+    fixed = fixed.sort_by("patient_id")
+    long = dose_table.read_long(args.varying)
+    if args.clean:
+        long = long.filter(pa.array(dose_qa.clean_mask(long)))
+
+    snapshots = snapshot_dates(args.start, args.end, args.every)
+    batches = sweep_batches(
+        fixed.column("patient_id").to_numpy(),
+        long.column("patient_id").to_numpy(),
+        dose_table.to_days(long.column("vax_date")),
+        snapshots,
+        first_dates={"died": first_date_days(fixed.column("death_date"))},
+        batch_size=args.batch_size,
+    )
+
+    # written batch by batch, so only one batch of state rows is held at a time; the
+    # writer is opened first so that an empty population still gives a (row-less) file
+    schema = series_schema(fixed.schema.field("patient_id").type)
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with arrow_io.new_file(args.output, schema) as writer:
+        for table in batches:
+            writer.write_table(table.cast(schema))
+    print(f"wrote {args.output}: {len(snapshots)} snapshot dates", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,363 @@
+##########################
+# patient_id-sorted extracts with a batch index, and a streaming merge-join
+##########################
+
+# This script:
+# writes extracts as arrow files sorted by patient_id, in record batches of about a
+# fixed number of rows, with
+#  - `sorted_by: patient_id` in the schema metadata, so readers can check the order
+#    rather than assume it
+#  - a sidecar index (`<name>.index.arrow`, one row per record batch) of the first and
+#    last patient_id, row offset and content hash of each batch
+# A batch ends after a patient whose hash picks it (about one in `batch_size` rows), so
+# where the batches start depends only on which patients are in the extract: two versions
+# of an extract share every batch whose rows haven't changed, with the same content hash
+# (see extract_diff.py). The content hash is of the values, not of how they are encoded
+# or compressed.
+# With the index, finding one patient's rows reads a single record batch of the
+# memory-mapped file, and two sorted extracts (eg fixed and varying) can be joined by
+# walking both in patient_id order, holding one batch of each at a time, instead of
+# loading both tables and matching them with a hash join.
+#
+#   fixed = SortedExtract("output/sorted/extract_fixed.arrow")
+#   fixed.lookup(1234)
+#   for joined in merge_join(fixed, SortedExtract("output/sorted/extract_varying.arrow")):
+#       ...
+#
+# It isn't a project.yaml action, as no action reads the sorted copies (they would only
+# be another highly sensitive copy of the extracts); sampling.py writes its sample with
+# write_sorted(), and the copies can be made locally for lookups and extract_diff.py.
+#
+# usage:
+#   python analysis/sorted_extract.py output/extracts/extract_fixed.arrow output/extracts/extract_varying.arrow
+#   # -> output/sorted/extract_fixed.arrow, extract_fixed.index.arrow, ...
+
+import argparse
+import hashlib
+import sys
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import arrow_io
+import hashing
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+KEY = "patient_id"
+SORTED_BY = b"sorted_by"
+BATCH_SIZE = 65_536
+
+JOINS = ("inner", "left", "outer")
+# a batch with no patient picked to end it is cut at this many times batch_size rows
+MAX_BATCH_FACTOR = 4
+# the hash of a missing value, whatever the column's type
+NULL_HASH = np.uint64(0x6E756C6C6E756C6C)
+
+
+def index_path(path):
+    path = Path(path)
+    return path.with_name(path.name.split(".")[0] + ".index.arrow")
+
+
+def is_sorted(patient_id):
+    patient_id = np.asarray(patient_id)
+    return bool(np.all(patient_id[1:] >= patient_id[:-1]))
+
+
+## content hashes ----
+
+def _value_hashes(values):
+    # hashes of a (short) list of python values, eg the levels of a dictionary
+    return np.array(
+        [int.from_bytes(hashlib.blake2b(repr(value).encode(), digest_size=8).digest(), "little") for value in values],
+        dtype=np.uint64,
+    )
+
+
+def column_hashes(column):
+    # a uint64 hash of each value of a column, the same for the same value whether or not
+    # the column is chunked or dictionary-encoded
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    type = column.type
+    if pa.types.is_null(type):
+        return np.full(len(column), NULL_HASH, dtype=np.uint64)
+    if pa.types.is_string(type) or pa.types.is_large_string(type) or pa.types.is_binary(type):
+        column = column.dictionary_encode()
+        type = column.type
+    if pa.types.is_dictionary(type):
+        dictionary = column.dictionary
+        if pa.types.is_string(dictionary.type) or pa.types.is_large_string(dictionary.type):
+            levels = np.where(dictionary.is_valid().to_numpy(zero_copy_only=False),
+                              _value_hashes(dictionary.to_pylist()), NULL_HASH)
+        else:
+            levels = column_hashes(dictionary)
+        levels = np.append(levels, NULL_HASH).astype(np.uint64)
+        return levels[column.indices.fill_null(len(dictionary)).to_numpy(zero_copy_only=False)]
+    if pa.types.is_floating(type):
+        values = column.cast(pa.float64()).fill_null(0).to_numpy(zero_copy_only=False).view(np.uint64)
+    elif pa.types.is_date32(type):
+        values = column.cast(pa.int32()).fill_null(0).to_numpy(zero_copy_only=False).astype(np.int64).view(np.uint64)
+    elif pa.types.is_integer(type) or pa.types.is_boolean(type) or pa.types.is_temporal(type):
+        # unchecked, so that uint64 values wrap rather than overflow
+        values = column.cast(pa.int64(), safe=False).fill_null(0).to_numpy(zero_copy_only=False).view(np.uint64)
+    else:
+        values = _value_hashes(column.to_pylist())
+    hashes = hashing.splitmix64(values)
+    return np.where(column.is_valid().to_numpy(zero_copy_only=False), hashes, NULL_HASH)
+
+
+def row_hashes(table, columns=None):
+    # a uint64 hash of each row over the given columns (default: all), in that order; a
+    # column the table doesn't have counts as missing
+    columns = table.column_names if columns is None else columns
+    hashes = np.zeros(table.num_rows, dtype=np.uint64)
+    for name in columns:
+        values = column_hashes(table.column(name)) if name in table.column_names else NULL_HASH
+        hashes = hashing.splitmix64(hashes ^ values ^ _value_hashes([name])[0])
+    return hashes
+
+
+def content_hash(hashes, columns):
+    # the hash of a batch, from its row hashes and column names
+    digest = hashlib.sha256("\n".join(columns).encode())
+    digest.update(np.asarray(hashes, dtype="<u8").tobytes())
+    return digest.hexdigest()[:16]
+
+
+## writing ----
+
+def batch_offsets(patient_id, batch_size=BATCH_SIZE):
+    # row offsets of the batches of a table sorted by patient_id: a batch ends after the last
+    # row of a patient whose hash is 0 modulo batch_size, or after MAX_BATCH_FACTOR * batch_size
+    # rows without one
+    patient_id = np.asarray(patient_id, dtype=np.int64)
+    n = len(patient_id)
+    last = np.ones(n, dtype=bool)
+    last[:-1] = patient_id[1:] != patient_id[:-1]
+    picked = hashing.splitmix64(patient_id.view(np.uint64)) % np.uint64(batch_size) == 0
+    limit = MAX_BATCH_FACTOR * batch_size
+    offsets = [0]
+    for end in np.flatnonzero(last & picked).tolist() + [n - 1]:
+        end += 1
+        while end - offsets[-1] > limit:
+            offsets.append(offsets[-1] + limit)
+        if end > offsets[-1]:
+            offsets.append(end)
+    return np.array(offsets, dtype=np.int64)
+
+
+def write_sorted(table, path, batch_size=BATCH_SIZE, compression=None):
+    # write a table sorted by patient_id in batches of about batch_size rows, with its index;
+    # batches are compressed with the arrow_io.py setting
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if not is_sorted(table.column(KEY).to_numpy()):
+        table = table.take(pc.sort_indices(table.column(KEY)))
+    metadata = dict(table.schema.metadata or {})
+    metadata[SORTED_BY] = KEY.encode()
+    table = table.replace_schema_metadata(metadata).combine_chunks()
+
+    patient_id = table.column(KEY).to_numpy()
+    offsets = batch_offsets(patient_id, batch_size) if table.num_rows else np.zeros(1, dtype=np.int64)
+    hashes = row_hashes(table)
+    with arrow_io.new_file(path, table.schema, compression) as writer:
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            writer.write_table(table.slice(start, end - start))
+
+    batches = len(offsets) - 1
+    index = pa.table({
+        "batch": pa.array(np.arange(batches, dtype=np.int32)),
+        "first_patient_id": pa.array(patient_id[offsets[:-1]] if batches else [], type=pa.int64()),
+        "last_patient_id": pa.array(patient_id[offsets[1:] - 1] if batches else [], type=pa.int64()),
+        "offset": pa.array(offsets[:-1], type=pa.int64()),
+        "num_rows": pa.array(np.diff(offsets), type=pa.int64()),
+        "content_hash": pa.array(
+            [content_hash(hashes[start:end], table.column_names) for start, end in zip(offsets[:-1], offsets[1:])],
+            type=pa.string(),
+        ),
+    })
+    with pa.ipc.new_file(index_path(path), index.schema) as writer:
+        writer.write_table(index)
+    return path
+
+
+## reading ----
+
+class SortedExtract:
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.reader = pa.ipc.open_file(pa.memory_map(str(self.path)))
+        metadata = self.reader.schema.metadata or {}
+        if metadata.get(SORTED_BY) != KEY.encode():
+            raise ValueError(f"{self.path} is not marked as sorted by {KEY}; write it with write_sorted()")
+        if index_path(self.path).exists():
+            index = pa.ipc.open_file(pa.memory_map(str(index_path(self.path)))).read_all()
+            self.first = index.column("first_patient_id").to_numpy()
+            self.last = index.column("last_patient_id").to_numpy()
+        else:
+            # rebuild from the batches' first and last ids
+            ids = [self.batch(i).column(KEY).to_numpy() for i in range(self.num_batches)]
+            self.first = np.array([b[0] for b in ids], dtype=np.int64)
+            self.last = np.array([b[-1] for b in ids], dtype=np.int64)
+
+    @property
+    def schema(self):
+        return self.reader.schema
+
+    @property
+    def num_batches(self):
+        return self.reader.num_record_batches
+
+    def batch(self, i):
+        return self.reader.get_batch(i)
+
+    def batches(self):
+        for i in range(self.num_batches):
+            yield self.batch(i)
+
+    def lookup(self, patient_id):
+        # rows of one patient, reading only the batches that can hold them
+        first = np.searchsorted(self.last, patient_id, side="left")
+        stop = np.searchsorted(self.first, patient_id, side="right")
+        pieces = []
+        for i in range(first, stop):
+            batch = self.batch(i)
+            ids = batch.column(KEY).to_numpy()
+            lo, hi = np.searchsorted(ids, patient_id, side="left"), np.searchsorted(ids, patient_id, side="right")
+            pieces.append(batch.slice(lo, hi - lo))
+        if not pieces:
+            return self.schema.empty_table()
+        return pa.Table.from_batches(pieces, schema=self.schema)
+
+    def read_all(self):
+        return self.reader.read_all()
+
+
+## merge-join ----
+
+def _join_columns(left_schema, right_schema, suffix):
+    # output (name, side, source name); right columns that clash get the suffix
+    names = set(left_schema.names)
+    columns = [(name, "left", name) for name in left_schema.names]
+    for name in right_schema.names:
+        if name == KEY:
+            continue
+        columns.append((name + suffix if name in names else name, "right", name))
+    return columns
+
+
+def join_sorted(left, right, how="left", suffix="_right"):
+    # join two in-memory tables sorted by patient_id; left has at most one row per
+    # patient, right may have several (eg the long dose table)
+    if how not in JOINS:
+        raise ValueError(f"how must be one of {', '.join(JOINS)}")
+    lid = left.column(KEY).to_numpy()
+    rid = right.column(KEY).to_numpy()
+    starts = np.searchsorted(rid, lid, side="left")
+    counts = np.searchsorted(rid, lid, side="right") - starts
+    matched = counts > 0
+
+    n_out = counts if how == "inner" else np.maximum(counts, 1)
+    left_take = np.repeat(np.arange(len(lid)), n_out)
+    within = np.arange(n_out.sum()) - np.repeat(np.cumsum(n_out) - n_out, n_out)
+    right_take = np.repeat(starts, n_out) + within
+    right_valid = np.repeat(matched, n_out)
+    ids = lid[left_take]
+
+    left_take = pa.array(left_take)
+    right_take = pa.array(np.where(right_valid, right_take, 0), mask=~right_valid)
+    if how == "outer":
+        # right rows with no left row, placed among the others in patient_id order
+        unmatched = np.ones(len(rid), dtype=bool)
+        unmatched[right_take.drop_null().to_numpy()] = False
+        extra = np.flatnonzero(unmatched)
+        ids = np.concatenate([ids, rid[extra]])
+        order = np.argsort(ids, kind="stable")
+        ids = ids[order]
+        left_take = pa.concat_arrays([left_take, pa.nulls(len(extra), pa.int64())]).take(pa.array(order))
+        right_take = pa.concat_arrays([right_take, pa.array(extra)]).take(pa.array(order))
+
+    arrays, names = [], []
+    for name, side, source in _join_columns(left.schema, right.schema, suffix):
+        if name == KEY:
+            arrays.append(pa.array(ids, type=left.schema.field(KEY).type))
+        else:
+            table, take = (left, left_take) if side == "left" else (right, right_take)
+            arrays.append(table.column(source).take(take))
+        names.append(name)
+    return pa.Table.from_arrays(arrays, names=names)
+
+
+def merge_join(left, right, how="left", suffix="_right"):
+    # join two SortedExtracts batch by batch, yielding joined tables in patient_id order;
+    # at any time only one batch of left and the right rows up to its last patient are held
+    right_batches = right.batches()
+    pending = right.schema.empty_table()
+    exhausted = False
+
+    def take_until(last_id):
+        # right rows with patient_id <= last_id (all remaining ones if last_id is None)
+        nonlocal pending, exhausted
+        while not exhausted and (last_id is None or pending.num_rows == 0
+                                 or pending.column(KEY)[-1].as_py() <= last_id):
+            batch = next(right_batches, None)
+            if batch is None:
+                exhausted = True
+            else:
+                pending = pa.concat_tables([pending, pa.Table.from_batches([batch])])
+        if last_id is None:
+            split = pending.num_rows
+        else:
+            split = int(np.searchsorted(pending.column(KEY).to_numpy(), last_id, side="right"))
+        taken, pending = pending.slice(0, split), pending.slice(split)
+        return taken
+
+    for batch in left.batches():
+        if batch.num_rows == 0:
+            continue
+        left_table = pa.Table.from_batches([batch])
+        right_table = take_until(batch.column(KEY)[-1].as_py())
+        yield join_sorted(left_table, right_table.combine_chunks(), how, suffix)
+
+    if how == "outer":
+        # right rows after the last left patient
+        rest = take_until(None)
+        if rest.num_rows:
+            yield join_sorted(left.schema.empty_table(), rest.combine_chunks(), how, suffix)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write patient_id-sorted copies of extracts with a batch index")
+    parser.add_argument("inputs", nargs="+", help="arrow, parquet or csv extracts")
+    parser.add_argument("--output-dir", default=str(ROOT / "output" / "sorted"))
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="average rows per record batch")
+    args = parser.parse_args(argv)
+
+    import pyarrow.feather as feather
+
+    for path in args.inputs:
+        path = Path(path)
+        if path.name.endswith((".csv", ".csv.gz")):
+            import pyarrow.csv as pacsv
+
+            table = pacsv.read_csv(path)
+        elif path.suffix == ".parquet":
+            import pyarrow.parquet as pq
+
+            table = pq.read_table(path)
+        else:
+            table = feather.read_table(path, memory_map=True)
+        output = Path(args.output_dir) / (path.name.split(".")[0] + ".arrow")
+        write_sorted(table, output, batch_size=args.batch_size)
+        print(f"wrote {output} and {index_path(output).name}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,9 +18,36 @@ from snapshot_demographic_vars import demographic_variables
 from snapshot_comorbidity_vars import comorbidity_variables
 import codelists
 
+# number of vaccination slots, as chosen by dose_slots.py
+from schema_registry import snapshot as snapshot_schema, slot_count
+
 # Set snapshot date
 snapshot_date = "2023-09-01"
 
+n_slots = slot_count(snapshot_schema)
+
+
+# Dates of the first n COVID vaccinations, each at least 14 days after the previous one
+def vaccination_dates(n):
+    variables = {}
+    for i in range(1, n+1):
+        if i == 1:
+            from_date = "2020-12-01"  # any dose recorded after 01/12/2020
+        else:
+            from_date = f"covid_vax_date_{i-1} + 14 days"  # from day after previous dose
+        variables[f"covid_vax_date_{i}"] = patients.with_tpp_vaccination_record(
+            target_disease_matches="SARS-2 CORONAVIRUS",
+            between=[from_date, snapshot_date],
+            find_first_match_in_period=True,
+            returning="date",
+            date_format="YYYY-MM-DD",
+            return_expectations={
+                "date": {"earliest": "2020-12-01", "latest": snapshot_date},
+                "incidence": {1: 0.8, 2: 0.6}.get(i, 0.5),
+            },
+        )
+    return variables
+
 # DEFINE STUDY POPULATION ----
 # Define study population and variables
 study = StudyDefinition(
@@ -65,96 +92,8 @@ study = StudyDefinition(
     **comorbidity_variables,
  
     # VACCINATION HISTORY
-    # Date of first COVID vaccination -
-    covid_vax_date_1=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        between=["2020-12-01", snapshot_date],  # any dose recorded after 01/12/2020
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {"earliest": "2020-12-01", "latest": snapshot_date},
-            "incidence": 0.8,
-        },
-    ),
-    
-    # Date of second COVID vaccination -
-    covid_vax_date_2=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        between=["covid_vax_date_1 + 14 days", snapshot_date],  # from day after previous dose
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {"earliest": "2020-12-01", "latest": snapshot_date},
-            "incidence": 0.6,
-        },
-    ),
-    
-    # Date of third COVID vaccination (primary or booster) -
-    covid_vax_date_3=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        between=["covid_vax_date_2 + 14 days", snapshot_date],  # from day after previous dose
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {"earliest": "2020-12-01", "latest": snapshot_date},
-            "incidence": 0.5,
-        },
-    ),
-    
-    # Date of fourth COVID vaccination (booster) -
-    covid_vax_date_4=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        between=["covid_vax_date_3 + 14 days", snapshot_date],  # from day after previous dose
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {"earliest": "2020-12-01", "latest": snapshot_date},
-            "incidence": 0.5,
-        },
-    ),
-    
-    # Date of fifth COVID vaccination (booster) -
-    covid_vax_date_5=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        between=["covid_vax_date_4 + 14 days", snapshot_date],  # from day after previous dose
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {"earliest": "2020-12-01", "latest": snapshot_date},
-            "incidence": 0.5,
-        },
-    ),
-    
-    # Date of sixth COVID vaccination (booster) -
-    covid_vax_date_6=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        between=["covid_vax_date_5 + 14 days", snapshot_date],  # from day after previous dose
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {"earliest": "2020-12-01", "latest": snapshot_date},
-            "incidence": 0.5,
-        },
-    ),
-    
-    # Date of seventh COVID vaccination (booster) -
-    covid_vax_date_7=patients.with_tpp_vaccination_record(
-        target_disease_matches="SARS-2 CORONAVIRUS",
-        between=["covid_vax_date_6 + 14 days", snapshot_date],  # from day after previous dose
-        find_first_match_in_period=True,
-        returning="date",
-        date_format="YYYY-MM-DD",
-        return_expectations={
-            "date": {"earliest": "2020-12-01", "latest": snapshot_date},
-            "incidence": 0.5,
-        },
-    ),
+    # Dates of first, second, ... COVID vaccination (primary or booster)
+    **vaccination_dates(n_slots),
     
     # Date of most recent COVID vaccination
     covid_vax_date_most_recent=patients.with_tpp_vaccination_record(
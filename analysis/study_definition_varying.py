@@ -15,6 +15,11 @@ from cohortextractor import (
 # Import codelists from codelists.py
 import codelists
 
+# number of vaccination slots, as chosen by dose_slots.py
+from schema_registry import varying as varying_schema, slot_count
+
+n_slots = slot_count(varying_schema)
+
 
 index_date = "2020-01-01"
 
@@ -172,7 +177,7 @@ study = StudyDefinition(
     # use 1900 to capture all possible recorded covid vaccinations, including date errors
     # any vaccines occurring before national rollout can be later excluded if necessary
     on_or_after = "1900-01-01",
-    n = 10
+    n = n_slots
   ),
   
   ## all other known covid-19 vaccine product names in use
@@ -182,7 +187,7 @@ study = StudyDefinition(
   **vaccination_date_X(
     name = "covid_vax_pfizer",
     on_or_after = "1900-01-01", 
-    n = 10,
+    n = n_slots,
     product_name_matches="COVID-19 mRNA Vaccine Comirnaty 30micrograms/0.3ml dose conc for susp for inj MDV (Pfizer)"
   ),
   
@@ -190,7 +195,7 @@ study = StudyDefinition(
   **vaccination_date_X(
     name = "covid_vax_az",
     on_or_after = "1900-01-01",
-    n = 10,
+    n = n_slots,
     product_name_matches="COVID-19 Vaccine Vaxzevria 0.5ml inj multidose vials (AstraZeneca)"
   ),
   
@@ -198,7 +203,7 @@ study = StudyDefinition(
   **vaccination_date_X(
     name = "covid_vax_moderna",
     on_or_after = "1900-01-01",
-    n = 10,
+    n = n_slots,
     product_name_matches="COVID-19 mRNA Vaccine Spikevax (nucleoside modified) 0.1mg/0.5mL dose disp for inj MDV (Moderna)"
   ),
   
@@ -206,7 +211,7 @@ study = StudyDefinition(
   **vaccination_date_X(
     name = "covid_vax_pfizeromicron",
     on_or_after = "1900-01-01", 
-    n = 10,
+    n = n_slots,
     product_name_matches="Comirnaty Original/Omicron BA.1 COVID-19 Vacc md vials"
   ),
   
@@ -214,7 +219,7 @@ study = StudyDefinition(
   **vaccination_date_X(
     name = "covid_vax_modernaomicron",
     on_or_after = "1900-01-01",
-    n = 10,
+    n = n_slots,
     product_name_matches="COVID-19 Vac Spikevax (Zero)/(Omicron) inj md vials"
   ),
   
@@ -222,7 +227,7 @@ study = StudyDefinition(
   **vaccination_date_X(
     name = "covid_vax_pfizerchildren",
     on_or_after = "1900-01-01",
-    n = 10,
+    n = n_slots,
     product_name_matches="COVID-19 mRNA Vaccine Comirnaty Children 5-11yrs 10mcg/0.2ml dose conc for disp for inj MDV (Pfizer)"
   ),
   
@@ -230,7 +235,7 @@ study = StudyDefinition(
   **vaccination_date_X(
     name = "covid_vax_az2",
     on_or_after = "1900-01-01",
-    n = 10,
+    n = n_slots,
     product_name_matches="COVID-19 Vac AZD2816 (ChAdOx1 nCOV-19) 3.5x10*9 viral part/0.5ml dose sol for inj MDV (AstraZeneca)"
   ),
   
@@ -0,0 +1,267 @@
+##########################
+# compare extract schemas using file metadata only
+##########################
+
+# This script:
+# checks that a study-definition / dataset-definition output has the same columns
+# and column types as the custom dummy data (or another reference file).
+# Only the Arrow schema / Parquet footer / CSV header is read, through a memory map,
+# so validation takes milliseconds regardless of the size of the extract. A CSV header
+# carries no types, so for CSV extracts the first block of rows is also read and each
+# column checked to parse as its reference type (eg dates as dates).
+#
+# usage:
+#   python analysis/validate_schema.py                       # all extracts vs dummy data / declared schemas
+#   python analysis/validate_schema.py REFERENCE TARGET      # any pair of files
+#   python analysis/validate_schema.py registry:snapshot TARGET   # a file vs its schema_registry.py declaration
+#
+# Exits with status 1 if any column is missing, extra, or of a different type.
+# As in `import_extract` in utility.R, the dummy data only matters outside of the
+# real backend, so there the results are reported but never fail the action.
+
+import argparse
+import gzip
+import json
+import os
+import sys
+from pathlib import Path
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import schema_registry
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# (reference, target) pairs checked by default
+DEFAULT_PAIRS = {
+    "fixed": (
+        ROOT / "lib" / "dummydata" / "dummyinput_fixed.arrow",
+        ROOT / "output" / "extracts" / "extract_fixed.arrow",
+    ),
+    "varying": (
+        ROOT / "lib" / "dummydata" / "dummyinput_varying.arrow",
+        ROOT / "output" / "extracts" / "extract_varying.arrow",
+    ),
+    # there is no custom dummy data for the snapshot, so check against the declared columns
+    "snapshot": (
+        "registry:snapshot",
+        ROOT / "output" / "input_snapshot.csv.gz",
+    ),
+}
+
+REGISTRY_PREFIX = "registry:"
+
+# a CSV header carries no types, so columns read from one have this placeholder type
+UNKNOWN = "unknown"
+
+# bytes of a CSV read to check its values against the reference types
+CSV_SAMPLE_BYTES = 1 << 20
+# as schema_registry.read_extract()
+BOOLEAN_VALUES = ["1", "T", "TRUE", "True", "true", "0", "F", "FALSE", "False", "false"]
+
+
+## schema readers ----
+
+def _read_csv_header(path):
+    opener = gzip.open if path.suffix == ".gz" else open
+    with opener(path, "rt", newline="") as f:
+        header = f.readline().rstrip("\r\n")
+    return {name.strip('"'): UNKNOWN for name in header.split(",") if name}
+
+
+def csv_mismatches(path, reference):
+    # columns of a CSV whose values in the first block don't parse as their reference type
+    import pyarrow.csv as pacsv
+
+    names = [name for name in _read_csv_header(Path(path)) if name in reference and reference[name] != UNKNOWN]
+    if not names:
+        return []
+    with pacsv.open_csv(
+        path,
+        read_options=pacsv.ReadOptions(block_size=CSV_SAMPLE_BYTES),
+        convert_options=pacsv.ConvertOptions(
+            column_types={name: pa.string() for name in names},
+            include_columns=names,
+            strings_can_be_null=True,
+        ),
+    ) as reader:
+        try:
+            sample = reader.read_next_batch()
+        except StopIteration:
+            return []
+
+    mismatched = []
+    for name in names:
+        ref_type = reference[name]
+        value_type = ref_type.value_type if pa.types.is_dictionary(ref_type) else ref_type
+        column = sample.column(name)
+        if pa.types.is_boolean(value_type):
+            # cohortextractor writes binary flags as 0/1
+            parses = pc.all(pc.is_in(column.drop_null(), pa.array(BOOLEAN_VALUES))).as_py() is not False
+        else:
+            try:
+                column.cast(value_type)
+                parses = True
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                parses = False
+        if not parses:
+            mismatched.append({"column": name, "reference": str(ref_type), "target": "csv values that don't parse as it"})
+    return mismatched
+
+
+def read_schema(path):
+    # column name -> arrow type (or UNKNOWN), reading metadata only
+    path = Path(path)
+    suffixes = "".join(path.suffixes)
+
+    if suffixes.endswith((".arrow", ".feather")):
+        with pa.memory_map(str(path)) as source:
+            try:
+                schema = pa.ipc.open_file(source).schema
+            except pa.ArrowInvalid:
+                # arrow stream format has no footer but the schema message comes first
+                source.seek(0)
+                schema = pa.ipc.open_stream(source).schema
+    elif suffixes.endswith(".parquet"):
+        schema = pq.read_schema(str(path), memory_map=True)
+    elif suffixes.endswith((".csv", ".csv.gz")):
+        return _read_csv_header(path)
+    else:
+        raise ValueError(f"don't know how to read the schema of {path}")
+
+    return {field.name: field.type for field in schema}
+
+
+## type comparison ----
+
+def type_kind(arrow_type):
+    # coarse type used for comparisons, matching how the R scripts consume each column
+    if arrow_type == UNKNOWN:
+        return UNKNOWN
+    if pa.types.is_dictionary(arrow_type):
+        return type_kind(arrow_type.value_type)
+    if pa.types.is_date(arrow_type) or pa.types.is_timestamp(arrow_type):
+        return "date"
+    if pa.types.is_boolean(arrow_type):
+        return "boolean"
+    if pa.types.is_integer(arrow_type):
+        return "integer"
+    if pa.types.is_floating(arrow_type) or pa.types.is_decimal(arrow_type):
+        return "float"
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return "string"
+    return str(arrow_type)
+
+
+def compare_schemas(reference, target, strict=False):
+    # reference and target are dicts of column name -> type, as returned by read_schema
+    missing = [name for name in reference if name not in target]
+    extra = [name for name in target if name not in reference]
+
+    mismatched = []
+    for name in reference:
+        if name not in target:
+            continue
+        ref_type, target_type = reference[name], target[name]
+        if UNKNOWN in (ref_type, target_type):
+            continue
+        if strict:
+            different = ref_type != target_type
+        else:
+            different = type_kind(ref_type) != type_kind(target_type)
+        if different:
+            mismatched.append({
+                "column": name,
+                "reference": str(ref_type),
+                "target": str(target_type),
+            })
+
+    return {
+        "missing": missing,
+        "extra": extra,
+        "mismatched": mismatched,
+        "ok": not (missing or extra or mismatched),
+    }
+
+
+def read_registry_schema(dataset_name, target_names):
+    # declared columns, expanded to however many vaccination slots the target has
+    dataset = schema_registry.DATASETS[dataset_name]
+    schema = dataset.arrow_schema(dataset.n_slots_in(target_names))
+    return {field.name: field.type for field in schema}
+
+
+def validate(reference_path, target_path, strict=False):
+    if not Path(target_path).exists():
+        return {"missing": [], "extra": [], "mismatched": [], "ok": False, "error": "target not found",
+                "reference": str(reference_path), "target": str(target_path)}
+    target = read_schema(target_path)
+    if str(reference_path).startswith(REGISTRY_PREFIX):
+        reference = read_registry_schema(str(reference_path)[len(REGISTRY_PREFIX):], list(target))
+    else:
+        reference = read_schema(reference_path)
+    result = compare_schemas(reference, target, strict=strict)
+    if UNKNOWN in target.values():
+        result["mismatched"] += csv_mismatches(target_path, reference)
+    if str(reference_path).startswith(REGISTRY_PREFIX):
+        # columns that aren't declared are skipped by the readers, so they aren't an error
+        result["ok"] = not (result["missing"] or result["mismatched"])
+    else:
+        result["ok"] = not (result["missing"] or result["extra"] or result["mismatched"])
+    result["reference"] = str(reference_path)
+    result["target"] = str(target_path)
+    return result
+
+
+def format_result(name, result):
+    lines = [f"{name}: {'ok' if result['ok'] else 'FAILED'} ({result['target']} vs {result['reference']})"]
+    if "error" in result:
+        lines.append(f"  {result['error']}")
+    if result["missing"]:
+        lines.append("  in reference but not in target: " + ", ".join(result["missing"]))
+    if result["extra"]:
+        lines.append("  in target but not in reference: " + ", ".join(result["extra"]))
+    for m in result["mismatched"]:
+        lines.append(f"  type mismatch for {m['column']}: reference {m['reference']}, target {m['target']}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare extract schemas without reading any data")
+    parser.add_argument("reference", nargs="?", help="reference file, e.g. custom dummy data")
+    parser.add_argument("target", nargs="?", help="file to check, e.g. study definition output")
+    parser.add_argument("--strict", action="store_true",
+                        help="require identical arrow types, not just the same kind (date, string, integer, ...)")
+    parser.add_argument("--output", help="write the results as json to this file")
+    args = parser.parse_args(argv)
+
+    if (args.reference is None) != (args.target is None):
+        parser.error("give both a reference and a target file, or neither")
+
+    if args.reference is not None:
+        pairs = {Path(args.target).name: (args.reference, Path(args.target))}
+    else:
+        # a missing extract is reported as a failure rather than skipped
+        pairs = DEFAULT_PAIRS
+
+    results = {}
+    for name, (reference_path, target_path) in pairs.items():
+        results[name] = validate(reference_path, target_path, strict=args.strict)
+        print(format_result(name, results[name]))
+
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    dummy_data_backend = os.environ.get("OPENSAFELY_BACKEND", "") in ("", "expectations")
+    if dummy_data_backend and not all(r["ok"] for r in results.values()):
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
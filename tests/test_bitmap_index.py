@@ -0,0 +1,70 @@
+import csv
+
+import numpy as np
+import pyarrow as pa
+
+import arrow_io
+import bitmap_index
+
+
+def test_popcount_table_matches_bitwise_count():
+    words = np.random.default_rng(1).integers(0, 2**63, size=1024, dtype=np.int64).view(np.uint64)
+    expected = sum(bin(int(w)).count("1") for w in words)
+    assert bitmap_index._popcount_table(words) == expected
+    assert bitmap_index._popcount(words) == expected
+
+
+def test_bitmap_round_trip_and_intersections():
+    rng = np.random.default_rng(2)
+    n = 3 * bitmap_index.CHUNK_SIZE
+    # one dense (bitset) and one sparse (array) set of rows
+    a = np.flatnonzero(rng.random(n) < 0.5)
+    b = np.flatnonzero(rng.random(n) < 0.01)
+    bitmap_a, bitmap_b = bitmap_index.Bitmap.from_rows(a), bitmap_index.Bitmap.from_rows(b)
+    assert np.array_equal(bitmap_a.rows(), a)
+    assert len(bitmap_a & bitmap_b) == len(np.intersect1d(a, b))
+    assert np.array_equal((bitmap_a | bitmap_b).rows(), np.union1d(a, b))
+    assert bitmap_index.intersection_count([bitmap_a, bitmap_b, bitmap_a]) == len(np.intersect1d(a, b))
+
+
+def test_missing_values_are_a_level():
+    column = pa.array(["a", None, "b", "a", None]).dictionary_encode()
+    codes, levels = bitmap_index.factorize(column)
+    assert levels == ["a", "b", bitmap_index.MISSING]
+    assert codes.tolist() == [0, 2, 1, 0, 2]
+
+    index = bitmap_index.SubgroupIndex.from_table(pa.table({"x": column}))
+    assert index.count(x=bitmap_index.MISSING) == 2
+    assert sum(index.count(x=level) for level in index.levels("x")) == 5
+
+
+def test_crosstab_matches_brute_force():
+    rng = np.random.default_rng(3)
+    n = 5000
+    sex = rng.choice(["Female", "Male"], n)
+    imd = np.where(rng.random(n) < 0.1, None, rng.choice(["1", "2", "3"], n)).tolist()
+    table = pa.table({"sex": pa.array(sex), "imd": pa.array(imd)})
+    index = bitmap_index.SubgroupIndex.from_table(table)
+    counts = index.crosstab("imd", "sex")
+    for (level, s), count in counts.items():
+        value = None if level == bitmap_index.MISSING else level
+        assert count == sum(1 for i in range(n) if imd[i] == value and sex[i] == s)
+
+
+def test_main_on_processed_snapshot(tmp_path):
+    rng = np.random.default_rng(4)
+    n = 200
+    table = pa.table({
+        "patient_id": pa.array(np.arange(n)),
+        "agegroup_medium": pa.array(rng.choice(["18-49", "50-64"], n)).dictionary_encode(),
+        "sex": pa.array(rng.choice(["Female", "Male"], n)).dictionary_encode(),
+        "n_vax": pa.array(rng.integers(0, 8, n).astype(str)).dictionary_encode(),
+    })
+    path, output = tmp_path / "processed_snapshot.arrow", tmp_path / "counts.csv"
+    arrow_io.write_table(table, path)
+    assert bitmap_index.main(["--input", str(path), "--output", str(output), "--rounding", "1"]) == 0
+    with open(output) as f:
+        rows = list(csv.DictReader(f))
+    assert {row["covariate"] for row in rows} == {"sex"}
+    assert {row["n_vax"] for row in rows} == {"0", "1", "2", "3", "4", "5plus"}
+    assert sum(int(row["n"]) for row in rows) == n
@@ -0,0 +1,60 @@
+import datetime
+
+import pyarrow as pa
+
+import arrow_io
+import dose_coverage
+import dose_table
+import schema_registry
+
+
+def _set(table, name, array):
+    return table.set_column(table.column_names.index(name), name, array)
+
+
+def _population(n):
+    fixed = schema_registry.dummy_table(schema_registry.fixed, n=n)
+    return _set(fixed, "death_date", pa.nulls(n, pa.date32()))
+
+
+def _final(rows, k=1):
+    last = max(row["week"] for row in rows)
+    return next(row for row in rows if row["group"] == "all" and row["k"] == k and row["week"] == last)
+
+
+def test_deregistration_does_not_censor():
+    n = 30
+    population = _population(n)
+    wide = schema_registry.dummy_table(schema_registry.varying, n=n)
+    for i in range(1, 4):
+        wide = _set(wide, f"deregistered_{i}_date", pa.array([datetime.date(2021, 1, 1)] * n, pa.date32()))
+    long = dose_table.wide_to_long(wide)
+    weeks = dose_coverage.week_starts(dose_coverage.START_DATE, dose_coverage.END_DATE)
+
+    final = _final(dose_coverage.coverage_curves(population, long, weeks))
+    vax_day = dose_table.to_days(long.column("vax_date"))
+    vaccinated = set(long.column("patient_id").to_numpy()[vax_day < weeks[-1] + 7])
+    assert final["n_population"] == n
+    assert final["n_vaccinated"] == len(vaccinated)
+
+
+def test_death_censors_from_the_following_week():
+    population = _population(4)
+    population = _set(population, "death_date", pa.array([datetime.date(2021, 6, 1), None, None, None], pa.date32()))
+    long = dose_table.wide_to_long(schema_registry.dummy_table(schema_registry.varying, n=4).slice(0, 0))
+    weeks = dose_coverage.week_starts(dose_coverage.START_DATE, dose_coverage.END_DATE)
+
+    final = _final(dose_coverage.coverage_curves(population, long, weeks))
+    assert final["n_population"] == 3
+    assert final["n_vaccinated"] == 0
+
+
+def test_main_without_doses(tmp_path):
+    fixed, varying = tmp_path / "fixed.arrow", tmp_path / "varying.arrow"
+    wide = schema_registry.dummy_table(schema_registry.varying, n=10)
+    arrow_io.write_table(_population(10), fixed)
+    arrow_io.write_table(wide.slice(0, 0), varying)
+
+    output = tmp_path / "coverage.csv"
+    assert dose_coverage.main(["--fixed", str(fixed), "--varying", str(varying), "--clean", "--output", str(output)]) == 0
+    assert output.read_text().startswith("group,level,k,week")
@@ -0,0 +1,71 @@
+import datetime
+
+import numpy as np
+import pyarrow as pa
+
+import dose_history
+import dose_table
+import schema_registry
+
+
+def _history(n=300):
+    wide = schema_registry.dummy_table(schema_registry.varying, n=n, n_slots=4)
+    return wide, dose_history.DoseHistory.from_wide(wide)
+
+
+def _doses_by_patient(wide):
+    long = dose_table.wide_to_long(wide)
+    doses = {p: [] for p in wide.column("patient_id").to_pylist()}
+    for p, date in zip(long.column("patient_id").to_pylist(), long.column("vax_date").to_pylist()):
+        doses[p].append(date)
+    return doses
+
+
+def test_accessors_match_the_long_table():
+    wide, history = _history()
+    doses = _doses_by_patient(wide)
+    ids = history.patient_id.tolist()
+    assert ids == sorted(doses)
+    assert history.counts.tolist() == [len(doses[p]) for p in ids]
+    assert history.kth(2).to_pylist() == [d[1] if len(d) > 1 else None for d in (doses[p] for p in ids)]
+    assert history.last().to_pylist() == [d[-1] if d else None for d in (doses[p] for p in ids)]
+
+
+def test_count_before_matches_brute_force():
+    wide, history = _history()
+    doses = _doses_by_patient(wide)
+    rng = np.random.default_rng(5)
+    dates = [None if rng.random() < 0.1 else datetime.date(2021, 1, 1) + datetime.timedelta(int(x))
+             for x in rng.integers(0, 900, len(history))]
+    for inclusive in (False, True):
+        counts = history.count_before(pa.array(dates, pa.date32()), inclusive=inclusive)
+        expected = [
+            0 if date is None else sum(d < date or (inclusive and d == date) for d in doses[p])
+            for p, date in zip(history.patient_id.tolist(), dates)
+        ]
+        assert counts.tolist() == expected
+    assert history.count_before("2023-09-01").tolist() == [
+        sum(d < datetime.date(2023, 9, 1) for d in doses[p]) for p in history.patient_id.tolist()
+    ]
+
+
+def test_interval_to_previous():
+    wide, history = _history()
+    doses = _doses_by_patient(wide)
+    expected = []
+    for p in history.patient_id.tolist():
+        expected.extend([None] + [(b - a).days for a, b in zip(doses[p], doses[p][1:])] if doses[p] else [])
+    assert history.interval_to_previous().to_pylist() == expected
+
+
+def test_arrow_round_trip(tmp_path):
+    wide, history = _history(50)
+    path = tmp_path / "history.arrow"
+    history.write(path)
+    read = dose_history.DoseHistory.read(path)
+    assert read.patient_id.tolist() == history.patient_id.tolist()
+    assert read.offsets.tolist() == history.offsets.tolist()
+    assert read.to_long().equals(history.to_long())
+    p = int(history.patient_id[np.argmax(history.counts)])
+    assert [d["vax_date"] for d in read.patient(p)] == _doses_by_patient(wide)[p]
+    assert read.patient(-1) == []
@@ -0,0 +1,45 @@
+import json
+
+import numpy as np
+import pyarrow as pa
+
+import arrow_io
+import dose_slots
+
+
+def test_choose_slots():
+    n_doses = np.array([1, 2, 2, 3, 40])
+    assert dose_slots.choose_slots(n_doses) == 40
+    assert dose_slots.choose_slots(n_doses, quantile=0.75) == 3
+    assert dose_slots.choose_slots(n_doses, max_slots=20) == 20
+    assert dose_slots.choose_slots([], min_slots=2) == 2
+
+
+def test_truncation():
+    assert dose_slots.truncation(np.array([1, 3, 5]), 3) == {
+        "n_patients": 3, "n_doses": 9, "n_patients_truncated": 1, "n_doses_truncated": 2,
+    }
+
+
+def _run(tmp_path, n_doses, *args):
+    path = tmp_path / "extract_dose_count.arrow"
+    table = pa.table({"patient_id": pa.array(np.arange(1, len(n_doses) + 1)), "n_doses": pa.array(n_doses, pa.int64())})
+    arrow_io.write_table(table, path)
+    assert dose_slots.main(["--input", str(path), "--output-dir", str(tmp_path), *args]) == 0
+    with open(tmp_path / "dose_slots.json") as f:
+        return json.load(f)
+
+
+def test_main_records_the_cap(tmp_path):
+    summary = _run(tmp_path, [1, 2, 3] * 10 + [25, 30])
+    assert summary["n_slots"] == dose_slots.MAX_SLOTS
+    assert summary["uncapped_n_slots"] == 30
+    assert summary["capped"] and summary["source"] == "max_slots"
+    assert summary["n_patients_truncated_by_cap"] == 2
+
+
+def test_main_without_cap(tmp_path):
+    summary = _run(tmp_path, [1, 2, 3] * 10 + [25, 30], "--max-slots", "0")
+    assert summary["n_slots"] == 30
+    assert not summary["capped"] and summary["source"] == "maximum"
+    assert summary["n_patients_truncated_by_cap"] == 0
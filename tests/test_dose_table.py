@@ -0,0 +1,80 @@
+import datetime
+import os
+import threading
+
+import pyarrow as pa
+
+import arrow_io
+import campaigns
+import dose_history
+import dose_qa
+import dose_table
+import schema_registry
+
+
+def without_doses(table):
+    # the same patients with every slot column missing
+    for k, field in enumerate(table.schema):
+        if field.name != "patient_id":
+            table = table.set_column(k, field.name, pa.nulls(table.num_rows, field.type))
+    return table
+
+
+def test_wide_to_long_one_row_per_dose_sorted():
+    wide = schema_registry.dummy_table(schema_registry.varying, n=200, n_slots=3)
+    long = dose_table.wide_to_long(wide)
+    n_doses = sum(wide.column(f"covid_vax_{i}_date").null_count for i in (1, 2, 3))
+    assert long.num_rows == 3 * wide.num_rows - n_doses
+    assert long.schema == dose_table.long_schema()
+    keys = list(zip(long.column("patient_id").to_pylist(), long.column("vax_date").to_pylist()))
+    assert keys == sorted(keys)
+
+
+def test_wide_to_long_without_doses_keeps_columns():
+    wide = without_doses(schema_registry.dummy_table(schema_registry.varying, n=20))
+    long = dose_table.wide_to_long(wide)
+    assert long.num_rows == 0
+    assert long.schema == dose_table.long_schema()
+
+
+def test_wide_to_long_without_rows_keeps_columns():
+    wide = schema_registry.dummy_table(schema_registry.varying, n=20).slice(0, 0)
+    assert dose_table.wide_to_long(wide).schema == dose_table.long_schema()
+
+
+def test_read_long_of_empty_stream(tmp_path):
+    # a stream over a named pipe that ends without any batches
+    path = tmp_path / "pipe"
+    os.mkfifo(path)
+
+    def produce():
+        with open(path, "wb") as sink, pa.ipc.new_stream(sink, schema_registry.varying.arrow_schema()):
+            pass
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    long = dose_table.read_long(path)
+    producer.join()
+    assert long.num_rows == 0
+    assert long.schema == dose_table.long_schema()
+
+
+def test_actions_run_without_doses(tmp_path):
+    path = tmp_path / "extract_varying.arrow"
+    wide = without_doses(schema_registry.dummy_table(schema_registry.varying, n=20))
+    arrow_io.write_table(wide, path)
+
+    assert dose_qa.main(["--input", str(path), "--output-dir", str(tmp_path / "qa")]) == 0
+    assert campaigns.main(["--input", str(path), "--output-dir", str(tmp_path / "campaigns")]) == 0
+    written = arrow_io.read_table(tmp_path / "campaigns" / "dose_campaigns.arrow")
+    assert written.num_rows == 0
+    assert "vax_type" in written.column_names
+
+    history = dose_history.DoseHistory.from_wide(wide)
+    assert len(history.patient_id) == wide.num_rows
+
+
+def test_day_round_trip():
+    assert dose_table.day("1970-01-02") == 1
+    dates = pa.array([datetime.date(2021, 1, 1)], type=pa.date32())
+    assert dose_table.to_days(dates)[0] == dose_table.day("2021-01-01")
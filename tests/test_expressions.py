@@ -0,0 +1,44 @@
+import datetime
+
+import numpy as np
+import pyarrow as pa
+
+import expressions
+
+
+def _table():
+    return pa.table({
+        "age": pa.array([17, 30, None, 70]),
+        "ethnicity_primary": pa.array(["1", None, None, "2"]),
+        "ethnicity_sus": pa.array(["2", "1", "3", None]),
+        "dialysis_date": pa.array([datetime.date(2020, 1, 1), None, datetime.date(2021, 1, 1), None], pa.date32()),
+        "transplant_date": pa.array([datetime.date(2019, 1, 1), datetime.date(2019, 1, 1), None, None], pa.date32()),
+    })
+
+
+def _satisfying(expression, nulls="default"):
+    return expressions.satisfying(expression, _table(), nulls).to_pylist()
+
+
+def test_missing_numbers_and_strings_default_to_zero_and_empty():
+    assert _satisfying("age < 18") == [True, False, True, False]
+    assert _satisfying("age < 18", nulls="kleene") == [True, False, False, False]
+    assert _satisfying("ethnicity_primary='1' OR (NOT ethnicity_primary AND ethnicity_sus='1')") == [True, True, False, False]
+
+
+def test_missing_dates_compare_as_unknown():
+    assert _satisfying("dialysis_date > transplant_date") == [True, False, False, False]
+    assert _satisfying("NOT dialysis_date > transplant_date") == [False, False, False, False]
+    assert _satisfying("dialysis_date > transplant_date", nulls="kleene") == [True, False, False, False]
+
+
+def test_bare_dates_are_true_when_present():
+    assert _satisfying("dialysis_date") == [True, False, True, False]
+    assert _satisfying("NOT dialysis_date") == [False, True, False, True]
+    assert _satisfying("dialysis_date AND transplant_date") == [True, False, False, False]
+
+
+def test_categorised_as_with_default():
+    categories = {"young": "age < 50", "old": "age >= 50", "missing": "DEFAULT"}
+    labels = expressions.categorised_as(categories, _table(), nulls="kleene")
+    assert np.asarray(labels.to_pylist()).tolist() == ["young", "young", "missing", "old"]
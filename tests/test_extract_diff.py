@@ -0,0 +1,76 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import arrow_io
+import extract_diff
+import schema_registry
+import sorted_extract
+
+
+def _versions():
+    old = schema_registry.dummy_table(schema_registry.fixed, n=2000)
+    ids = old.column("patient_id").to_numpy()
+    # remove a few patients, change the age of a few others and add some new ones
+    removed = ids[[5, 900]]
+    changed = ids[[10, 11, 1500]]
+    new = old.filter(pa.array(~np.isin(ids, removed)))
+    new_ids = new.column("patient_id").to_numpy()
+    age = pc.if_else(pa.array(np.isin(new_ids, changed)), pa.scalar(200, pa.int32()), new.column("age"))
+    new = new.set_column(new.column_names.index("age"), "age", age)
+    inserted = old.slice(0, 4)
+    inserted = inserted.set_column(0, "patient_id", pa.array(ids.max() + 1 + np.arange(4)))
+    new = pa.concat_tables([new, inserted]).unify_dictionaries()
+    return old, new, removed, changed
+
+
+def _write(tmp_path, old, new):
+    old_path, new_path = tmp_path / "old.arrow", tmp_path / "new.arrow"
+    sorted_extract.write_sorted(old, old_path, batch_size=100)
+    sorted_extract.write_sorted(new, new_path, batch_size=100)
+    return old_path, new_path
+
+
+def test_diff_finds_each_change(tmp_path):
+    old, new, removed, changed = _versions()
+    delta, stats = extract_diff.diff(*_write(tmp_path, old, new))
+
+    assert (stats["inserted"], stats["removed"], stats["changed"]) == (4, 2, 3)
+    # batches away from the changes are set aside without being read
+    assert stats["pieces_shared"] > 0
+    assert stats["rows_read_old"] < old.num_rows
+    assert stats["changed_by_column"] == {"age": 3}
+
+    def ids(change):
+        return sorted(delta.filter(pc.equal(delta.column("change"), change)).column("patient_id").to_pylist())
+
+    assert ids("removed") == sorted(removed.tolist())
+    assert ids("changed") == sorted(changed.tolist() * 2)
+    changed_rows = delta.filter(pc.equal(delta.column("change"), "changed"))
+    assert set(changed_rows.column("changed_columns").to_pylist()) == {"age"}
+    assert changed_rows.column("version").to_pylist()[:2] == ["old", "new"]
+
+
+def test_identical_versions(tmp_path):
+    old, _, _, _ = _versions()
+    delta, stats = extract_diff.diff(*_write(tmp_path, old, old))
+    assert delta.num_rows == 0
+    assert stats["pieces_shared"] == stats["pieces_old"]
+
+
+def test_diff_against_an_empty_version(tmp_path):
+    old, _, _, _ = _versions()
+    old_path, new_path = _write(tmp_path, old.slice(0, 0), old)
+    delta, stats = extract_diff.diff(old_path, new_path)
+    assert stats["inserted"] == old.num_rows
+    assert stats["removed"] == stats["changed"] == 0
+
+
+def test_main_without_an_index(tmp_path):
+    # files written without sorted_extract.py are compared in full
+    old, new, _, _ = _versions()
+    old_path, new_path, output = tmp_path / "old.arrow", tmp_path / "new.arrow", tmp_path / "delta.arrow"
+    arrow_io.write_table(old, old_path)
+    arrow_io.write_table(new, new_path)
+    assert extract_diff.main([str(old_path), str(new_path), "--output", str(output)]) == 0
+    assert arrow_io.read_table(output).num_rows == 4 + 2 + 2 * 3
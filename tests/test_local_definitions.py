@@ -0,0 +1,76 @@
+import pytest
+
+import local_definitions
+import local_engine
+
+
+@pytest.fixture(scope="module")
+def engine(tmp_path_factory):
+    engine = local_engine.Engine(str(tmp_path_factory.mktemp("db") / "dummy.db"))
+    local_engine.create_dummy_database(engine.connection, 400, event_codes=local_definitions.event_codes())
+    return engine
+
+
+def test_varying_slots_follow_the_definition(engine):
+    table, _ = engine.run(local_definitions.varying(n_slots=3))
+    result = {row["patient_id"]: row for row in table.to_pylist()}
+
+    # each slot is the first covid vaccination strictly after the previous slot
+    dates = {}
+    for patient_id, date in engine.query(
+        "SELECT patient_id, date FROM vaccinations WHERE target_disease = 'SARS-2 CORONAVIRUS'"
+    ):
+        dates.setdefault(patient_id, set()).add(date)
+    assert set(result) == set(dates)
+    for patient_id, patient_dates in dates.items():
+        slots = sorted(patient_dates)[:3]
+        for i in range(1, 4):
+            expected = slots[i - 1] if i <= len(slots) else None
+            assert str(result[patient_id][f"covid_vax_{i}_date"] or "") == str(expected or "")
+            if expected is None:
+                # exists_for_patient() is false, not missing, without a vaccination
+                assert result[patient_id][f"registered_{i}"] is False
+
+
+def test_fixed_population_is_registered_on_the_index_date(engine):
+    table, _ = engine.run(local_definitions.fixed())
+    condition, _ = local_definitions.active_registration(repr(local_definitions.INDEX_DATE))
+    registered = {row[0] for row in engine.query(f"SELECT DISTINCT patient_id FROM practice_registrations AS r WHERE {condition}")}
+    assert set(table.column("patient_id").to_pylist()) == registered
+    assert all(table.column("registered").to_pylist())
+
+
+def test_frames_are_named_after_their_steps():
+    names = list(local_definitions.varying(n_slots=2).frames)
+    assert names == [
+        "vaccinations_where_1",
+        "vaccinations_first_1", "practice_registrations_on_1",
+        "vaccinations_first_2", "practice_registrations_on_2",
+    ]
+
+
+@pytest.mark.parametrize("body, message", [
+    ("dataset.x = medications.sort_by(medications.date).first_for_patient().date", "no local table medications"),
+    ("dataset.x = patients.date_of_birth.year", "series method year"),
+    ("dataset.x = vaccinations.sort_by(vaccinations.date).first_for_patient().dose", "no column dose"),
+    ("dataset.x = vaccinations.date", "reducing to one row per patient"),
+])
+def test_unsupported_expressions_raise(tmp_path, body, message):
+    path = tmp_path / "dataset_definition.py"
+    path.write_text(
+        "from ehrql import Dataset\n"
+        "from ehrql.tables.beta.tpp import patients, medications, vaccinations\n"
+        "dataset = Dataset()\n"
+        "dataset.define_population(vaccinations.exists_for_patient())\n"
+        f"{body}\n"
+    )
+    with pytest.raises(local_definitions.Untranslatable, match=message):
+        local_definitions.translate(path)
+
+
+def test_snapshot_takes_the_study_definition_variables():
+    names = {variable.name for variable in local_definitions.snapshot().variables}
+    events = local_definitions.source_events()
+    assert {"hba1c_mmol_per_mol_date", "creatinine_age", "age"} <= names
+    assert "ethnicity_primary" in events and "ethnicity_primary" not in names
+    assert local_definitions.check() == []
@@ -0,0 +1,25 @@
+import json
+
+import numpy as np
+
+import memory_profile
+
+
+def test_profile_action_reports_block_and_process_peaks(tmp_path):
+    with memory_profile.profile_action("block", enabled=True, output_dir=tmp_path, log_dir=tmp_path, interval=0.01):
+        block = np.ones(2**23)
+        block.sum()
+    with open(tmp_path / "memory_block.json") as f:
+        summary = json.load(f)
+    assert summary["peak_rss_bytes"] == summary["sampled_peak_rss_bytes"]
+    # sampled from /proc, so not exactly comparable with ru_maxrss
+    assert summary["peak_rss_bytes"] > 0
+    assert summary["process_peak_rss_bytes"] > 0
+
+
+def test_find_artifacts_only_declared_outputs(tmp_path, monkeypatch):
+    monkeypatch.setattr(memory_profile, "ROOT", tmp_path)
+    for name in ("mine.arrow", "other.arrow"):
+        (tmp_path / name).write_bytes(b"")
+    found = memory_profile.find_artifacts(tmp_path, since=0, outputs=["mine.*"])
+    assert [p.name for p in found] == ["mine.arrow"]
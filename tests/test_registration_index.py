@@ -0,0 +1,97 @@
+import datetime
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+import dose_table
+import registration_index
+
+
+BASE = datetime.date(2020, 1, 1)
+
+
+def _date(offset):
+    return BASE + datetime.timedelta(int(offset))
+
+
+def _registrations(rng, n, n_patients):
+    start = rng.integers(0, 60, n)
+    # some periods end before they start, or on the day they start
+    end = start + rng.integers(-2, 30, n)
+    open_end = rng.random(n) < 0.3
+    table = pa.table({
+        "patient_id": pa.array(rng.integers(1, n_patients, n)),
+        "start_date": pa.array([_date(x) for x in start], pa.date32()),
+        "end_date": pa.array([None if o else _date(x) for x, o in zip(end, open_end)], pa.date32()),
+        "practice_pseudo_id": pa.array(rng.integers(1, 5, n)),
+    })
+    return table, start, end, open_end
+
+
+def _for_patient_on(table, start, end, open_end, patient_id, day):
+    # ehrql's for_patient_on: active on the date, then the last by start_date, end_date
+    # (open ends first) and practice_pseudo_id
+    pid = table.column("patient_id").to_numpy()
+    practice = table.column("practice_pseudo_id").to_numpy()
+    active = [
+        (start[i], (0, 0) if open_end[i] else (1, end[i]), practice[i], i)
+        for i in range(len(pid))
+        if pid[i] == patient_id and start[i] <= day and (open_end[i] or end[i] >= day)
+    ]
+    if not active:
+        return None
+    i = max(active)[3]
+    return int(practice[i]), None if open_end[i] else _date(end[i])
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_lookup_matches_for_patient_on(seed):
+    rng = np.random.default_rng(seed)
+    table, start, end, open_end = _registrations(rng, n=1500, n_patients=150)
+    index = registration_index.RegistrationIndex.from_table(table)
+
+    query_patient = rng.integers(0, 155, 2000)
+    query_day = rng.integers(-5, 95, 2000)
+    rows = index.lookup(query_patient, query_day + dose_table.day(str(BASE)))
+    practice = index.take(rows, "practice_pseudo_id").to_pylist()
+    end_date = index.end_date(rows).to_pylist()
+
+    for k, (patient_id, day) in enumerate(zip(query_patient, query_day)):
+        expected = _for_patient_on(table, start, end, open_end, patient_id, day)
+        got = None if rows[k] < 0 else (practice[k], end_date[k])
+        assert got == expected, (patient_id, day)
+
+
+def test_resolve_doses():
+    registrations = pa.table({
+        "patient_id": pa.array([1, 1, 2]),
+        "start_date": pa.array([datetime.date(2020, 1, 1), datetime.date(2021, 6, 1), datetime.date(2022, 1, 1)]),
+        "end_date": pa.array([datetime.date(2021, 5, 31), None, datetime.date(2022, 6, 30)], pa.date32()),
+        "practice_pseudo_id": pa.array([10, 11, 20]),
+        "practice_nuts1_region_name": pa.array(["London", "North East", "London"]),
+    })
+    long = pa.table({
+        "patient_id": pa.array([1, 1, 2, 3]),
+        "vax_date": pa.array([datetime.date(2021, 1, 1), datetime.date(2021, 7, 1),
+                              datetime.date(2022, 9, 1), datetime.date(2022, 1, 1)]),
+    })
+    index = registration_index.RegistrationIndex.from_table(registrations)
+    resolved = registration_index.resolve_doses(long, index)
+    assert resolved.column("registered").to_pylist() == [True, True, False, False]
+    assert resolved.column("practice_pseudo_id").to_pylist() == [10, 11, None, None]
+    assert resolved.column("region").to_pylist() == ["London", "North East", None, None]
+    assert resolved.column("deregistered_date").to_pylist() == [datetime.date(2021, 5, 31), None, None, None]
+
+
+def test_empty_index():
+    registrations = pa.table({
+        "patient_id": pa.array([], pa.int64()),
+        "start_date": pa.array([], pa.date32()),
+        "end_date": pa.array([], pa.date32()),
+        "practice_pseudo_id": pa.array([], pa.int64()),
+    })
+    index = registration_index.RegistrationIndex.from_table(registrations)
+    rows = index.lookup(np.array([1, 2]), np.array([18000, 18001]))
+    assert rows.tolist() == [-1, -1]
+    assert index.take(rows, "practice_pseudo_id").to_pylist() == [None, None]
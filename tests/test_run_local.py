@@ -0,0 +1,35 @@
+import run_local
+
+
+def _inputs(name):
+    actions = run_local.load_actions()
+    return {str(p.relative_to(run_local.ROOT)) for p in run_local.action_inputs(actions[name])}
+
+
+def test_definition_keyed_on_its_imports_not_other_scripts():
+    inputs = _inputs("extract_fixed")
+    assert "analysis/dataset_definition_fixed.py" in inputs
+    assert "analysis/schema_registry.py" in inputs
+    assert "lib/dummydata/dummyinput_fixed.arrow" in inputs
+    assert not any(p.endswith(".R") for p in inputs)
+    assert "analysis/dose_qa.py" not in inputs
+
+
+def test_python_imports_from_syntax_tree(tmp_path):
+    script = tmp_path / "script.py"
+    script.write_text(
+        "import os\n"
+        "# import commented_out\n"
+        "text = 'import in_a_string'\n"
+        "from helper import thing\n"
+        "def f():\n"
+        "    import lazy\n"
+    )
+    assert run_local.python_imports(script) == {"os", "helper", "lazy"}
+    assert run_local.python_imports(script, module_level=True) == {"os", "helper"}
+
+
+def test_r_action_keyed_on_sourced_scripts():
+    inputs = _inputs("process")
+    assert {"analysis/process.R", "analysis/utility.R"} <= inputs
+    assert not any(p.endswith(".py") for p in inputs)
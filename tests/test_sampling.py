@@ -0,0 +1,30 @@
+import numpy as np
+import pyarrow as pa
+
+import sampling
+import schema_registry
+
+
+def test_restrict_finds_sampled_patients():
+    table = pa.table({"patient_id": pa.array([5, 1, 3, 7])})
+    found, weight = sampling.restrict(table, np.array([3, 5]), np.array([2.0, 4.0]))
+    assert found.tolist() == [True, False, True, False]
+    assert weight[found].tolist() == [4.0, 2.0]
+
+
+def test_restrict_to_an_empty_sample():
+    table = pa.table({"patient_id": pa.array([1, 2, 3])})
+    found, weight = sampling.restrict(table, np.array([], dtype=np.int64), np.array([]))
+    assert not found.any()
+    assert np.isnan(weight).all()
+
+
+def test_sample_varying_with_an_empty_fixed_sample():
+    varying = schema_registry.dummy_table(schema_registry.varying, n=50)
+    fixed_sample = pa.table({
+        "patient_id": pa.array([], pa.int64()),
+        schema_registry.SAMPLE_WEIGHT: pa.array([], pa.float64()),
+    })
+    sampled = sampling.sample_varying(varying, fixed_sample, fraction=0.5)
+    # only patients outside the fixed extract, by their own hash, with weight 1 / fraction
+    assert set(sampled.column(schema_registry.SAMPLE_WEIGHT).to_pylist()) <= {2.0}
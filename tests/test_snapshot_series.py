@@ -0,0 +1,63 @@
+import datetime
+
+import numpy as np
+import pyarrow as pa
+
+import arrow_io
+import dose_table
+import schema_registry
+import snapshot_series
+
+
+def _dates(days):
+    return [str(dose_table.EPOCH + int(day)) for day in days]
+
+
+def test_monthly_snapshots_clamp_to_month_end():
+    assert _dates(snapshot_series.snapshot_dates("2021-01-31", "2021-05-31")) == [
+        "2021-01-31", "2021-02-28", "2021-03-31", "2021-04-30", "2021-05-31",
+    ]
+    assert _dates(snapshot_series.snapshot_dates("2024-01-30", "2024-03-01")) == ["2024-01-30", "2024-02-29"]
+
+
+def test_sweep_counts_doses_up_to_each_snapshot():
+    snapshots = [dose_table.day("2021-02-01"), dose_table.day("2021-03-01")]
+    doses = [dose_table.day("2021-01-10"), dose_table.day("2021-02-01"), dose_table.day("2021-02-20")]
+    table = snapshot_series.sweep(np.array([1, 2]), np.array([1, 1, 1]), np.array(doses), snapshots)
+    assert table.column("n_vax").to_pylist() == [2, 3, 0, 0]
+    assert table.column("last_vax_date").to_pylist() == [
+        datetime.date(2021, 2, 1), datetime.date(2021, 2, 20), None, None,
+    ]
+
+
+def test_main_with_empty_population(tmp_path):
+    fixed, varying = tmp_path / "fixed.arrow", tmp_path / "varying.arrow"
+    arrow_io.write_table(schema_registry.dummy_table(schema_registry.fixed, n=5).slice(0, 0), fixed)
+    arrow_io.write_table(schema_registry.dummy_table(schema_registry.varying, n=5), varying)
+
+    output = tmp_path / "series.arrow"
+    assert snapshot_series.main(["--fixed", str(fixed), "--varying", str(varying), "--clean", "--output", str(output)]) == 0
+    written = arrow_io.read_table(output)
+    assert written.num_rows == 0
+    assert written.schema.equals(snapshot_series.series_schema(), check_metadata=False)
+
+
+def test_main_clean_drops_doses_within_14_days(tmp_path):
+    fixed, varying = tmp_path / "fixed.arrow", tmp_path / "varying.arrow"
+    population = schema_registry.dummy_table(schema_registry.fixed, n=1)
+    population = population.set_column(population.column_names.index("death_date"), "death_date", pa.nulls(1, pa.date32()))
+    wide = schema_registry.dummy_table(schema_registry.varying, n=1, n_slots=2)
+    for i, date in ((1, datetime.date(2021, 3, 1)), (2, datetime.date(2021, 3, 5))):
+        name = f"covid_vax_{i}_date"
+        wide = wide.set_column(wide.column_names.index(name), name, pa.array([date], pa.date32()))
+    arrow_io.write_table(population, fixed)
+    arrow_io.write_table(wide, varying)
+
+    counts = {}
+    for clean in (False, True):
+        output = tmp_path / f"series_{clean}.arrow"
+        argv = ["--fixed", str(fixed), "--varying", str(varying), "--start", "2021-04-01", "--end", "2021-04-01",
+                "--output", str(output)]
+        snapshot_series.main(argv + ["--clean"] * clean)
+        counts[clean] = arrow_io.read_table(output).column("n_vax").to_pylist()
+    assert counts == {False: [2], True: [1]}